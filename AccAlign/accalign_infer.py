@@ -0,0 +1,233 @@
+# coding=utf-8
+"""Inference-only entry point for AccAlign word alignment.
+
+Replaces `train_alignment_adapter.py --do_test` for alignment extraction: only the
+inference arguments are parsed, and torch/transformers/adapters are imported when the
+aligner is built, so `--help` and argument errors return immediately. The AccAligner
+class is the Python API:
+
+    aligner = AccAligner(adapter_path=ADAPTER)
+    aligner.align(["Das stimmt nicht !"], ["That is not true !"])
+    # -> [{(0, 0), (1, 2), ...}], one set of (source word, target word) pairs per sentence pair
+
+Output files are named like those of word_align (<infer_filename>.<layer>, or
+<infer_filename>.thr<threshold>.<layer> for several thresholds).
+"""
+
+import argparse
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AccAligner(object):
+    def __init__(
+        self,
+        model_name_or_path="sentence-transformers/LaBSE",
+        adapter_path=None,
+        align_layer=6,
+        softmax_thresholds=(0.1,),
+        batch_size=32,
+        inference_dtype="fp32",
+        embedding_cache_dir=None,
+        early_exit=True,
+        device=None,
+    ):
+        import torch
+        import adapters
+        from transformers import AutoConfig, AutoModel, AutoTokenizer
+
+        from aligner.embedding_cache import EmbeddingCache, checkpoint_fingerprint
+        from aligner.word_align import SentenceAligner_word
+        from self_training_modeling_adapter import prepare_inference_model
+
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        # Arguments expected by BertForSO and SentenceAligner_word
+        self.args = argparse.Namespace(
+            model_name_or_path=model_name_or_path,
+            adapter_path=adapter_path,
+            align_layer=align_layer,
+            extraction="softmax",
+            softmax_threshold=softmax_thresholds[0],
+            softmax_thresholds=list(softmax_thresholds),
+            early_exit=early_exit,
+            inference_dtype=inference_dtype,
+            device=torch.device(device),
+            per_gpu_train_batch_size=batch_size,
+        )
+        self.batch_size = batch_size
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+        config = AutoConfig.from_pretrained(model_name_or_path)
+        labse_model = AutoModel.from_pretrained(model_name_or_path, output_hidden_states=True)
+        adapters.init(labse_model)
+        self.model = prepare_inference_model(self.args, config, labse_model)
+
+        self.embedding_cache = None
+        if embedding_cache_dir:
+            self.embedding_cache = EmbeddingCache(
+                embedding_cache_dir,
+                checkpoint_fingerprint(model_name_or_path, adapter_path, align_layer, inference_dtype),
+            )
+        self.sentence_aligner = SentenceAligner_word(
+            self.args, self.model, embedding_cache=self.embedding_cache
+        )
+        self.softmax_thresholds = self.sentence_aligner.softmax_thresholds
+
+    def tokenize(self, sent_src, sent_tgt):
+        """Model inputs of a sentence pair, as taken by align_examples."""
+        from aligner.sent_aligner import empty_sentence_pair, tokenize_sentence_pair
+
+        # Sentences are whitespace-tokenized strings or lists of words
+        line_src = sent_src if isinstance(sent_src, str) else " ".join(sent_src)
+        line_tgt = sent_tgt if isinstance(sent_tgt, str) else " ".join(sent_tgt)
+        if not line_src.split() or not line_tgt.split():
+            return empty_sentence_pair(self.tokenizer)
+        return tokenize_sentence_pair(self.tokenizer, line_src, line_tgt)
+
+    def align_all(self, sents_src, sents_tgt):
+        """Word alignments of every sentence pair for every threshold: {threshold: [set of (src, tgt)]}."""
+        return self.align_examples(
+            [self.tokenize(sent_src, sent_tgt) for sent_src, sent_tgt in zip(sents_src, sents_tgt)]
+        )
+
+    def align_examples(self, examples):
+        """As align_all, for sentence pairs already passed through tokenize."""
+        import torch
+        from torch.nn.utils.rnn import pad_sequence
+
+        # Batch sentences of similar length to minimize padding, the input order is restored below
+        order = sorted(
+            range(len(examples)), key=lambda i: max(len(examples[i][0]), len(examples[i][1]))
+        )
+        word_aligns_all = {threshold: [None] * len(examples) for threshold in self.softmax_thresholds}
+        pad_id = self.tokenizer.pad_token_id
+        for start in range(0, len(order), self.batch_size):
+            batch = [examples[i] for i in order[start : start + self.batch_size]]
+            ids_src = pad_sequence([example[0] for example in batch], batch_first=True, padding_value=pad_id)
+            ids_tgt = pad_sequence([example[1] for example in batch], batch_first=True, padding_value=pad_id)
+            with torch.no_grad():
+                word_aligns_batch = self.sentence_aligner.get_aligned_word(
+                    self.args,
+                    ids_src.to(self.args.device),
+                    ids_tgt.to(self.args.device),
+                    [example[2] for example in batch],
+                    [example[3] for example in batch],
+                    pad_id,
+                    self.tokenizer.cls_token_id,
+                    self.tokenizer.sep_token_id,
+                    output_prob=False,
+                    align_layer=self.args.align_layer,
+                )[self.args.align_layer]
+            for threshold, word_aligns in word_aligns_batch.items():
+                for i, aligns in zip(order[start : start + self.batch_size], word_aligns):
+                    # Placeholder pairs of empty sentences are aligned to -1
+                    word_aligns_all[threshold][i] = {pair for pair in aligns if pair[0] != -1}
+        return word_aligns_all
+
+    def align(self, sents_src, sents_tgt, softmax_threshold=None):
+        """Word alignments of every sentence pair for a single threshold (the first one by default)."""
+        if softmax_threshold is None:
+            softmax_threshold = self.softmax_thresholds[0]
+        return self.align_all(sents_src, sents_tgt)[softmax_threshold]
+
+    def align_files(self, src_path, tgt_path, output_dir, infer_filename, chunk_size=4096):
+        """Stream two parallel files through the aligner and return the number of aligned lines."""
+        from aligner.sent_aligner import alignment_filename, write_word_aligns
+        from train_utils import track_stage
+
+        os.makedirs(output_dir, exist_ok=True)
+        writers = {
+            threshold: open(
+                os.path.join(
+                    output_dir,
+                    alignment_filename(
+                        infer_filename, self.args.align_layer, threshold, self.softmax_thresholds
+                    ),
+                ),
+                "w",
+                encoding="utf-8",
+            )
+            for threshold in self.softmax_thresholds
+        }
+        num_lines = 0
+        try:
+            with track_stage("word_align", unit="sentence pairs") as stage, open(
+                src_path, encoding="utf-8"
+            ) as f_src, open(tgt_path, encoding="utf-8") as f_tgt:
+                chunk_src, chunk_tgt = [], []
+                for line_src, line_tgt in zip(f_src, f_tgt):
+                    chunk_src.append(line_src)
+                    chunk_tgt.append(line_tgt)
+                    if len(chunk_src) == chunk_size:
+                        for threshold, word_aligns in self.align_all(chunk_src, chunk_tgt).items():
+                            write_word_aligns(writers[threshold], word_aligns)
+                        num_lines += len(chunk_src)
+                        stage.add_items(len(chunk_src))
+                        chunk_src, chunk_tgt = [], []
+                if chunk_src:
+                    for threshold, word_aligns in self.align_all(chunk_src, chunk_tgt).items():
+                        write_word_aligns(writers[threshold], word_aligns)
+                    num_lines += len(chunk_src)
+                    stage.add_items(len(chunk_src))
+        finally:
+            for writer in writers.values():
+                writer.close()
+            if self.embedding_cache is not None:
+                self.embedding_cache.flush()
+        return num_lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract word alignments with LaBSE and an alignment adapter")
+    parser.add_argument("--data_file_src", required=True, type=str, help="Source sentences (whitespace-tokenized)")
+    parser.add_argument("--data_file_tgt", required=True, type=str, help="Target sentences (whitespace-tokenized)")
+    parser.add_argument("--output_dir", required=True, type=str, help="Where the alignment files are written.")
+    parser.add_argument("--infer_filename", default="infer.align", type=str, help="Prefix of the alignment files.")
+    parser.add_argument("--model_name_or_path", default="sentence-transformers/LaBSE", type=str)
+    parser.add_argument("--adapter_path", default=None, type=str)
+    parser.add_argument("--align_layer", type=int, default=6, help="layer for alignment extraction")
+    parser.add_argument("--softmax_thresholds", type=float, default=[0.1], nargs="+")
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--chunk_size", default=4096, type=int, help="Lines read and length-sorted at once")
+    parser.add_argument("--inference_dtype", default="fp32", choices=["fp32", "bf16", "int8"])
+    parser.add_argument("--embedding_cache_dir", default=None, type=str)
+    parser.add_argument("--no_early_exit", action="store_true", help="Run all encoder layers")
+    parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    start = time.time()
+    aligner = AccAligner(
+        model_name_or_path=args.model_name_or_path,
+        adapter_path=args.adapter_path,
+        align_layer=args.align_layer,
+        softmax_thresholds=args.softmax_thresholds,
+        batch_size=args.batch_size,
+        inference_dtype=args.inference_dtype,
+        embedding_cache_dir=args.embedding_cache_dir,
+        early_exit=not args.no_early_exit,
+        device="cpu" if args.no_cuda else None,
+    )
+    loaded = time.time()
+    logger.info("Loaded aligner in %.2fs", loaded - start)
+
+    num_lines = aligner.align_files(
+        args.data_file_src, args.data_file_tgt, args.output_dir, args.infer_filename, args.chunk_size
+    )
+    elapsed = time.time() - loaded
+    logger.info(
+        "Aligned %d sentence pairs in %.2fs (%.1f pairs/s)", num_lines, elapsed, num_lines / max(elapsed, 1e-9)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+# coding=utf-8
+"""Long-lived HTTP alignment service around AccAligner.
+
+The model is loaded once and kept warm. Concurrent requests are queued and merged into
+micro-batches: a batch is run as soon as it holds --max_batch_size sentence pairs or
+--max_wait_ms after its first request arrived. Endpoints:
+
+    POST /align   {"src": ["Das stimmt nicht !"], "tgt": ["That is not true !"], "softmax_threshold": 0.1}
+                  -> {"alignments": [[[0, 0], [1, 2], ...]]}
+    GET  /stats   request/pair/batch counts, p50/p99 latency and throughput
+    GET  /health
+
+"softmax_threshold" is optional and must be one of the --softmax_thresholds of the server.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from accalign_infer import AccAligner
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+def is_sentence_list(sents):
+    """Sentences are whitespace-tokenized strings or lists of words."""
+    return isinstance(sents, list) and all(
+        isinstance(sent, str) or (isinstance(sent, list) and all(isinstance(word, str) for word in sent))
+        for sent in sents
+    )
+
+
+class AlignRequest(object):
+    def __init__(self, sents_src, sents_tgt, softmax_threshold):
+        self.sents_src = sents_src
+        self.sents_tgt = sents_tgt
+        self.softmax_threshold = softmax_threshold
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """Runs the aligner on a single worker thread, merging queued requests into batches."""
+
+    def __init__(self, aligner, max_batch_size=64, max_wait_ms=5.0, stats_window=10000):
+        self.aligner = aligner
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=stats_window)
+        self.num_requests = self.num_pairs = self.num_batches = 0
+        self.busy_time = 0.0
+        self.start_time = time.time()
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, sents_src, sents_tgt, softmax_threshold=None):
+        request = AlignRequest(sents_src, sents_tgt, softmax_threshold)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self):
+        while True:
+            requests = [self.queue.get()]
+            num_pairs = len(requests[0].sents_src)
+            deadline = requests[0].arrival + self.max_wait
+            while num_pairs < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                requests.append(request)
+                num_pairs += len(request.sents_src)
+            self._process(requests)
+
+    def _process(self, requests):
+        start = time.perf_counter()
+        # Tokenize every request on its own, so that a bad request does not fail the others of the batch
+        examples, tokenized = [], []
+        for request in requests:
+            try:
+                examples += [
+                    self.aligner.tokenize(sent_src, sent_tgt)
+                    for sent_src, sent_tgt in zip(request.sents_src, request.sents_tgt)
+                ]
+            except Exception as e:
+                logger.exception("Tokenization of a request with %d sentence pairs failed", len(request.sents_src))
+                request.error = e
+                request.done.set()
+                continue
+            tokenized.append(request)
+        requests = tokenized
+        if not requests:
+            return
+        try:
+            word_aligns_all = self.aligner.align_examples(examples)
+        except Exception as e:
+            logger.exception("Alignment of a batch with %d sentence pairs failed", len(examples))
+            for request in requests:
+                request.error = e
+                request.done.set()
+            return
+
+        offset = 0
+        for request in requests:
+            threshold = request.softmax_threshold
+            if threshold is None:
+                threshold = self.aligner.softmax_thresholds[0]
+            request.result = word_aligns_all[threshold][offset : offset + len(request.sents_src)]
+            offset += len(request.sents_src)
+            request.done.set()
+
+        end = time.perf_counter()
+        with self.lock:
+            self.latencies.extend(end - request.arrival for request in requests)
+            self.num_requests += len(requests)
+            self.num_pairs += len(examples)
+            self.num_batches += 1
+            self.busy_time += end - start
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            uptime = time.time() - self.start_time
+            return {
+                "requests": self.num_requests,
+                "pairs": self.num_pairs,
+                "batches": self.num_batches,
+                "mean_batch_pairs": self.num_pairs / max(self.num_batches, 1),
+                "p50_latency_ms": percentile(latencies, 50) * 1000.0,
+                "p99_latency_ms": percentile(latencies, 99) * 1000.0,
+                "throughput_pairs_per_s": self.num_pairs / max(uptime, 1e-9),
+                "busy_pairs_per_s": self.num_pairs / max(self.busy_time, 1e-9),
+                "uptime_s": uptime,
+            }
+
+
+class AlignHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.batcher.stats())
+        elif self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/align":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            sents_src, sents_tgt = payload["src"], payload["tgt"]
+            softmax_threshold = payload.get("softmax_threshold")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"Expected a JSON object with 'src' and 'tgt': {e}"})
+            return
+        if not is_sentence_list(sents_src) or not is_sentence_list(sents_tgt):
+            self._send_json(400, {"error": "'src' and 'tgt' must be lists of strings or of lists of strings"})
+            return
+        if len(sents_src) != len(sents_tgt):
+            self._send_json(400, {"error": "'src' and 'tgt' must have the same number of sentences"})
+            return
+        if softmax_threshold is not None and softmax_threshold not in self.batcher.aligner.softmax_thresholds:
+            self._send_json(
+                400,
+                {"error": f"softmax_threshold must be one of {self.batcher.aligner.softmax_thresholds}"},
+            )
+            return
+
+        try:
+            word_aligns = self.batcher.submit(sents_src, sents_tgt, softmax_threshold) if sents_src else []
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"alignments": [sorted(aligns) for aligns in word_aligns]})
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve word alignments over HTTP with a warm model")
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8686, type=int)
+    parser.add_argument("--model_name_or_path", default="sentence-transformers/LaBSE", type=str)
+    parser.add_argument("--adapter_path", default=None, type=str)
+    parser.add_argument("--align_layer", type=int, default=6, help="layer for alignment extraction")
+    parser.add_argument("--softmax_thresholds", type=float, default=[0.1], nargs="+")
+    parser.add_argument("--inference_dtype", default="fp32", choices=["fp32", "bf16", "int8"])
+    parser.add_argument("--max_batch_size", default=64, type=int, help="Sentence pairs per micro-batch")
+    parser.add_argument("--max_wait_ms", default=5.0, type=float, help="Maximum time a request waits for a batch")
+    parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    start = time.time()
+    aligner = AccAligner(
+        model_name_or_path=args.model_name_or_path,
+        adapter_path=args.adapter_path,
+        align_layer=args.align_layer,
+        softmax_thresholds=args.softmax_thresholds,
+        batch_size=args.max_batch_size,
+        inference_dtype=args.inference_dtype,
+        device="cpu" if args.no_cuda else None,
+    )
+    # Warm-up so that the first request does not pay for lazy initialization
+    aligner.align(["warm up"], ["warm up"])
+    logger.info("Loaded aligner in %.2fs", time.time() - start)
+
+    AlignHandler.batcher = MicroBatcher(aligner, args.max_batch_size, args.max_wait_ms)
+    server = ThreadingHTTPServer((args.host, args.port), AlignHandler)
+    logger.info("Serving alignments on http://%s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("Final stats: %s", json.dumps(AlignHandler.batcher.stats()))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ import argparse
 import itertools
 from collections import Counter
 
+import numpy as np
+
 
 PUNCTUATION_MARKS = {".", ",", "!", "?", ";", ":", "(", ")"}
 
@@ -141,6 +143,48 @@ def calculate_metrics(array_sure, array_possible, array_hypothesis, f_alpha, sou
     return precision, recall, aer, f_measure, errors, source_coverage, target_coverage, internal_jumps, external_jumps
 
 
+# Word indices of a link must be below KEY_BASE, which leaves 2 ** 31 sentences per corpus
+KEY_BASE = 1 << 16
+
+
+def encode_links(alignments):
+    """ Links of a corpus as sorted int64 keys (sentence * KEY_BASE + src) * KEY_BASE + tgt
+    >>> encode_links([{(0, 1)}, set(), {(2, 2)}]).tolist()
+    [1, 8590065666]
+    """
+    num_links = sum(len(A) for A in alignments)
+    links = np.fromiter(
+        (x for i, A in enumerate(alignments) for s, t in A for x in (i, s, t)), dtype=np.int64, count=3 * num_links
+    ).reshape(num_links, 3)
+    if num_links > 0 and (links[:, 1:].min() < 0 or links[:, 1:].max() >= KEY_BASE):
+        raise ValueError("Alignment indices must be in [0, {0})".format(KEY_BASE))
+    # Links are unique within a sentence and sentences do not share keys, so sorting is enough
+    return np.sort((links[:, 0] * KEY_BASE + links[:, 1]) * KEY_BASE + links[:, 2])
+
+
+def calculate_aer(sure, possible, hypothesis):
+    """ Precision, recall and alignment error rate of a corpus, same values as calculate_metrics
+        Every argument is a list of link sets or its encode_links keys; the intersections over the whole
+        corpus are single np.intersect1d calls on the sorted keys; arguments given as lists must have
+        the same number of sentences
+    >>> calculate_aer([{(0, 0)}], [{(0, 0), (1, 1)}], [{(0, 0), (1, 1), (2, 2)}])
+    (0.6666666666666666, 1.0, 0.25)
+    """
+    number_of_sentences = {len(A) for A in (sure, possible, hypothesis) if not isinstance(A, np.ndarray)}
+    assert len(number_of_sentences) <= 1, "Number of sentences does not match"
+    sure, possible, hypothesis = [A if isinstance(A, np.ndarray) else encode_links(A) for A in (sure, possible, hypothesis)]
+
+    sum_a_intersect_p = len(np.intersect1d(hypothesis, possible, assume_unique=True))
+    sum_a_intersect_s = len(np.intersect1d(hypothesis, sure, assume_unique=True))
+    sum_a, sum_s = len(hypothesis), len(sure)
+
+    # Unlike calculate_metrics, an empty hypothesis or reference does not raise
+    precision = sum_a_intersect_p / sum_a if sum_a else 0.0
+    recall = sum_a_intersect_s / sum_s if sum_s else 0.0
+    aer = 1.0 - ((sum_a_intersect_p + sum_a_intersect_s) / (sum_a + sum_s)) if sum_a + sum_s else 1.0
+    return precision, recall, aer
+
+
 def parse_single_alignment(string, reverse=False, one_indexed=False):
     assert ('-' in string or 'p' in string) and 'Bad Alignment separator'
 
@@ -164,20 +208,9 @@ def read_text(path):
         return [l.split() for l in f]
 
 
-if __name__ == "__main__":
-    args = parse_args()
-    sure, possible, hypothesis = [], [], []
-
-    source, target = map(read_text, [args.source, args.target])
-
-    assert len(source) == len(target), "Length of source and target does not match"
-    assert (not args.cleanPunctuation) or len(source) > 0, "To clean punctuation alignments, specify a source and target text file"
-    # print('$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$')
-    # print(args.reverseRef) #False
-    # print(args.oneRef) #True
-    # print(args.cleanPunctuation) #False
-    # print(args.allSure)#False
-    with open(args.reference, 'r') as f:
+def read_reference(path, reverse=False, one_indexed=False, all_sure=False, ignore_possible=False):
+    sure, possible = [], []
+    with open(path, 'r') as f:
         for line in f:
             sure.append(set())
             possible.append(set())
@@ -185,21 +218,48 @@ if __name__ == "__main__":
             for alignment_string in line.split():
 
                 sure_alignment = True if '-' in alignment_string else False
-                alignment_tuple = parse_single_alignment(alignment_string, args.reverseRef, args.oneRef)
+                alignment_tuple = parse_single_alignment(alignment_string, reverse, one_indexed)
 
-                if sure_alignment or args.allSure:
+                if sure_alignment or all_sure:
                     sure[-1].add(alignment_tuple)
-                if sure_alignment or not args.ignorePossible:
+                if sure_alignment or not ignore_possible:
                     possible[-1].add(alignment_tuple)
-    with open(args.hypothesis, 'r') as f:
+    return sure, possible
+
+
+def read_hypothesis(path, reverse=False, one_indexed=False):
+    hypothesis = []
+    with open(path, 'r') as f:
         for line in f:
             hypothesis.append(set())
 
             for alignment_string in line.split():
-                alignment_tuple = parse_single_alignment(alignment_string, args.reverseHyp, args.oneHyp)
+                alignment_tuple = parse_single_alignment(alignment_string, reverse, one_indexed)
                 hypothesis[-1].add(alignment_tuple)
+    return hypothesis
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    source, target = map(read_text, [args.source, args.target])
 
-    precision, recall, aer, f_measure, errors, source_coverage, target_coverage, internal_jumps, external_jumps = calculate_metrics(sure, possible, hypothesis, args.fAlpha, source, target, args.cleanPunctuation)
+    assert len(source) == len(target), "Length of source and target does not match"
+    assert (not args.cleanPunctuation) or len(source) > 0, "To clean punctuation alignments, specify a source and target text file"
+    # print('$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$')
+    # print(args.reverseRef) #False
+    # print(args.oneRef) #True
+    # print(args.cleanPunctuation) #False
+    # print(args.allSure)#False
+    sure, possible = read_reference(args.reference, args.reverseRef, args.oneRef, args.allSure, args.ignorePossible)
+    hypothesis = read_hypothesis(args.hypothesis, args.reverseHyp, args.oneHyp)
+
+    if args.source or args.cleanPunctuation:
+        precision, recall, aer, f_measure, errors, source_coverage, target_coverage, internal_jumps, external_jumps = calculate_metrics(sure, possible, hypothesis, args.fAlpha, source, target, args.cleanPunctuation)
+    else:
+        # Only AER, precision and recall are reported, skip the error analysis
+        precision, recall, aer = calculate_aer(sure, possible, hypothesis)
+        f_measure = 1.0 / (args.fAlpha / precision + (1.0 - args.fAlpha) / recall) if args.fAlpha >= 0.0 else 0.0
     print("{0}: {1:.1f}% ({2:.1f}%/{3:.1f}%/{4})".format(args.hypothesis,
                 aer * 100.0, precision * 100.0, recall * 100.0, sum([len(x) for x in hypothesis])))
     #print("=======aer========",aer * 100.0)
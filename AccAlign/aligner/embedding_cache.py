@@ -0,0 +1,134 @@
+# coding=utf-8
+
+import os
+import json
+import hashlib
+
+import numpy as np
+from train_utils import get_logger
+
+LOG = get_logger(__name__)
+
+DATA_FILENAME = "embeddings.bin"
+INDEX_FILENAME = "index.tsv"
+META_FILENAME = "meta.json"
+
+
+def checkpoint_fingerprint(
+    model_name_or_path, adapter_path=None, align_layer=6, inference_dtype="fp32"
+):
+    """Hash of everything that changes the hidden states: model, adapter weights, layer and dtype."""
+    key = f"{model_name_or_path}|{align_layer}"
+    if inference_dtype != "fp32":
+        key = f"{key}|{inference_dtype}"
+    fingerprint = hashlib.sha1(key.encode("utf-8"))
+    if adapter_path:
+        for root, dirs, files in os.walk(adapter_path):
+            dirs.sort()
+            for name in sorted(files):
+                fingerprint.update(name.encode("utf-8"))
+                with open(os.path.join(root, name), "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        fingerprint.update(chunk)
+    return fingerprint.hexdigest()[:16]
+
+
+class EmbeddingCache(object):
+    """On-disk cache of per-sentence hidden states at the alignment layer.
+
+    Every sentence is stored once as a (num_subwords, hidden_size) block in an append-only
+    binary file that is memory-mapped for reading. Blocks are keyed by the hash of the
+    sentence's token ids (incl. special tokens), and every checkpoint fingerprint gets its
+    own sub-directory. The cache is not safe for concurrent writers.
+    """
+
+    def __init__(self, cache_dir, fingerprint, dtype="float32", max_pending=4096):
+        self.cache_dir = os.path.join(cache_dir, fingerprint)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.data_path = os.path.join(self.cache_dir, DATA_FILENAME)
+        self.index_path = os.path.join(self.cache_dir, INDEX_FILENAME)
+        self.meta_path = os.path.join(self.cache_dir, META_FILENAME)
+        self.max_pending = max_pending
+
+        self.dtype = np.dtype(dtype)
+        self.hidden_size = None
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dtype = np.dtype(meta["dtype"])
+            self.hidden_size = meta["hidden_size"]
+
+        # key -> (first row, number of rows)
+        self.index = {}
+        self.num_rows = 0
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                for line in f:
+                    key, offset, length = line.split("\t")
+                    self.index[key] = (int(offset), int(length))
+                    self.num_rows = max(self.num_rows, int(offset) + int(length))
+
+        self.pending = {}
+        self.mmap = None
+        self.hits = self.misses = 0
+        LOG.info(
+            "Loaded embedding cache at %s with %d sentences",
+            self.cache_dir,
+            len(self.index),
+        )
+
+    @staticmethod
+    def key(ids):
+        return hashlib.sha1(np.asarray(ids, dtype=np.int64).tobytes()).hexdigest()
+
+    def _load_mmap(self):
+        if self.mmap is None or self.mmap.shape[0] < self.num_rows:
+            self.mmap = np.memmap(
+                self.data_path,
+                dtype=self.dtype,
+                mode="r",
+                shape=(self.num_rows, self.hidden_size),
+            )
+        return self.mmap
+
+    def get(self, key):
+        if key in self.pending:
+            self.hits += 1
+            return self.pending[key]
+        if key not in self.index:
+            self.misses += 1
+            return None
+        self.hits += 1
+        offset, length = self.index[key]
+        return self._load_mmap()[offset : offset + length]
+
+    def put(self, key, hidden_states):
+        if key in self.index or key in self.pending:
+            return
+        if self.hidden_size is None:
+            self.hidden_size = hidden_states.shape[-1]
+        self.pending[key] = np.ascontiguousarray(hidden_states, dtype=self.dtype)
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if not os.path.isfile(self.meta_path):
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump({"dtype": self.dtype.name, "hidden_size": self.hidden_size}, f)
+        with open(self.data_path, "ab") as f_data, open(
+            self.index_path, "a", encoding="utf-8"
+        ) as f_index:
+            for key, hidden_states in self.pending.items():
+                f_data.write(hidden_states.tobytes())
+                f_index.write(f"{key}\t{self.num_rows}\t{hidden_states.shape[0]}\n")
+                self.index[key] = (self.num_rows, hidden_states.shape[0])
+                self.num_rows += hidden_states.shape[0]
+        self.pending = {}
+        LOG.info(
+            "Embedding cache: %d sentences stored, %d hits, %d misses",
+            len(self.index),
+            self.hits,
+            self.misses,
+        )
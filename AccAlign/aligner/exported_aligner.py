@@ -0,0 +1,174 @@
+# coding=utf-8
+"""Lean runtime for aligners exported with export_aligner.py.
+
+Only depends on numpy, tokenizers and either onnxruntime (ONNX) or torch (TorchScript),
+so it starts without the transformers/adapters import graph of the training script.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+CONFIG_NAME = "aligner_config.json"
+# Position embeddings of LaBSE, tokenize_sentence_pair truncates to the same length
+MAX_LENGTH = 512
+
+
+def softmax(x, axis):
+    x = x - x.max(axis=axis, keepdims=True)
+    np.exp(x, out=x)
+    return x / x.sum(axis=axis, keepdims=True)
+
+
+class ExportedAligner(object):
+    def __init__(self, export_dir, num_threads=None):
+        with open(os.path.join(export_dir, CONFIG_NAME), encoding="utf-8") as f:
+            self.config = json.load(f)
+        self.align_layer = self.config["align_layer"]
+        self.softmax_threshold = self.config["softmax_threshold"]
+        self.pad_token_id = self.config["pad_token_id"]
+        self.cls_token_id = self.config["cls_token_id"]
+        self.sep_token_id = self.config["sep_token_id"]
+
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(export_dir, "tokenizer.json"))
+
+        model_file = os.path.join(export_dir, self.config["model_file"])
+        if self.config["format"] == "onnx":
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError(
+                    "Please install onnxruntime to run aligners exported to ONNX."
+                )
+            options = onnxruntime.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(
+                model_file, options, providers=["CPUExecutionProvider"]
+            )
+        else:
+            import torch
+
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            self.module = torch.jit.load(model_file, map_location="cpu")
+
+    def tokenize(self, sent):
+        # Same as LineByLineTextDataset.process_line: every word is tokenized on its own
+        if len(sent) == 0:
+            return [self.cls_token_id, self.sep_token_id], []
+        encodings = self.tokenizer.encode_batch(sent, add_special_tokens=False)
+        ids, bpe2word_map = [self.cls_token_id], []
+        for i, encoding in enumerate(encodings):
+            ids += encoding.ids
+            bpe2word_map += [i] * len(encoding.ids)
+        # Keep room for [CLS] and [SEP]
+        ids = ids[: MAX_LENGTH - 1]
+        ids.append(self.sep_token_id)
+        return ids, bpe2word_map[: MAX_LENGTH - 2]
+
+    def encode(self, ids_list):
+        """Hidden states at align_layer for every sentence (without padding)."""
+        lengths = [len(ids) for ids in ids_list]
+        input_ids = np.full((len(ids_list), max(lengths)), self.pad_token_id, dtype=np.int64)
+        for i, ids in enumerate(ids_list):
+            input_ids[i, : len(ids)] = ids
+        attention_mask = (input_ids != self.pad_token_id).astype(np.int64)
+
+        if self.config["format"] == "onnx":
+            hidden_states = self.session.run(
+                None, {"input_ids": input_ids, "attention_mask": attention_mask}
+            )[0]
+        else:
+            import torch
+
+            with torch.no_grad():
+                hidden_states = self.module(
+                    torch.from_numpy(input_ids), torch.from_numpy(attention_mask)
+                ).float().numpy()
+        return [hidden_states[i, :length] for i, length in enumerate(lengths)]
+
+    def extract(self, hidden_states_src, hidden_states_tgt, b2w_src, b2w_tgt, softmax_threshold):
+        # [CLS] and [SEP] are masked out in SentenceAligner_word, so the softmax only runs over the subwords
+        scores = np.matmul(
+            hidden_states_src[1:-1].astype(np.float32), hidden_states_tgt[1:-1].astype(np.float32).T
+        )
+        attention_probs_src = softmax(scores.copy(), axis=-1)
+        attention_probs_tgt = softmax(scores, axis=-2)
+        align_matrix = (attention_probs_src > softmax_threshold) * (
+            attention_probs_tgt > softmax_threshold
+        )
+        return {(b2w_src[i], b2w_tgt[j]) for i, j in zip(*np.nonzero(align_matrix))}
+
+    def get_aligned_word(self, sents_src, sents_tgt, softmax_threshold=None):
+        """Word alignments (sets of (src_word, tgt_word) pairs) for a batch of whitespace-tokenized sentences."""
+        softmax_threshold = self.softmax_threshold if softmax_threshold is None else softmax_threshold
+        tokenized_src = [self.tokenize(sent) for sent in sents_src]
+        tokenized_tgt = [self.tokenize(sent) for sent in sents_tgt]
+        hidden_states_src = self.encode([ids for ids, _ in tokenized_src])
+        hidden_states_tgt = self.encode([ids for ids, _ in tokenized_tgt])
+
+        word_aligns = []
+        for states_src, states_tgt, (_, b2w_src), (_, b2w_tgt) in zip(
+            hidden_states_src, hidden_states_tgt, tokenized_src, tokenized_tgt
+        ):
+            if not b2w_src or not b2w_tgt:
+                word_aligns.append(set())
+                continue
+            word_aligns.append(
+                self.extract(states_src, states_tgt, b2w_src, b2w_tgt, softmax_threshold)
+            )
+        return word_aligns
+
+    def align_files(self, src_path, tgt_path, out_path, batch_size=32, softmax_threshold=None):
+        """Write alignments in the same format as word_align (<src>-<tgt> pairs per line)."""
+        with open(src_path, encoding="utf-8") as f_src, open(tgt_path, encoding="utf-8") as f_tgt, open(
+            out_path, "w", encoding="utf-8"
+        ) as writer:
+            batch_src, batch_tgt = [], []
+            for line_src, line_tgt in zip(f_src, f_tgt):
+                batch_src.append(line_src.strip().split())
+                batch_tgt.append(line_tgt.strip().split())
+                if len(batch_src) == batch_size:
+                    self._write(writer, self.get_aligned_word(batch_src, batch_tgt, softmax_threshold))
+                    batch_src, batch_tgt = [], []
+            if batch_src:
+                self._write(writer, self.get_aligned_word(batch_src, batch_tgt, softmax_threshold))
+
+    @staticmethod
+    def _write(writer, word_aligns):
+        for aligns in word_aligns:
+            writer.write(" ".join(f"{src}-{tgt}" for src, tgt in aligns) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract word alignments with an exported aligner")
+    parser.add_argument("export_dir", help="Directory written by export_aligner.py")
+    parser.add_argument("data_file_src", help="Source sentences (whitespace-tokenized)")
+    parser.add_argument("data_file_tgt", help="Target sentences (whitespace-tokenized)")
+    parser.add_argument("output_file", help="Output alignment file")
+    parser.add_argument("--softmax_threshold", type=float, default=None)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    args = parser.parse_args()
+
+    start = time.time()
+    aligner = ExportedAligner(args.export_dir, num_threads=args.num_threads)
+    loaded = time.time()
+    aligner.align_files(
+        args.data_file_src,
+        args.data_file_tgt,
+        args.output_file,
+        batch_size=args.batch_size,
+        softmax_threshold=args.softmax_threshold,
+    )
+    print(f"Loaded in {loaded - start:.2f}s, aligned in {time.time() - loaded:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
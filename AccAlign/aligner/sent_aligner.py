@@ -28,9 +28,80 @@ from torch.utils.data import DataLoader, IterableDataset
 
 from transformers import AutoTokenizer, AutoConfig, AutoModel
 from aligner.word_align import SentenceAligner_word
+from train_utils import timed_stage, current_stage
 from tqdm import tqdm
 
 
+def tokenize_sentence_pair(tokenizer, line_src, line_tgt):
+    """Subword ids and subword-to-word maps of a whitespace-tokenized sentence pair."""
+    if len(line_src) == 0 or len(line_tgt) == 0:
+        return None
+
+    sent_src, sent_tgt = line_src.strip().split(), line_tgt.strip().split()
+    token_src, token_tgt = [tokenizer.tokenize(word) for word in sent_src], [
+        tokenizer.tokenize(word) for word in sent_tgt
+    ]
+    wid_src, wid_tgt = [tokenizer.convert_tokens_to_ids(x) for x in token_src], [
+        tokenizer.convert_tokens_to_ids(x) for x in token_tgt
+    ]
+
+    ids_src, ids_tgt = (
+        tokenizer.prepare_for_model(
+            list(itertools.chain(*wid_src)), return_tensors="pt", max_length=512
+        )["input_ids"],
+        tokenizer.prepare_for_model(
+            list(itertools.chain(*wid_tgt)), return_tensors="pt", max_length=512
+        )["input_ids"],
+    )
+
+    bpe2word_map_src = []
+    for i, word_list in enumerate(token_src):
+        bpe2word_map_src += [i for x in word_list]
+    bpe2word_map_tgt = []
+    for i, word_list in enumerate(token_tgt):
+        bpe2word_map_tgt += [i for x in word_list]
+    return (
+        ids_src,
+        ids_tgt,
+        bpe2word_map_src,
+        bpe2word_map_tgt,
+        sent_src,
+        sent_tgt,
+    )
+
+
+def empty_sentence_pair(tokenizer):
+    # Placeholder for lines that cannot be aligned, keeps the output aligned with the input lines
+    empty_tensor = torch.tensor(
+        [tokenizer.cls_token_id, 999, tokenizer.sep_token_id]
+    )
+    empty_sent = ""
+    return (
+        empty_tensor,
+        empty_tensor,
+        [-1],
+        [-1],
+        empty_sent,
+        empty_sent,
+    )
+
+
+def alignment_filename(infer_filename, layer_id, threshold, thresholds):
+    # Keep the plain <infer_filename>.<layer> name when only a single threshold is extracted
+    if len(thresholds) == 1:
+        return f"{infer_filename}.{str(layer_id)}"
+    return f"{infer_filename}.thr{threshold:g}.{str(layer_id)}"
+
+
+def write_word_aligns(writers, word_aligns_list):
+    for word_aligns in word_aligns_list:
+        output_str = []
+        for word_align in word_aligns:
+            if word_align[0] != -1:
+                output_str.append(f"{word_align[0]}-{word_align[1]}")
+        writers.write(" ".join(output_str) + "\n")
+
+
 class LineByLineTextDataset(IterableDataset):
     def __init__(self, tokenizer, file_path_src, file_path_tgt, offsets=None):
         assert os.path.isfile(file_path_src)
@@ -47,40 +118,7 @@ class LineByLineTextDataset(IterableDataset):
         if len(line) == 0 or line.isspace() or not len(line.split(' ||| ')) == 2:
             return None
         """
-        if len(line_src) == 0 or len(line_tgt) == 0:
-            return None
-
-        sent_src, sent_tgt = line_src.strip().split(), line_tgt.strip().split()
-        token_src, token_tgt = [self.tokenizer.tokenize(word) for word in sent_src], [
-            self.tokenizer.tokenize(word) for word in sent_tgt
-        ]
-        wid_src, wid_tgt = [
-            self.tokenizer.convert_tokens_to_ids(x) for x in token_src
-        ], [self.tokenizer.convert_tokens_to_ids(x) for x in token_tgt]
-
-        ids_src, ids_tgt = (
-            self.tokenizer.prepare_for_model(
-                list(itertools.chain(*wid_src)), return_tensors="pt", max_length=512
-            )["input_ids"],
-            self.tokenizer.prepare_for_model(
-                list(itertools.chain(*wid_tgt)), return_tensors="pt", max_length=512
-            )["input_ids"],
-        )
-
-        bpe2word_map_src = []
-        for i, word_list in enumerate(token_src):
-            bpe2word_map_src += [i for x in word_list]
-        bpe2word_map_tgt = []
-        for i, word_list in enumerate(token_tgt):
-            bpe2word_map_tgt += [i for x in word_list]
-        return (
-            ids_src,
-            ids_tgt,
-            bpe2word_map_src,
-            bpe2word_map_tgt,
-            sent_src,
-            sent_tgt,
-        )
+        return tokenize_sentence_pair(self.tokenizer, line_src, line_tgt)
 
     def __iter__(self):
 
@@ -96,22 +134,12 @@ class LineByLineTextDataset(IterableDataset):
                     print(
                         f'Line "{line_src.strip()}" (offset in bytes: {f_src.tell()}) is not in the correct format. Skipping...'
                     )
-                    empty_tensor = torch.tensor(
-                        [self.tokenizer.cls_token_id, 999, self.tokenizer.sep_token_id]
-                    )
-                    empty_sent = ""
-                    yield (
-                        empty_tensor,
-                        empty_tensor,
-                        [-1],
-                        [-1],
-                        empty_sent,
-                        empty_sent,
-                    )
+                    yield empty_sentence_pair(self.tokenizer)
                 else:
                     yield processed
 
 
+@timed_stage("word_align", unit="sentence pairs")
 def word_align(
     args,
     tokenizer,
@@ -122,6 +150,7 @@ def word_align(
     device,
     infer_filename,
     align_layer=-1,
+    embedding_cache=None,
 ):
 
     def collate(examples):
@@ -151,7 +180,7 @@ def word_align(
     )
 
     tqdm_iterator = trange(0, desc="Extracting")
-    model_sentence = SentenceAligner_word(args, model)
+    model_sentence = SentenceAligner_word(args, model, embedding_cache=embedding_cache)
 
     word_aligns_list_all_layer_dic = {}
     model.eval()
@@ -166,6 +195,7 @@ def word_align(
                 sents_tgt,
             ) = batch
 
+            current_stage().add_items(len(sents_src))
             ids_src, ids_tgt = ids_src.to(device), ids_tgt.to(device)
             word_aligns_list_all_layer_dic_one_batch = model_sentence.get_aligned_word(
                 args,
@@ -181,93 +211,24 @@ def word_align(
             )
 
             for layer_id in word_aligns_list_all_layer_dic_one_batch:
-
-                if layer_id not in word_aligns_list_all_layer_dic:
-                    word_aligns_list_all_layer_dic[layer_id] = (
-                        word_aligns_list_all_layer_dic_one_batch[layer_id]
-                    )
-                else:
-                    word_aligns_list_all_layer_dic[layer_id] = (
-                        word_aligns_list_all_layer_dic[layer_id]
-                        + word_aligns_list_all_layer_dic_one_batch[layer_id]
-                    )
-
-    for layer_id in word_aligns_list_all_layer_dic:
+                for threshold, word_aligns in word_aligns_list_all_layer_dic_one_batch[
+                    layer_id
+                ].items():
+                    word_aligns_list_all_layer_dic.setdefault(
+                        (layer_id, threshold), []
+                    ).extend(word_aligns)
+
+    if embedding_cache is not None:
+        embedding_cache.flush()
+
+    thresholds = model_sentence.softmax_thresholds
+    for layer_id, threshold in word_aligns_list_all_layer_dic:
+        out_filename = alignment_filename(infer_filename, layer_id, threshold, thresholds)
         with open(
-            os.path.join(folder_path, f"{infer_filename}.{str(layer_id)}"),
+            os.path.join(folder_path, out_filename),
             "w",
             encoding="utf-8",
         ) as writers:
-            for word_aligns in word_aligns_list_all_layer_dic[layer_id]:
-                output_str = []
-                for word_align in word_aligns:
-                    if word_align[0] != -1:
-                        output_str.append(f"{word_align[0]}-{word_align[1]}")
-                writers.write(" ".join(output_str) + "\n")
-
-
-# def main():
-#     parser = argparse.ArgumentParser()
-#
-#     # Required parameters
-#     parser.add_argument(
-#         "--data_file_src", default="/nfsshare/home/wangweikang/en2ces_101/output/en2Ces.src", type=str,
-#         help="The input data file (a text file)."
-#     )
-#     parser.add_argument(
-#         "--data_file_tgt", default="/nfsshare/home/wangweikang/en2ces_101/output/en2Ces.tgt", type=str,
-#         help="The input data file (a text file)."
-#     )
-#     parser.add_argument(
-#         "--output_file",
-#         default='/nfsshare/home/wangweikang/my_alignment/valid_output/full/800',
-#         type=str,
-#         help="The output file."
-#     )
-#     parser.add_argument("--align_layer", type=int, default=6, help="layer for alignment extraction")
-#     parser.add_argument(
-#         "--extraction", default='softmax', type=str, help='softmax or others'
-#     )
-#     parser.add_argument(
-#         "--softmax_threshold", type=float, default=0.1
-#     )
-#     parser.add_argument(
-#         "--output_prob_file", default=None, type=str, help='The output probability file.'
-#     )
-#     parser.add_argument(
-#         "--output_word_file", default=None, type=str, help='The output word file.'
-#     )
-#     parser.add_argument(
-#         "--model_name_or_path",
-#         default="/nfsshare/home/wangweikang/my_alignment/ckpt_output/full_fune/checkpoint-800",
-#         type=str,
-#         help="The model checkpoint for weights initialization. Leave None if you want to train a model from scratch.",
-#     )
-#     parser.add_argument(
-#         "--adapter_path",
-#         default="/nfsshare/home/wangweikang/my_alignment/ckpt_output/full_fune/checkpoint-800",
-#         type=str,
-#         help="The model checkpoint for weights initialization. Leave None if you want to train a model from scratch.",
-#     )
-#     parser.add_argument("--batch_size", default=32, type=int)
-#
-#     parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
-#     parser.add_argument("--num_workers", type=int, default=1, help="Number of workers for data loading")
-#     parser.add_argument("--tokenizer_name_or_path", type=str, default="xlm-roberta-base")
-#     args = parser.parse_args()
-#     device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-#     args.device = device
-#
-#
-#     tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
-#     model = AutoModel.from_pretrained(args.model_name_or_path)
-#     if args.adapter_path:
-#         model.load_adapter(args.adapter_path)
-#         model.set_active_adapters('alignment_adapter')
-#
-#
-#     word_align(args, tokenizer, model, args.output_file, args.data_file_src, args.data_file_tgt)
-#
-#
-# if __name__ == "__main__":
-#     main()
+            write_word_aligns(
+                writers, word_aligns_list_all_layer_dic[(layer_id, threshold)]
+            )
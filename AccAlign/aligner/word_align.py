@@ -20,6 +20,7 @@ from transformers import (
     AutoTokenizer,
 )
 import torch.nn as nn
+from torch.nn.utils.rnn import pad_sequence
 from train_utils import get_logger
 
 LOG = get_logger(__name__)
@@ -38,10 +39,15 @@ def return_extended_attention_mask(attention_mask, dtype):
 
 
 class SentenceAligner_word(object):
-    def __init__(self, args, model):
+    def __init__(self, args, model, embedding_cache=None):
 
         self.guide = None
+        self.embedding_cache = embedding_cache
         self.softmax_threshold = args.softmax_threshold
+        # Several thresholds can be extracted from the same forward pass and softmax
+        self.softmax_thresholds = list(
+            dict.fromkeys(getattr(args, "softmax_thresholds", None) or [args.softmax_threshold])
+        )
         self.embed_loader = model
 
     def transpose_for_scores(self, x):
@@ -49,6 +55,40 @@ class SentenceAligner_word(object):
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
+    def get_hidden_states_cached(self, args, inputs, PAD_ID, align_layer):
+        # Look up the hidden states of every sentence in the cache and only encode the misses
+        lengths = (inputs != PAD_ID).sum(-1).tolist()
+        ids_list = [row[:length] for row, length in zip(inputs.cpu(), lengths)]
+        keys = [self.embedding_cache.key(ids.numpy()) for ids in ids_list]
+        hidden_states_list = [self.embedding_cache.get(key) for key in keys]
+
+        misses = [i for i, states in enumerate(hidden_states_list) if states is None]
+        if misses:
+            inputs_miss = pad_sequence(
+                [ids_list[i] for i in misses], batch_first=True, padding_value=PAD_ID
+            ).to(inputs.device)
+            hidden_states_miss = self.embed_loader.encode(
+                inputs_miss,
+                attention_mask=(inputs_miss != PAD_ID).long(),
+                align_layer=align_layer,
+                early_exit=getattr(args, "early_exit", False),
+            )
+            for row, i in enumerate(misses):
+                states = hidden_states_miss[row, : lengths[i]].float().cpu().numpy()
+                self.embedding_cache.put(keys[i], states)
+                hidden_states_list[i] = states
+
+        # Padding positions are masked out before the softmax, zeros are fine
+        hidden_states = torch.zeros(
+            inputs.size(0),
+            inputs.size(1),
+            hidden_states_list[0].shape[-1],
+            device=inputs.device,
+        )
+        for i, states in enumerate(hidden_states_list):
+            hidden_states[i, : lengths[i]] = torch.from_numpy(np.array(states))
+        return hidden_states
+
     def get_subword_matrix(
         self,
         args,
@@ -62,17 +102,31 @@ class SentenceAligner_word(object):
     ):
         # print(inputs_src)
 
-        output_src, output_tgt = self.embed_loader(
-            inputs_src=inputs_src,
-            inputs_tgt=inputs_tgt,
-            attention_mask_src=(inputs_src != PAD_ID).long(),
-            attention_mask_tgt=(inputs_tgt != PAD_ID).long(),
-            guide=None,
-            align_layer=args.align_layer,
-            extraction=args.extraction,
-            softmax_threshold=args.softmax_threshold,
-            do_infer=True,
-        )
+        # Truncate the encoder at the requested layer, all layers are needed otherwise
+        early_exit = getattr(args, "early_exit", False) and align_layer != -1
+        # The cache only holds the states of a single layer
+        use_cache = self.embedding_cache is not None and align_layer != -1
+
+        if use_cache:
+            cached_src = self.get_hidden_states_cached(
+                args, inputs_src, PAD_ID, align_layer
+            )
+            cached_tgt = self.get_hidden_states_cached(
+                args, inputs_tgt, PAD_ID, align_layer
+            )
+        else:
+            output_src, output_tgt = self.embed_loader(
+                inputs_src=inputs_src,
+                inputs_tgt=inputs_tgt,
+                attention_mask_src=(inputs_src != PAD_ID).long(),
+                attention_mask_tgt=(inputs_tgt != PAD_ID).long(),
+                guide=None,
+                align_layer=align_layer if early_exit else args.align_layer,
+                extraction=args.extraction,
+                softmax_threshold=args.softmax_threshold,
+                do_infer=True,
+                early_exit=early_exit,
+            )
 
         align_matrix_all_layers = {}
         if align_layer != -1:
@@ -81,8 +135,17 @@ class SentenceAligner_word(object):
             layers = range(1, len(output_src.hidden_states))
         for layer_id in layers:
 
-            hidden_states_src = output_src.hidden_states[layer_id]
-            hidden_states_tgt = output_tgt.hidden_states[layer_id]
+            if use_cache:
+                hidden_states_src, hidden_states_tgt = cached_src, cached_tgt
+            elif early_exit:
+                hidden_states_src = output_src.last_hidden_state
+                hidden_states_tgt = output_tgt.last_hidden_state
+            else:
+                hidden_states_src = output_src.hidden_states[layer_id]
+                hidden_states_tgt = output_tgt.hidden_states[layer_id]
+            # Extract in fp32 regardless of the inference dtype of the encoder
+            hidden_states_src = hidden_states_src.float()
+            hidden_states_tgt = hidden_states_tgt.float()
             # mask
             attention_mask_src = (
                 (inputs_src == PAD_ID) + (inputs_src == CLS_ID) + (inputs_src == SEP_ID)
@@ -123,14 +186,15 @@ class SentenceAligner_word(object):
 
             if self.guide is None:
                 # threshold = softmax_threshold if extraction == 'softmax' else 0
-                threshold = self.softmax_threshold
-                align_matrix = (attention_probs_src > threshold) * (
-                    attention_probs_tgt > threshold
-                )
+                align_matrix_all_thresholds = {}
+                for threshold in self.softmax_thresholds:
+                    align_matrix_all_thresholds[threshold] = (
+                        attention_probs_src > threshold
+                    ) * (attention_probs_tgt > threshold)
 
                 if not output_prob:
                     # return align_matrix
-                    align_matrix_all_layers[layer_id] = align_matrix
+                    align_matrix_all_layers[layer_id] = align_matrix_all_thresholds
                 # A heuristic of generating the alignment probability
                 """
                 attention_probs_src = nn.Softmax(dim=-1)(attention_scores_src/torch.sqrt(len_tgt.view(-1, 1, 1, 1)))
@@ -172,28 +236,34 @@ class SentenceAligner_word(object):
         word_aligns_all_layers = {}
 
         for layer_id in attention_probs_inter_all_layers:
+            word_aligns_all_thresholds = {}
 
-            attention_probs_inter = attention_probs_inter_all_layers[layer_id].float()
-
-            word_aligns = []
-            attention_probs_inter = attention_probs_inter[:, 0, 1:-1, 1:-1]
-
-            for idx, (attention, b2w_src, b2w_tgt) in enumerate(
-                zip(attention_probs_inter, bpe2word_map_src, bpe2word_map_tgt)
-            ):
-                aligns = set() if not output_prob else dict()
-                non_zeros = torch.nonzero(attention)
-                for i, j in non_zeros:
-                    word_pair = (b2w_src[i], b2w_tgt[j])
-                    if output_prob:
-                        prob = alignment_probs[idx, i, j]
-                        if not word_pair in aligns:
-                            aligns[word_pair] = prob
+            for threshold, attention_probs_inter in attention_probs_inter_all_layers[
+                layer_id
+            ].items():
+                attention_probs_inter = attention_probs_inter.float()
+
+                word_aligns = []
+                attention_probs_inter = attention_probs_inter[:, 0, 1:-1, 1:-1]
+
+                for idx, (attention, b2w_src, b2w_tgt) in enumerate(
+                    zip(attention_probs_inter, bpe2word_map_src, bpe2word_map_tgt)
+                ):
+                    aligns = set() if not output_prob else dict()
+                    non_zeros = torch.nonzero(attention)
+                    for i, j in non_zeros:
+                        word_pair = (b2w_src[i], b2w_tgt[j])
+                        if output_prob:
+                            prob = alignment_probs[idx, i, j]
+                            if not word_pair in aligns:
+                                aligns[word_pair] = prob
+                            else:
+                                aligns[word_pair] = max(aligns[word_pair], prob)
                         else:
-                            aligns[word_pair] = max(aligns[word_pair], prob)
-                    else:
-                        aligns.add(word_pair)
-                word_aligns.append(aligns)
+                            aligns.add(word_pair)
+                    word_aligns.append(aligns)
+
+                word_aligns_all_thresholds[threshold] = word_aligns
 
-            word_aligns_all_layers[layer_id] = word_aligns
+            word_aligns_all_layers[layer_id] = word_aligns_all_thresholds
         return word_aligns_all_layers
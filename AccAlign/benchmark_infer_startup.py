@@ -0,0 +1,103 @@
+# coding=utf-8
+"""Compare the end-to-end time of accalign_infer.py with `train_alignment_adapter.py --do_test`.
+
+Both entry points run as fresh processes on the first --num_lines sentence pairs, so the
+numbers include interpreter start-up, imports and model loading. `--help` is timed as well
+to separate the import cost from model loading and extraction.
+"""
+
+import argparse
+import itertools
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_command(command, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def head(path, num_lines, out_path):
+    with open(path, encoding="utf-8") as f, open(out_path, "w", encoding="utf-8") as writer:
+        writer.writelines(itertools.islice(f, num_lines))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_file_src", required=True, type=str)
+    parser.add_argument("--data_file_tgt", required=True, type=str)
+    parser.add_argument("--model_name_or_path", default="sentence-transformers/LaBSE", type=str)
+    parser.add_argument("--adapter_path", default=None, type=str)
+    parser.add_argument("--num_lines", default=100, type=int, help="Number of sentence pairs to align")
+    parser.add_argument("--repeats", default=3, type=int, help="Runs per command, the median is reported")
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src_path = os.path.join(tmp_dir, "src")
+        tgt_path = os.path.join(tmp_dir, "tgt")
+        head(args.data_file_src, args.num_lines, src_path)
+        head(args.data_file_tgt, args.num_lines, tgt_path)
+
+        common = ["--model_name_or_path", args.model_name_or_path, "--align_layer", "6"]
+        if args.adapter_path:
+            common += ["--adapter_path", args.adapter_path]
+        if args.no_cuda:
+            common.append("--no_cuda")
+
+        train_script = [sys.executable, os.path.join(HERE, "train_alignment_adapter.py")]
+        infer_script = [sys.executable, os.path.join(HERE, "accalign_infer.py")]
+        commands = {
+            "train_alignment_adapter.py --help": train_script + ["--help"],
+            "accalign_infer.py --help": infer_script + ["--help"],
+            "train_alignment_adapter.py --do_test": train_script
+            + common
+            + [
+                "--do_test",
+                "--early_exit",
+                "--extraction",
+                "softmax",
+                "--infer_path",
+                tmp_dir,
+                "--infer_filename",
+                "train.align",
+                "--infer_data_file_src",
+                src_path,
+                "--infer_data_file_tgt",
+                tgt_path,
+                "--per_gpu_train_batch_size",
+                str(args.batch_size),
+            ],
+            "accalign_infer.py": infer_script
+            + common
+            + [
+                "--output_dir",
+                tmp_dir,
+                "--infer_filename",
+                "infer.align",
+                "--data_file_src",
+                src_path,
+                "--data_file_tgt",
+                tgt_path,
+                "--batch_size",
+                str(args.batch_size),
+            ],
+        }
+
+        for name, command in commands.items():
+            print(f"{name:<40} {time_command(command, args.repeats):8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
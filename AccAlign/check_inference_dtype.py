@@ -0,0 +1,104 @@
+# coding=utf-8
+"""Accuracy guard for reduced-precision alignment inference.
+
+Extracts alignments for a reference set with fp32 and every requested --inference_dtype
+and reports the AER (computed with aer.py) of each dtype and its delta to fp32.
+Exits with a non-zero status if a delta exceeds --max_aer_delta.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+import torch
+import adapters
+from transformers import AutoConfig, AutoModel, AutoTokenizer
+
+from aer import calculate_aer, encode_links, read_hypothesis, read_reference
+from aligner.sent_aligner import word_align
+from self_training_modeling_adapter import prepare_inference_model
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_file_src", required=True, type=str, help="Source side of the reference set.")
+    parser.add_argument("--data_file_tgt", required=True, type=str, help="Target side of the reference set.")
+    parser.add_argument("--gold_file", required=True, type=str, help="Gold alignment of the reference set.")
+    parser.add_argument("--gold_one_index", action="store_true", help="Whether the gold alignment file is one-indexed")
+    parser.add_argument("--output_dir", required=True, type=str, help="Where the alignments per dtype are written.")
+    parser.add_argument("--model_name_or_path", default="sentence-transformers/LaBSE", type=str)
+    parser.add_argument("--adapter_path", default=None, type=str)
+    parser.add_argument(
+        "--inference_dtypes", default=["bf16", "int8"], nargs="+", choices=["bf16", "int8"], help="dtypes compared against fp32"
+    )
+    parser.add_argument("--align_layer", type=int, default=6, help="layer for alignment extraction")
+    parser.add_argument("--softmax_threshold", type=float, default=0.1)
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--max_aer_delta", default=1.0, type=float, help="Maximum tolerated AER increase in points")
+    parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    # Arguments expected by word_align
+    args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    args.per_gpu_train_batch_size = args.batch_size
+    args.extraction = "softmax"
+    args.softmax_thresholds = None
+    args.early_exit = True
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    config = AutoConfig.from_pretrained(args.model_name_or_path)
+    sure, possible = [encode_links(A) for A in read_reference(args.gold_file, one_indexed=args.gold_one_index)]
+
+    results = {}
+    for inference_dtype in ["fp32"] + args.inference_dtypes:
+        args.inference_dtype = inference_dtype
+        labse_model = AutoModel.from_pretrained(args.model_name_or_path, output_hidden_states=True)
+        adapters.init(labse_model)
+        model = prepare_inference_model(args, config, labse_model)
+
+        start = time.time()
+        word_align(
+            args,
+            tokenizer,
+            model,
+            args.output_dir,
+            args.data_file_src,
+            args.data_file_tgt,
+            args.device,
+            f"{inference_dtype}.align",
+            args.align_layer,
+        )
+        elapsed = time.time() - start
+
+        hypothesis = read_hypothesis(os.path.join(args.output_dir, f"{inference_dtype}.align.{args.align_layer}"))
+        precision, recall, aer = calculate_aer(sure, possible, hypothesis)
+        results[inference_dtype] = (aer * 100.0, precision * 100.0, recall * 100.0, elapsed)
+
+    failed = False
+    aer_fp32 = results["fp32"][0]
+    for inference_dtype, (aer, precision, recall, elapsed) in results.items():
+        delta = aer - aer_fp32
+        print(
+            "{0}: AER {1:.2f}% (delta {2:+.2f}) P {3:.2f}% R {4:.2f}% in {5:.1f}s".format(
+                inference_dtype, aer, delta, precision, recall, elapsed
+            )
+        )
+        if delta > args.max_aer_delta:
+            logger.warning("AER delta of %s exceeds --max_aer_delta %.2f", inference_dtype, args.max_aer_delta)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# coding=utf-8
+"""Export LaBSE + alignment adapter for fast alignment serving.
+
+The encoder is truncated at --align_layer and traced together with the active
+alignment_adapter (bottleneck adapters have no weights to fold, tracing bakes them
+into the graph), then written as ONNX or TorchScript next to the tokenizer and an
+aligner_config.json. Load the result with aligner/exported_aligner.py.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+import torch
+import adapters
+from transformers import AutoModel, AutoTokenizer
+
+from aligner.exported_aligner import CONFIG_NAME, ExportedAligner
+from aligner.sent_aligner import word_align
+from self_training_modeling_adapter import prepare_inference_model, truncated_encoder
+
+logger = logging.getLogger(__name__)
+
+
+class AlignLayerEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(
+            input_ids, attention_mask=attention_mask, output_hidden_states=False
+        ).last_hidden_state
+
+
+def export(args, labse_model, tokenizer):
+    encoder = AlignLayerEncoder(labse_model).eval()
+    dummy_ids = torch.tensor(
+        [[tokenizer.cls_token_id] + [tokenizer.unk_token_id] * 6 + [tokenizer.sep_token_id]] * 2
+    )
+    dummy_mask = torch.ones_like(dummy_ids)
+
+    with truncated_encoder(labse_model, args.align_layer), torch.no_grad():
+        if args.format == "onnx":
+            model_file = "encoder.onnx"
+            torch.onnx.export(
+                encoder,
+                (dummy_ids, dummy_mask),
+                os.path.join(args.output_dir, model_file),
+                input_names=["input_ids", "attention_mask"],
+                output_names=["hidden_states"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "sequence"},
+                    "attention_mask": {0: "batch", 1: "sequence"},
+                    "hidden_states": {0: "batch", 1: "sequence"},
+                },
+                opset_version=args.opset,
+                do_constant_folding=True,
+            )
+            if args.quantize:
+                try:
+                    from onnxruntime.quantization import QuantType, quantize_dynamic
+                except ImportError:
+                    raise ImportError("Please install onnxruntime to quantize the exported encoder.")
+                quantize_dynamic(
+                    os.path.join(args.output_dir, model_file),
+                    os.path.join(args.output_dir, "encoder.int8.onnx"),
+                    weight_type=QuantType.QInt8,
+                )
+                model_file = "encoder.int8.onnx"
+        else:
+            model_file = "encoder.pt"
+            traced = torch.jit.trace(encoder, (dummy_ids, dummy_mask), strict=False)
+            traced.save(os.path.join(args.output_dir, model_file))
+    return model_file
+
+
+def verify(args, labse_model, tokenizer):
+    """Compare the exported aligner with SentenceAligner_word on a few sentence pairs."""
+    args.per_gpu_train_batch_size = args.batch_size
+    args.extraction = "softmax"
+    args.softmax_thresholds = None
+    args.early_exit = True
+    args.inference_dtype = "fp32"
+    args.adapter_path = None  # already loaded
+    model = prepare_inference_model(args, labse_model.config, labse_model)
+    word_align(
+        args,
+        tokenizer,
+        model,
+        args.output_dir,
+        args.verify_data_file_src,
+        args.verify_data_file_tgt,
+        args.device,
+        "verify.align",
+        args.align_layer,
+    )
+
+    start = time.time()
+    aligner = ExportedAligner(args.output_dir)
+    logger.info("Loaded exported aligner in %.2fs", time.time() - start)
+    exported_file = os.path.join(args.output_dir, "verify.exported.align")
+    aligner.align_files(
+        args.verify_data_file_src, args.verify_data_file_tgt, exported_file, args.batch_size
+    )
+
+    with open(os.path.join(args.output_dir, f"verify.align.{args.align_layer}"), encoding="utf-8") as f:
+        reference = [set(line.split()) for line in f]
+    with open(exported_file, encoding="utf-8") as f:
+        exported = [set(line.split()) for line in f]
+    same = sum(r == e for r, e in zip(reference, exported))
+    logger.info("Exported aligner reproduces %d/%d alignment lines", same, len(reference))
+    for path in [exported_file, os.path.join(args.output_dir, f"verify.align.{args.align_layer}")]:
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output_dir", required=True, type=str, help="Directory for the exported aligner.")
+    parser.add_argument("--model_name_or_path", default="sentence-transformers/LaBSE", type=str)
+    parser.add_argument("--adapter_path", default=None, type=str)
+    parser.add_argument("--format", default="onnx", choices=["onnx", "torchscript"])
+    parser.add_argument("--quantize", action="store_true", help="Also write a dynamically int8-quantized ONNX encoder and use it")
+    parser.add_argument("--opset", default=14, type=int, help="ONNX opset version")
+    parser.add_argument("--align_layer", type=int, default=6, help="layer for alignment extraction")
+    parser.add_argument("--softmax_threshold", type=float, default=0.1)
+    parser.add_argument("--verify_data_file_src", default=None, type=str, help="Optional source sentences to verify the export.")
+    parser.add_argument("--verify_data_file_tgt", default=None, type=str, help="Optional target sentences to verify the export.")
+    parser.add_argument("--batch_size", default=32, type=int)
+    args = parser.parse_args()
+    args.device = torch.device("cpu")
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    labse_model = AutoModel.from_pretrained(args.model_name_or_path, output_hidden_states=True)
+    adapters.init(labse_model)
+    if args.adapter_path:
+        labse_model.load_adapter(args.adapter_path)
+        labse_model.set_active_adapters("alignment_adapter")
+    labse_model.eval()
+
+    model_file = export(args, labse_model, tokenizer)
+    tokenizer.backend_tokenizer.save(os.path.join(args.output_dir, "tokenizer.json"))
+    with open(os.path.join(args.output_dir, CONFIG_NAME), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "format": args.format,
+                "model_file": model_file,
+                "model_name_or_path": args.model_name_or_path,
+                "adapter_path": args.adapter_path,
+                "align_layer": args.align_layer,
+                "softmax_threshold": args.softmax_threshold,
+                "pad_token_id": tokenizer.pad_token_id,
+                "cls_token_id": tokenizer.cls_token_id,
+                "sep_token_id": tokenizer.sep_token_id,
+            },
+            f,
+            indent=2,
+        )
+    logger.info("Exported aligner to %s", args.output_dir)
+
+    if args.verify_data_file_src and args.verify_data_file_tgt:
+        verify(args, labse_model, tokenizer)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# coding=utf-8
+"""On-disk cache of the tokenized examples of LineByLineTextDataset (train_alignment_adapter.py).
+
+Every field of all examples (subword ids, subword-to-word maps, gold word pairs) is stored
+as one flat int32 .npy array plus a table of per-example offsets and the input line of
+every example, and memory-mapped on load. Caches are keyed by the content of the data
+files, the tokenizer and the tokenization options, so a changed file or tokenizer never
+reads stale features.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+FIELDS = ["ids_src", "ids_tgt", "b2w_src", "b2w_tgt", "gold"]
+OFFSETS_FILENAME = "offsets.npy"
+LINE_IDS_FILENAME = "line_ids.npy"
+META_FILENAME = "meta.json"
+# Part of the fingerprint, bump when the stored format changes
+FORMAT_VERSION = 2
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    if getattr(tokenizer, "is_fast", False):
+        state = tokenizer.backend_tokenizer.to_str()
+    else:
+        state = json.dumps(sorted(tokenizer.get_vocab().items()))
+    return hashlib.sha1(f"{type(tokenizer).__name__}|{state}".encode("utf-8")).hexdigest()
+
+
+def features_fingerprint(tokenizer, paths, **options):
+    """Hash of the data files (None for a missing gold file), the tokenizer and the options."""
+    fingerprint = hashlib.sha1()
+    for path in paths:
+        fingerprint.update((file_sha1(path) if path else "-").encode("utf-8"))
+    fingerprint.update(tokenizer_fingerprint(tokenizer).encode("utf-8"))
+    options = dict(options, format_version=FORMAT_VERSION)
+    fingerprint.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    return fingerprint.hexdigest()[:16]
+
+
+def save_features(cache_dir, examples, line_ids):
+    # Written to a temporary directory first, so an interrupted run leaves no partial cache
+    tmp_dir = f"{cache_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    has_gold = len(examples) > 0 and examples[0][4] is not None
+    values = {field: [] for field in FIELDS}
+    lengths = np.zeros((len(examples), len(FIELDS)), dtype=np.int64)
+    for i, (ids_src, ids_tgt, b2w_src, b2w_tgt, gold, _) in enumerate(examples):
+        gold = [w for pair in gold for w in pair] if has_gold else []
+        for j, (field, field_values) in enumerate(
+            zip(FIELDS, [ids_src.numpy(), ids_tgt.numpy(), b2w_src, b2w_tgt, gold])
+        ):
+            values[field].append(np.asarray(field_values, dtype=np.int32))
+            lengths[i, j] = len(field_values)
+
+    for field in FIELDS:
+        array = np.concatenate(values[field]) if values[field] else np.zeros(0, dtype=np.int32)
+        np.save(os.path.join(tmp_dir, f"{field}.npy"), array)
+    offsets = np.zeros((len(examples) + 1, len(FIELDS)), dtype=np.int64)
+    np.cumsum(lengths, axis=0, out=offsets[1:])
+    np.save(os.path.join(tmp_dir, OFFSETS_FILENAME), offsets)
+    np.save(os.path.join(tmp_dir, LINE_IDS_FILENAME), np.asarray(line_ids, dtype=np.int64))
+    with open(os.path.join(tmp_dir, META_FILENAME), "w", encoding="utf-8") as f:
+        json.dump({"num_examples": len(examples), "has_gold": has_gold}, f)
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+class CachedFeatures(object):
+    """Memory-mapped examples of a feature cache, in the LineByLineTextDataset format on access."""
+
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, META_FILENAME), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.num_examples = meta["num_examples"]
+        self.has_gold = meta["has_gold"]
+        self.offsets = np.load(os.path.join(cache_dir, OFFSETS_FILENAME))
+        self.line_ids = np.load(os.path.join(cache_dir, LINE_IDS_FILENAME)).tolist()
+        self.arrays = {
+            field: np.load(os.path.join(cache_dir, f"{field}.npy"), mmap_mode="r") for field in FIELDS
+        }
+
+    def __len__(self):
+        return self.num_examples
+
+    def _field(self, i, j):
+        return self.arrays[FIELDS[j]][self.offsets[i, j] : self.offsets[i + 1, j]]
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.num_examples:
+            raise IndexError(i)
+        ids_src = torch.from_numpy(self._field(i, 0).astype(np.int64))
+        ids_tgt = torch.from_numpy(self._field(i, 1).astype(np.int64))
+        gold = None
+        if self.has_gold:
+            gold = [tuple(pair) for pair in self._field(i, 4).reshape(-1, 2).tolist()]
+        return (
+            ids_src,
+            ids_tgt,
+            self._field(i, 2).tolist(),
+            self._field(i, 3).tolist(),
+            gold,
+            [len(ids_src) - 2, len(ids_tgt) - 2],
+        )
+
+    def __iter__(self):
+        for i in range(self.num_examples):
+            yield self[i]
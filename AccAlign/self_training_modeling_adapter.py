@@ -1,3 +1,6 @@
+import functools
+from contextlib import contextmanager
+
 import transformers
 from transformers import AutoModel
 import torch.nn as nn
@@ -25,6 +28,101 @@ def return_extended_attention_mask(attention_mask, dtype):
     return extended_attention_mask
 
 
+@contextmanager
+def truncated_encoder(model, num_layers):
+    # Temporarily drop all encoder layers above num_layers (and the pooler), so that
+    # last_hidden_state equals hidden_states[num_layers] of the full model
+    encoder_layers, pooler = model.encoder.layer, model.pooler
+    model.encoder.layer = encoder_layers[:num_layers]
+    model.pooler = None
+    try:
+        yield model
+    finally:
+        model.encoder.layer = encoder_layers
+        model.pooler = pooler
+
+
+def _checkpointed_forward(forward, *args, **kwargs):
+    if not torch.is_grad_enabled():
+        return forward(*args, **kwargs)
+    return torch.utils.checkpoint.checkpoint(forward, *args, use_reentrant=False, **kwargs)
+
+
+def checkpoint_encoder_layers(model, num_layers):
+    # Gradient checkpointing of the first num_layers encoder layers: their activations are
+    # recomputed in the backward pass instead of being kept in memory
+    for layer in model.encoder.layer[:num_layers]:
+        layer.forward = functools.partial(_checkpointed_forward, layer.forward)
+
+
+def quantize_dynamic_int8(model):
+    # adapters wraps the attention and feed-forward projections into LoRALinear subclasses, which
+    # quantize_dynamic skips. Without LoRA weights they are plain linear layers, so swap them back first
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if (
+                isinstance(child, nn.Linear)
+                and type(child) is not nn.Linear
+                and not getattr(child, 'loras', None)
+            ):
+                linear = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+                linear.weight, linear.bias = child.weight, child.bias
+                setattr(parent, name, linear)
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def set_inference_dtype(model, inference_dtype, device):
+    # Cast (bf16) or dynamically quantize (int8) the encoder including the adapter layers
+    if inference_dtype == 'bf16':
+        return model.to(dtype=torch.bfloat16)
+    if inference_dtype == 'int8':
+        if device.type != 'cpu':
+            raise ValueError('int8 dynamic quantization is only supported on CPU, use --no_cuda')
+        return quantize_dynamic_int8(model)
+    return model
+
+
+def word_aligns_to_guide(word_aligns, bpe2word_map_src, bpe2word_map_tgt, src_len, tgt_len, bpelen_src, bpelen_tgt):
+    # Subword-level guide of a batch: every aligned word pair is scattered into a word-level
+    # alignment matrix, which is then gathered through the subword-to-word maps in one op.
+    # Word ids are shifted by one so that the -1 placeholder maps to row/column 0
+    batch_size = len(word_aligns)
+    guide = torch.zeros(batch_size, 1, src_len, tgt_len)
+    lens_src = [max(0, min(bpelen_src, len(b2w))) for b2w in bpe2word_map_src]
+    lens_tgt = [max(0, min(bpelen_tgt, len(b2w))) for b2w in bpe2word_map_tgt]
+    max_src, max_tgt = max(lens_src, default=0), max(lens_tgt, default=0)
+    if max_src == 0 or max_tgt == 0:
+        return guide
+
+    b2w_src = torch.zeros(batch_size, max_src, dtype=torch.long)
+    b2w_tgt = torch.zeros(batch_size, max_tgt, dtype=torch.long)
+    for idx, (b2w, length) in enumerate(zip(bpe2word_map_src, lens_src)):
+        b2w_src[idx, :length] = torch.as_tensor(b2w[:length], dtype=torch.long) + 1
+    for idx, (b2w, length) in enumerate(zip(bpe2word_map_tgt, lens_tgt)):
+        b2w_tgt[idx, :length] = torch.as_tensor(b2w[:length], dtype=torch.long) + 1
+    num_words_src, num_words_tgt = int(b2w_src.max()) + 1, int(b2w_tgt.max()) + 1
+
+    pairs = [
+        (idx, word_src + 1, word_tgt + 1)
+        for idx, word_align in enumerate(word_aligns)
+        for word_src, word_tgt in word_align
+        if -1 <= word_src < num_words_src - 1 and -1 <= word_tgt < num_words_tgt - 1
+    ]
+    if not pairs:
+        return guide
+    word_guide = torch.zeros(batch_size, num_words_src, num_words_tgt, dtype=torch.bool)
+    pairs = torch.tensor(pairs, dtype=torch.long)
+    word_guide[pairs[:, 0], pairs[:, 1], pairs[:, 2]] = True
+
+    subword_guide = word_guide[
+        torch.arange(batch_size)[:, None, None], b2w_src[:, :, None], b2w_tgt[:, None, :]
+    ]
+    subword_guide &= (torch.arange(max_src)[None, :] < torch.tensor(lens_src)[:, None])[:, :, None]
+    subword_guide &= (torch.arange(max_tgt)[None, :] < torch.tensor(lens_tgt)[:, None])[:, None, :]
+    guide[:, 0, 1 : max_src + 1, 1 : max_tgt + 1] = subword_guide.float()
+    return guide
+
+
 class ModelGuideHead(nn.Module):
     def __init__(self):
         super().__init__()
@@ -118,11 +216,29 @@ class BertForSO(PreTrainedModel):
             position_ids1=None,
             position_ids2=None,
             do_infer=False,
+            early_exit=False,
     ):
 
         loss_fct =CrossEntropyLoss(reduction='none')
         batch_size = inputs_src.size(0)
 
+        if do_infer and early_exit:
+            # Only compute the layers up to align_layer and keep no intermediate hidden states
+            with truncated_encoder(self.model, align_layer):
+                output_src = self.model(
+                    inputs_src,
+                    attention_mask=attention_mask_src,
+                    position_ids=position_ids1,
+                    output_hidden_states=False,
+                )
+                output_tgt = self.model(
+                    inputs_tgt,
+                    attention_mask=attention_mask_tgt,
+                    position_ids=position_ids2,
+                    output_hidden_states=False,
+                )
+            return output_src, output_tgt
+
         output_src = self.model(
             inputs_src,
             attention_mask=attention_mask_src,
@@ -151,6 +267,15 @@ class BertForSO(PreTrainedModel):
                                     extraction=extraction, softmax_threshold=softmax_threshold)
         return sco_loss
 
+    def encode(self, inputs, attention_mask=None, align_layer=6, early_exit=False):
+        # Hidden states of a single side at align_layer
+        if early_exit:
+            with truncated_encoder(self.model, align_layer):
+                return self.model(
+                    inputs, attention_mask=attention_mask, output_hidden_states=False
+                ).last_hidden_state
+        return self.model(inputs, attention_mask=attention_mask).hidden_states[align_layer]
+
     def save_adapter(self, save_directory, adapter_name):
         self.model.save_adapter(save_directory, adapter_name)
         
@@ -166,11 +291,11 @@ class BertForSO(PreTrainedModel):
             with torch.no_grad():
                 outputs_src = self.model(
                     inputs_src,
-                    attention_mask=(inputs_src != PAD_ID),
+                    attention_mask=(inputs_src != PAD_ID).long(),
                 )
                 outputs_tgt = self.model(
                     inputs_tgt,
-                    attention_mask=(inputs_tgt != PAD_ID),
+                    attention_mask=(inputs_tgt != PAD_ID).long(),
                 )
 
 
@@ -210,16 +335,16 @@ class BertForSO(PreTrainedModel):
 
 
 
-        guide = torch.zeros(batch_size, 1, src_len, tgt_len)
-        for idx, (word_align, b2w_src, b2w_tgt) in enumerate(zip(word_aligns, bpe2word_map_src, bpe2word_map_tgt)):
-            len_src = min(bpelen_src, len(b2w_src))
-            len_tgt = min(bpelen_tgt, len(b2w_tgt))
-
-            for i in range(len_src):
-                for j in range(len_tgt):
-                    if (b2w_src[i], b2w_tgt[j]) in word_align:
-                        guide[idx, 0, i + 1, j + 1] = 1.0
-
+        return word_aligns_to_guide(
+            word_aligns, bpe2word_map_src, bpe2word_map_tgt, src_len, tgt_len, bpelen_src, bpelen_tgt
+        )
 
 
-        return guide
+def prepare_inference_model(args, config, labse_model):
+    if args.adapter_path:
+        labse_model.load_adapter(args.adapter_path)
+        labse_model.set_active_adapters('alignment_adapter')
+    model = BertForSO(args, config, labse_model)
+    model.to(args.device)
+    model.eval()
+    return set_inference_dtype(model, args.inference_dtype, args.device)
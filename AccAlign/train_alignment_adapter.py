@@ -17,6 +17,7 @@
 
 
 from aligner.sent_aligner import word_align
+from aligner.embedding_cache import EmbeddingCache, checkpoint_fingerprint
 import itertools
 import argparse
 import glob
@@ -24,6 +25,7 @@ import logging
 import os
 import random
 import re
+import time
 from typing import Dict, List, Tuple
 from tqdm import tqdm
 import copy
@@ -34,7 +36,12 @@ from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
-from self_training_modeling_adapter import BertForSO
+from self_training_modeling_adapter import (
+    PAD_ID,
+    BertForSO,
+    checkpoint_encoder_layers,
+    prepare_inference_model,
+)
 from transformers import (
     AutoTokenizer,
     AutoConfig,
@@ -42,7 +49,16 @@ from transformers import (
     AdamW,
     get_linear_schedule_with_warmup,
 )
-from train_utils import _sorted_checkpoints, _rotate_checkpoints, WEIGHTS_NAME
+from aer import calculate_aer, encode_links, read_reference
+from feature_cache import CachedFeatures, features_fingerprint, save_features
+from train_utils import (
+    _sorted_checkpoints,
+    _rotate_checkpoints,
+    DevAERTracker,
+    peak_memory_mb,
+    TokenBudgetBatchSampler,
+    WEIGHTS_NAME,
+)
 import adapters
 from adapters import AdapterConfig, DoubleSeqBnConfig
 
@@ -56,11 +72,27 @@ class LineByLineTextDataset(Dataset):
         logger.info("Creating features from dataset file at %s", file_path_src)
 
         assert file_path_src != file_path_tgt
-
-        # cache_fn = f'{file_path_src}.cache' if gold_path is None else f'{file_path}.gold.cache'
-        if args.cache_data and os.path.isfile(cache_fn) and not args.overwrite_cache:
-            logger.info("Loading cached data from %s", cache_fn)
-            self.examples = torch.load(cache_fn)
+        # Self-training word alignments per example, filled by precompute_guide_aligns
+        self.guide_aligns = None
+        # Input line of every example, lines without subwords or with a broken gold alignment are skipped
+        self.line_ids = []
+
+        cache_dir = None
+        if args.cache_data:
+            fingerprint = features_fingerprint(
+                tokenizer,
+                [file_path_src, file_path_tgt, gold_path],
+                max_len=args.max_len,
+                ignore_possible_alignments=args.ignore_possible_alignments,
+                gold_one_index=args.gold_one_index,
+            )
+            cache_dir = os.path.join(
+                args.feature_cache_dir or f"{file_path_src}.cache", fingerprint
+            )
+        if cache_dir and os.path.isdir(cache_dir) and not args.overwrite_cache:
+            logger.info("Loading cached data from %s", cache_dir)
+            self.examples = CachedFeatures(cache_dir)
+            self.line_ids = self.examples.line_ids
         else:
             # Loading text data
             self.examples = []
@@ -147,6 +179,7 @@ class LineByLineTextDataset(Dataset):
                                     [len(ids_src) - 2, len(ids_tgt) - 2],
                                 )
                             )
+                            self.line_ids.append(line_id)
                         except:
                             logger.info(
                                 "Error when processing the gold alignment %s, skipping",
@@ -164,19 +197,21 @@ class LineByLineTextDataset(Dataset):
                                 [len(ids_src) - 2, len(ids_tgt) - 2],
                             )
                         )
+                        self.line_ids.append(line_id)
 
-            if args.cache_data:
-                logger.info("Saving cached data to %s", cache_fn)
-                torch.save(self.examples, cache_fn)
+            if cache_dir:
+                logger.info("Saving cached data to %s", cache_dir)
+                os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+                save_features(cache_dir, self.examples, self.line_ids)
 
     def __len__(self):
         return len(self.examples)
 
     def __getitem__(self, i):
-        neg_i = random.randint(0, len(self.examples) - 1)
-        while neg_i == i:
-            neg_i = random.randint(0, len(self.examples) - 1)
-        return tuple(list(self.examples[i]) + list(self.examples[neg_i][:2]))
+        example = self.examples[i]
+        if self.guide_aligns is not None and example[4] is None:
+            example = tuple(example[:4]) + (self.guide_aligns[i],) + tuple(example[5:])
+        return example
 
 
 def load_and_cache_examples(args, tokenizer, evaluate=False):
@@ -192,6 +227,58 @@ def load_and_cache_examples(args, tokenizer, evaluate=False):
     )
 
 
+def truncate_ids(ids, block_size):
+    # Cut to block_size but keep the final [SEP]
+    end_id = ids[-1].view(-1)
+    return torch.cat([ids[:block_size][:-1], end_id])
+
+
+def example_lengths(dataset, block_size):
+    # src_len + tgt_len of every example after truncation to block_size
+    return [
+        min(len(example[0]), block_size) + min(len(example[1]), block_size)
+        for example in dataset.examples
+    ]
+
+
+def precompute_guide_aligns(args, model, train_dataset):
+    """Self-training word alignments of the whole training set, extracted in large length-sorted batches."""
+    model_to_align = model.module if hasattr(model, "module") else model
+    model_to_align.eval()
+    examples = train_dataset.examples
+    order = sorted(
+        range(len(examples)),
+        key=lambda i: max(len(examples[i][0]), len(examples[i][1])),
+    )
+    guide_aligns = [None] * len(examples)
+    for start in trange(
+        0,
+        len(order),
+        args.guide_batch_size,
+        desc="Guides",
+        disable=args.local_rank not in [-1, 0],
+    ):
+        batch_ids = order[start : start + args.guide_batch_size]
+        ids_src = [truncate_ids(examples[i][0], args.block_size) for i in batch_ids]
+        ids_tgt = [truncate_ids(examples[i][1], args.block_size) for i in batch_ids]
+        word_aligns = model_to_align.get_aligned_word(
+            pad_sequence(ids_src, batch_first=True, padding_value=PAD_ID),
+            pad_sequence(ids_tgt, batch_first=True, padding_value=PAD_ID),
+            [examples[i][2] for i in batch_ids],
+            [examples[i][3] for i in batch_ids],
+            args.device,
+            max(len(ids) for ids in ids_src),
+            max(len(ids) for ids in ids_tgt),
+            align_layer=args.align_layer,
+            extraction=args.extraction,
+            softmax_threshold=args.softmax_threshold,
+            test=True,
+        )
+        for i, aligns in zip(batch_ids, word_aligns):
+            guide_aligns[i] = aligns
+    return guide_aligns
+
+
 def set_seed(args):
     if args.seed >= 0:
         random.seed(args.seed)
@@ -206,7 +293,6 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
 
     def collate(examples):
         # model_init.eval()
-        model.eval()
         (
             examples_src,
             examples_tgt,
@@ -222,12 +308,8 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
         word_aligns = []
         pairs_len = []
         for example in examples:
-            end_id = example[0][-1].view(-1)
-
-            src_id = example[0][: args.block_size]
-            src_id = torch.cat([src_id[:-1], end_id])
-            tgt_id = example[1][: args.block_size]
-            tgt_id = torch.cat([tgt_id[:-1], end_id])
+            src_id = truncate_ids(example[0], args.block_size)
+            tgt_id = truncate_ids(example[1], args.block_size)
 
             examples_src.append(src_id)
             examples_tgt.append(tgt_id)
@@ -248,6 +330,8 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
         )
 
         if word_aligns[0] is None:
+            # Self-training guides are extracted on the fly (see --precompute_guides)
+            model.eval()
             word_aligns = None
         if args.n_gpu > 1 or args.local_rank != -1:
 
@@ -283,17 +367,41 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
 
         return examples_src, examples_tgt, guides
 
-    train_sampler = (
-        RandomSampler(train_dataset)
-        if args.local_rank == -1
-        else DistributedSampler(train_dataset)
-    )
-    train_dataloader = DataLoader(
-        train_dataset,
-        sampler=train_sampler,
-        batch_size=args.train_batch_size,
-        collate_fn=collate,
-    )
+    if args.precompute_guides:
+        if len(train_dataset) > 0 and train_dataset.examples[0][4] is not None:
+            logger.info("Training with gold alignments, --precompute_guides has no effect")
+        else:
+            logger.info("Precomputing self-training guides for %d examples", len(train_dataset))
+            train_dataset.guide_aligns = precompute_guide_aligns(args, model, train_dataset)
+
+    if args.max_tokens > 0:
+        # Length-grouped batches within a token budget instead of a fixed batch size
+        train_batch_sampler = TokenBudgetBatchSampler(
+            example_lengths(train_dataset, args.block_size),
+            args.max_tokens,
+            shuffle=True,
+            bucket_size=args.length_bucket_size,
+            seed=max(args.seed, 0),
+            num_replicas=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+            rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+        )
+        train_dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=train_batch_sampler,
+            collate_fn=collate,
+        )
+    else:
+        train_sampler = (
+            RandomSampler(train_dataset)
+            if args.local_rank == -1
+            else DistributedSampler(train_dataset)
+        )
+        train_dataloader = DataLoader(
+            train_dataset,
+            sampler=train_sampler,
+            batch_size=args.train_batch_size,
+            collate_fn=collate,
+        )
 
     t_total = (
         len(train_dataloader)
@@ -348,6 +456,14 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
             model, optimizer, opt_level=args.fp16_opt_level
         )
 
+    # Native mixed precision: autocast for the forward pass, loss scaling for fp16 only
+    amp_dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(args.mixed_precision)
+    scaler = torch.amp.GradScaler(
+        args.device.type, enabled=args.mixed_precision == "fp16"
+    )
+    if args.gradient_checkpointing:
+        checkpoint_encoder_layers(model.model, args.align_layer)
+
     # multi-gpu training (should be after apex fp16 initialization)
     if args.n_gpu > 1:
         model = torch.nn.DataParallel(model)
@@ -376,6 +492,11 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
     )
     logger.info("  Gradient Accumulation steps = %d", args.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", t_total)
+    logger.info(
+        "  Mixed precision = %s, gradient checkpointing = %s",
+        "apex" if args.fp16 else args.mixed_precision,
+        args.gradient_checkpointing,
+    )
 
     global_step = 0
     # Check if continuing training from a checkpoint
@@ -397,13 +518,28 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
             with amp.scale_loss(loss, optimizer) as scaled_loss:
                 scaled_loss.backward()
         else:
-            loss.backward()
+            scaler.scale(loss).backward()
         return tot_loss
 
     tqdm_iterator = trange(
         int(t_total), desc="Iteration", disable=args.local_rank not in [-1, 0]
     )
+    # The dev set is tokenized and batched once for all evaluations
+    eval_data = None
+    if args.local_rank in [-1, 0] and args.logging_steps > 0:
+        eval_data = load_eval_data(args, tokenizer)
+    aer_tracker = DevAERTracker(
+        args.output_dir_adapter,
+        patience=args.early_stopping_patience,
+        min_delta=args.early_stopping_min_delta,
+        keep_best=args.keep_best_checkpoints,
+    )
+    stop_training = False
+
+    # Time of the optimization steps incl. data loading, without evaluation and saving
+    train_time, logging_train_time = 0.0, 0.0
     for _ in range(int(args.num_train_epochs)):
+        step_start = time.perf_counter()
         for step, batch in enumerate(train_dataloader):
             model.train()
 
@@ -412,20 +548,25 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
                 inputs_src, inputs_tgt = inputs_src.to(args.device), inputs_tgt.to(
                     args.device
                 )
-                attention_mask_src, attention_mask_tgt = (inputs_src != 0), (
+                attention_mask_src, attention_mask_tgt = (inputs_src != 0).long(), (
                     inputs_tgt != 0
-                )
+                ).long()
                 guide = batch[2].to(args.device)
-                loss = model(
-                    inputs_src=inputs_src,
-                    inputs_tgt=inputs_tgt,
-                    attention_mask_src=attention_mask_src,
-                    attention_mask_tgt=attention_mask_tgt,
-                    guide=guide,
-                    align_layer=args.align_layer,
-                    extraction=args.extraction,
-                    softmax_threshold=args.softmax_threshold,
-                )
+                with torch.autocast(
+                    device_type=args.device.type,
+                    dtype=amp_dtype,
+                    enabled=amp_dtype is not None,
+                ):
+                    loss = model(
+                        inputs_src=inputs_src,
+                        inputs_tgt=inputs_tgt,
+                        attention_mask_src=attention_mask_src,
+                        attention_mask_tgt=attention_mask_tgt,
+                        guide=guide,
+                        align_layer=args.align_layer,
+                        extraction=args.extraction,
+                        softmax_threshold=args.softmax_threshold,
+                    )
                 tr_loss = backward_loss(loss, tr_loss)
 
             if (step + 1) % args.gradient_accumulation_steps == 0:
@@ -433,16 +574,32 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
                     torch.nn.utils.clip_grad_norm_(
                         amp.master_params(optimizer), args.max_grad_norm
                     )
+                    optimizer.step()
                 else:
+                    scaler.unscale_(optimizer)
                     torch.nn.utils.clip_grad_norm_(
                         model.parameters(), args.max_grad_norm
                     )
-                optimizer.step()
+                    scaler.step(optimizer)
+                    scaler.update()
                 scheduler.step()  # Update learning rate schedule
                 model.zero_grad()
                 global_step += 1
+                if args.device.type == "cuda":
+                    torch.cuda.synchronize(args.device)
+                train_time += time.perf_counter() - step_start
                 tqdm_iterator.update()
 
+                if (
+                    train_dataset.guide_aligns is not None
+                    and args.guide_refresh_steps > 0
+                    and global_step % args.guide_refresh_steps == 0
+                ):
+                    logger.info("Refreshing self-training guides at step %d", global_step)
+                    train_dataset.guide_aligns = precompute_guide_aligns(
+                        args, model, train_dataset
+                    )
+
                 if (
                     args.local_rank in [-1, 0]
                     and args.logging_steps > 0
@@ -453,6 +610,12 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
                         str(global_step),
                         str((tr_loss - logging_loss) / args.logging_steps),
                     )
+                    logger.info(
+                        "  Step time = %.3fs, peak memory = %.0f MB",
+                        (train_time - logging_train_time) / args.logging_steps,
+                        peak_memory_mb(args.device),
+                    )
+                    logging_train_time = train_time
 
                     logger.info("***** Training results {} *****".format(global_step))
                     # for key in sorted(result.keys()):
@@ -465,7 +628,24 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
 
                     logging_loss = tr_loss
 
-                    evaluate(args, model, tokenizer, global_step, prefix="")
+                    results = evaluate(args, model, tokenizer, global_step, eval_data, prefix="")
+                    if results:
+                        stop_training = aer_tracker.update(
+                            global_step,
+                            results["aer"],
+                            lambda path: model.save_adapter(path, "alignment_adapter"),
+                        )
+
+                if (
+                    args.local_rank != -1
+                    and args.early_stopping_patience > 0
+                    and args.logging_steps > 0
+                    and global_step % args.logging_steps == 0
+                ):
+                    # Only the first process evaluates, all processes stop together
+                    stop_flag = torch.tensor(int(stop_training), device=args.device)
+                    torch.distributed.broadcast(stop_flag, 0)
+                    stop_training = bool(stop_flag.item())
 
                 if (
                     args.local_rank in [-1, 0]
@@ -481,61 +661,43 @@ def train(args, train_dataset, model, tokenizer) -> Tuple[int, float]:
 
                     model.save_adapter(output_dir_adapter, "alignment_adapter")
                     logger.info("Saving adapters to %s", output_dir_adapter)
+                    _rotate_checkpoints(args, checkpoint_prefix, output_dir=args.output_dir_adapter)
+
+                step_start = time.perf_counter()
 
-            if global_step > t_total:
+            if global_step > t_total or stop_training:
                 break
 
-        if global_step > t_total:
+        if global_step > t_total or stop_training:
             break
 
-    return global_step, tr_loss / global_step
+    if aer_tracker.best_step is not None:
+        logger.info("  Best dev AER = %.2f%% at step %d", aer_tracker.best_aer * 100.0, aer_tracker.best_step)
 
+    logger.info(
+        "  Mixed precision = %s, gradient checkpointing = %s: %.3fs per step, peak memory = %.0f MB",
+        "apex" if args.fp16 else args.mixed_precision,
+        args.gradient_checkpointing,
+        train_time / max(global_step, 1),
+        peak_memory_mb(args.device),
+    )
 
-def evaluate(args, model, tokenizer, global_step, prefix="") -> Dict:
-    # Loop to handle MNLI double evaluation (matched, mis-matched)
-    eval_output_dir = args.eval_res_dir
-
-    eval_dataset = load_and_cache_examples(args, tokenizer, evaluate=True)
+    return global_step, tr_loss / global_step
 
-    if args.local_rank in [-1, 0]:
-        os.makedirs(eval_output_dir, exist_ok=True)
 
+def load_eval_data(args, tokenizer):
+    """Evaluation dataset, DataLoader and gold alignments (as encode_links keys), built once per training run."""
+    eval_dataset = load_and_cache_examples(args, tokenizer, evaluate=True)
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
 
-    # Note that DistributedSampler samples randomly
     def collate(examples):
-        model.eval()
-        (
-            examples_src,
-            examples_tgt,
-            examples_srctgt,
-            examples_tgtsrc,
-            langid_srctgt,
-            langid_tgtsrc,
-            psi_examples_srctgt,
-            psi_labels,
-        ) = ([], [], [], [], [], [], [], [])
-        src_len = tgt_len = 0
+        examples_src, examples_tgt = [], []
         bpe2word_map_src, bpe2word_map_tgt = [], []
-        word_aligns = []
-        pairs_len = []
         for example in examples:
-            end_id = example[0][-1].view(-1)
-
-            src_id = example[0][: args.block_size]
-            src_id = torch.cat([src_id[:-1], end_id])
-            tgt_id = example[1][: args.block_size]
-            tgt_id = torch.cat([tgt_id[:-1], end_id])
-
-            examples_src.append(src_id)
-            examples_tgt.append(tgt_id)
-            src_len = max(src_len, len(src_id))
-            tgt_len = max(tgt_len, len(tgt_id))
-
+            examples_src.append(truncate_ids(example[0], args.block_size))
+            examples_tgt.append(truncate_ids(example[1], args.block_size))
             bpe2word_map_src.append(example[2])
             bpe2word_map_tgt.append(example[3])
-            word_aligns.append(example[4])
-            pairs_len.append(example[5])
 
         examples_src = pad_sequence(
             examples_src, batch_first=True, padding_value=tokenizer.pad_token_id
@@ -543,35 +705,47 @@ def evaluate(args, model, tokenizer, global_step, prefix="") -> Dict:
         examples_tgt = pad_sequence(
             examples_tgt, batch_first=True, padding_value=tokenizer.pad_token_id
         )
+        return examples_src, examples_tgt, bpe2word_map_src, bpe2word_map_tgt
 
-        if word_aligns[0] is None:
-            word_aligns = None
-
-        guides = model.get_aligned_word(
-            examples_src,
-            examples_tgt,
-            bpe2word_map_src,
-            bpe2word_map_tgt,
-            args.device,
-            src_len,
-            tgt_len,
-            align_layer=args.align_layer,
-            extraction=args.extraction,
-            softmax_threshold=args.softmax_threshold,
-            test=False,
-            word_aligns=word_aligns,
-            pairs_len=pairs_len,
+    if args.max_tokens > 0:
+        # Deterministic length-sorted batches, the alignments are written back in the original order
+        eval_batch_sampler = TokenBudgetBatchSampler(
+            example_lengths(eval_dataset, args.block_size), args.max_tokens, shuffle=False
+        )
+        eval_dataloader = DataLoader(
+            eval_dataset,
+            batch_sampler=eval_batch_sampler,
+            collate_fn=collate,
         )
+        eval_batch_ids = list(eval_batch_sampler)
+    else:
+        eval_sampler = SequentialSampler(eval_dataset)
+        eval_dataloader = DataLoader(
+            eval_dataset,
+            sampler=eval_sampler,
+            batch_size=args.eval_batch_size,
+            collate_fn=collate,
+        )
+        eval_batch_ids = [
+            list(range(start, min(start + args.eval_batch_size, len(eval_dataset))))
+            for start in range(0, len(eval_dataset), args.eval_batch_size)
+        ]
 
-        return examples_src, examples_tgt, guides, bpe2word_map_src, bpe2word_map_tgt
+    num_lines = max(eval_dataset.line_ids, default=-1) + 1
+    sure = possible = None
+    if args.eval_gold_file:
+        sure, possible = read_reference(args.eval_gold_file, one_indexed=args.gold_one_index)
+        num_lines = len(sure)
+        sure, possible = encode_links(sure), encode_links(possible)
+    return eval_dataset, eval_dataloader, eval_batch_ids, num_lines, sure, possible
 
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(
-        eval_dataset,
-        sampler=eval_sampler,
-        batch_size=args.eval_batch_size,
-        collate_fn=collate,
-    )
+
+def evaluate(args, model, tokenizer, global_step, eval_data, prefix="") -> Dict:
+    eval_output_dir = args.eval_res_dir
+    eval_dataset, eval_dataloader, eval_batch_ids, num_lines, sure, possible = eval_data
+
+    if args.local_rank in [-1, 0]:
+        os.makedirs(eval_output_dir, exist_ok=True)
 
     # multi-gpu evaluate
     if args.n_gpu > 1:
@@ -581,8 +755,6 @@ def evaluate(args, model, tokenizer, global_step, prefix="") -> Dict:
     logger.info("***** Running evaluation {} *****".format(prefix))
     logger.info("  Num examples = %d", len(eval_dataset))
     logger.info("  Batch size = %d", args.eval_batch_size)
-    eval_loss = 0.0
-    nb_eval_steps = 0
     model.eval()
     set_seed(args)  # Added here for seeds
 
@@ -591,19 +763,14 @@ def evaluate(args, model, tokenizer, global_step, prefix="") -> Dict:
         os.makedirs(folder_path)
     output_file = os.path.join(folder_path, "dev.align.6")
 
-    writers = open(output_file, "w", encoding="utf-8")
-
-    for batch in tqdm(eval_dataloader, desc="Evaluating"):
+    # One alignment per input line, lines skipped by the dataset stay empty
+    word_aligns = [set() for _ in range(num_lines)]
+    for batch_ids, batch in zip(
+        eval_batch_ids, tqdm(eval_dataloader, desc="Evaluating")
+    ):
         with torch.no_grad():
-            inputs_src, inputs_tgt = batch[0].clone(), batch[1].clone()
-            inputs_src, inputs_tgt = inputs_src.to(args.device), inputs_tgt.to(
-                args.device
-            )
-            attention_mask_src, attention_mask_tgt = (inputs_src != 0), (
-                inputs_tgt != 0
-            )
-
-            bpe2word_map_src, bpe2word_map_tgt = batch[3], batch[4]
+            inputs_src, inputs_tgt = batch[0].to(args.device), batch[1].to(args.device)
+            bpe2word_map_src, bpe2word_map_tgt = batch[2], batch[3]
 
             word_aligns_list_batch = model.get_aligned_word(
                 inputs_src,
@@ -622,12 +789,29 @@ def evaluate(args, model, tokenizer, global_step, prefix="") -> Dict:
                 pairs_len=None,
             )
 
-            for aligns_set in word_aligns_list_batch:
-                output_str = []
-                for word_align in aligns_set:
-                    if word_align[0] != -1:
-                        output_str.append(f"{word_align[0]}-{word_align[1]}")
-                writers.write(" ".join(output_str) + "\n")
+            for i, aligns_set in zip(batch_ids, word_aligns_list_batch):
+                word_aligns[eval_dataset.line_ids[i]] = {
+                    word_align for word_align in aligns_set if word_align[0] != -1
+                }
+
+    with open(output_file, "w", encoding="utf-8") as writers:
+        for aligns_set in word_aligns:
+            writers.write(
+                " ".join(f"{word_align[0]}-{word_align[1]}" for word_align in aligns_set) + "\n"
+            )
+
+    results = {}
+    if sure is not None:
+        precision, recall, aer = calculate_aer(sure, possible, word_aligns)
+        results = {"aer": aer, "precision": precision, "recall": recall}
+        logger.info(
+            "  Step %d. AER = %.2f%% (precision %.2f%%, recall %.2f%%)",
+            global_step,
+            aer * 100.0,
+            precision * 100.0,
+            recall * 100.0,
+        )
+    return results
 
 
 def main():
@@ -743,7 +927,15 @@ def main():
     )
     # Other parameters
     parser.add_argument(
-        "--cache_data", action="store_true", help="if cache the dataset"
+        "--cache_data",
+        action="store_true",
+        help="Cache the tokenized examples, keyed by the content of the data files and the tokenizer",
+    )
+    parser.add_argument(
+        "--feature_cache_dir",
+        default=None,
+        type=str,
+        help="Directory for --cache_data (default: <data_file_src>.cache)",
     )
     parser.add_argument(
         "--align_layer", type=int, default=6, help="layer for alignment extraction"
@@ -756,6 +948,67 @@ def main():
         help="softmax or entmax",
     )
     parser.add_argument("--softmax_threshold", type=float, default=0.1)
+    parser.add_argument(
+        "--softmax_thresholds",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Extract one alignment file per threshold from a single encoder pass during inference "
+        "(written to <infer_filename>.thr<threshold>.<layer>). Overrides --softmax_threshold for --do_test.",
+    )
+    parser.add_argument(
+        "--early_exit",
+        action="store_true",
+        help="Only compute the encoder layers up to --align_layer during inference",
+    )
+
+    parser.add_argument(
+        "--inference_dtype",
+        default="fp32",
+        type=str,
+        choices=["fp32", "bf16", "int8"],
+        help="Precision of the encoder incl. adapters during inference (int8: dynamic quantization, CPU only)",
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        default=None,
+        type=str,
+        help="Optional directory to cache the per-sentence hidden states at --align_layer during inference. "
+        "Sentences seen before with the same model and adapter are not encoded again.",
+    )
+
+    parser.add_argument(
+        "--precompute_guides",
+        action="store_true",
+        help="Extract the self-training guides of the whole training set in batched passes before training "
+        "instead of in the DataLoader collate",
+    )
+    parser.add_argument(
+        "--guide_refresh_steps",
+        default=0,
+        type=int,
+        help="Re-extract the precomputed guides with the current adapter every X optimization steps (0: never)",
+    )
+    parser.add_argument(
+        "--guide_batch_size",
+        default=128,
+        type=int,
+        help="Batch size for --precompute_guides",
+    )
+
+    parser.add_argument(
+        "--max_tokens",
+        default=0,
+        type=int,
+        help="Group examples of similar length into batches of at most X padded (src + tgt) tokens "
+        "instead of fixed-size batches (0: disabled)",
+    )
+    parser.add_argument(
+        "--length_bucket_size",
+        default=1000,
+        type=int,
+        help="Number of shuffled training examples that are sorted by length together for --max_tokens",
+    )
 
     parser.add_argument(
         "--should_continue",
@@ -878,6 +1131,24 @@ def main():
         default=None,
         help="Limit the total amount of checkpoints, delete the older checkpoints in the output_dir, does not delete by default",
     )
+    parser.add_argument(
+        "--early_stopping_patience",
+        type=int,
+        default=0,
+        help="Stop training after this many evaluations (every --logging_steps) without a dev AER improvement, 0 disables",
+    )
+    parser.add_argument(
+        "--early_stopping_min_delta",
+        type=float,
+        default=0.0,
+        help="Minimum AER decrease (as a fraction, e.g. 0.001 for 0.1 points) that counts as an improvement",
+    )
+    parser.add_argument(
+        "--keep_best_checkpoints",
+        type=int,
+        default=0,
+        help="Keep the adapters of the K evaluations with the lowest dev AER as best-<step> in --output_dir_adapter",
+    )
     parser.add_argument(
         "--no_cuda", action="store_true", help="Avoid using CUDA when available"
     )
@@ -903,6 +1174,18 @@ def main():
         action="store_true",
         help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
     )
+    parser.add_argument(
+        "--mixed_precision",
+        default="no",
+        type=str,
+        choices=["no", "bf16", "fp16"],
+        help="Native torch.autocast mixed precision training (bf16 also works on CPU, fp16 uses loss scaling)",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="Recompute the activations of the encoder layers below --align_layer in the backward pass",
+    )
     parser.add_argument(
         "--fp16_opt_level",
         type=str,
@@ -923,6 +1206,13 @@ def main():
             "Cannot do evaluation without an evaluation data file. Either supply a file to --eval_data_file "
             "or remove the --do_eval argument."
         )
+    if (args.early_stopping_patience > 0 or args.keep_best_checkpoints > 0) and not (
+        args.eval_gold_file and args.logging_steps > 0
+    ):
+        raise ValueError(
+            "--early_stopping_patience and --keep_best_checkpoints need a dev AER: supply --eval_gold_file "
+            "and a positive --logging_steps."
+        )
     if args.should_continue:
         sorted_checkpoints = _sorted_checkpoints(args)
         if len(sorted_checkpoints) == 0:
@@ -1045,11 +1335,7 @@ def main():
 
     if args.do_test:
         # extract word alignment for all layers
-        if args.adapter_path:
-            labse_model.load_adapter(args.adapter_path)
-            labse_model.set_active_adapters("alignment_adapter")
-        model = modelforALING(args, config, labse_model)
-        model.to(args.device)
+        model = prepare_inference_model(args, config, labse_model)
 
         # debugpy.listen(("0.0.0.0", 5678))
         # debugpy.wait_for_client()
@@ -1058,6 +1344,18 @@ def main():
         folder_path = args.infer_path
         if not os.path.exists(folder_path):
             os.makedirs(folder_path)
+
+        embedding_cache = None
+        if args.embedding_cache_dir:
+            embedding_cache = EmbeddingCache(
+                args.embedding_cache_dir,
+                checkpoint_fingerprint(
+                    args.model_name_or_path,
+                    args.adapter_path,
+                    args.align_layer,
+                    args.inference_dtype,
+                ),
+            )
         word_align(
             args,
             tokenizer,
@@ -1068,6 +1366,7 @@ def main():
             args.device,
             args.infer_filename,
             args.align_layer,
+            embedding_cache=embedding_cache,
         )
 
 
@@ -17,14 +17,21 @@
 WEIGHTS_NAME = "pytorch_model.bin"
 
 import os
+import contextlib
+import functools
 import glob
+import json
 import re
 import shutil
 from typing import Dict, List, Tuple
 import logging
 import math
+import random
+import resource
+import sys
 import torch
 from torch.optim import Optimizer
+from torch.utils.data import Sampler
 from torch.optim.lr_scheduler import LambdaLR
 
 import logging
@@ -34,6 +41,60 @@ import os
 logger = logging.getLogger(__name__)
 
 
+class _UntrackedStage(object):
+    def add_items(self, n):
+        pass
+
+
+_warned_untracked = False
+
+
+def _stage_utils():
+    """devil_in_details.utils, or None (with a warning on the first call) if it cannot be imported."""
+    global _warned_untracked
+    try:
+        from devil_in_details import utils
+    except ImportError as e:
+        if not _warned_untracked:
+            logger.warning(
+                "Stages are not tracked and no run report is written, devil_in_details cannot be imported (%s)", e
+            )
+            _warned_untracked = True
+        return None
+    return utils
+
+
+def track_stage(name, unit="items"):
+    """devil_in_details.utils.track_stage if the package is installed, otherwise a no-op.
+
+    Imported on first use, not with this module: importing devil_in_details.utils configures
+    the root logger, which would turn the logging.basicConfig of the scripts into a no-op.
+    """
+    utils = _stage_utils()
+    if utils is None:
+        return contextlib.nullcontext(_UntrackedStage())
+    return utils.track_stage(name, unit)
+
+
+def current_stage():
+    """devil_in_details.utils.current_stage if the package is installed, see track_stage."""
+    utils = _stage_utils()
+    if utils is None:
+        return _UntrackedStage()
+    return utils.current_stage()
+
+
+def timed_stage(name, unit="items"):
+    """Decorator tracking every call of a function with track_stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_stage(name, unit):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def get_logger(name: Text, filename: Text = None, level: int = logging.DEBUG) -> logging.Logger:
     logger = logging.getLogger(name)
     logger.setLevel(level)
@@ -52,10 +113,147 @@ def get_logger(name: Text, filename: Text = None, level: int = logging.DEBUG) ->
 
     return logger
 
-def _sorted_checkpoints(args, checkpoint_prefix="checkpoint", use_mtime=False) -> List[str]:
+def peak_memory_mb(device):
+    # Peak allocated GPU memory, or the peak resident set size of the process on CPU
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # Stage tracking resets ru_maxrss with the high water mark of the RSS, it is only active once imported
+    stage_utils = sys.modules.get("devil_in_details.utils")
+    if stage_utils is not None:
+        return stage_utils.process_peak_rss_mb()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Length-grouped batches whose padded size stays within a token budget.
+
+    The cost of a batch is its number of examples times its longest example, where the
+    length of an example is src_len + tgt_len. With shuffle, the examples are shuffled,
+    sorted by length within buckets of bucket_size examples and the batch order is
+    shuffled again, with a new order on every pass. Without shuffle, all examples are
+    sorted by length once and the batches are the same on every pass.
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None, shuffle=True, bucket_size=1000, seed=0,
+                 num_replicas=1, rank=0):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        num_examples = len(self.lengths)
+        if self.shuffle:
+            rng = random.Random(self.seed + self.epoch)
+            indices = list(range(num_examples))
+            rng.shuffle(indices)
+            buckets = [
+                sorted(indices[start:start + self.bucket_size], key=self.lengths.__getitem__)
+                for start in range(0, num_examples, self.bucket_size)
+            ]
+        else:
+            buckets = [sorted(range(num_examples), key=self.lengths.__getitem__)]
+
+        batches = []
+        for bucket in buckets:
+            batch, batch_max = [], 0
+            for i in bucket:
+                new_max = max(batch_max, self.lengths[i])
+                # An example longer than the budget still gets a batch of its own
+                if batch and (
+                    new_max * (len(batch) + 1) > self.max_tokens
+                    or (self.max_batch_size and len(batch) >= self.max_batch_size)
+                ):
+                    batches.append(batch)
+                    batch, new_max = [], self.lengths[i]
+                batch.append(i)
+                batch_max = new_max
+            if batch:
+                batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        if self.num_replicas > 1:
+            # Every replica needs the same number of batches
+            batches += batches[:(-len(batches)) % self.num_replicas]
+            batches = batches[self.rank::self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        if self.shuffle:
+            self.epoch += 1
+        return iter(batches)
+
+    def __len__(self):
+        return len(self._batches())
+
+
+class DevAERTracker(object):
+    """Early stopping and keep-best-K checkpoint retention on the dev AER of a training run.
+
+    An evaluation improves on the best AER so far if it is lower by more than min_delta.
+    After patience evaluations in a row without an improvement, should_stop is set
+    (patience <= 0 never stops). With keep_best > 0, the adapter of every evaluation that
+    ranks among the keep_best lowest AERs is saved to <output_dir>/best-<step>, the
+    checkpoint that drops out of the ranking is deleted and the ranking is written to
+    <output_dir>/best_checkpoints.json.
+    """
+
+    def __init__(self, output_dir, patience=0, min_delta=0.0, keep_best=0):
+        self.output_dir = output_dir
+        self.patience = patience
+        self.min_delta = min_delta
+        self.keep_best = keep_best
+        self.best_aer = math.inf
+        self.best_step = None
+        self.num_bad_evaluations = 0
+        self.should_stop = False
+        # (aer, step, path) of the kept checkpoints, best first
+        self.checkpoints = []
+
+    def update(self, global_step, aer, save_fn):
+        """Record the dev AER at global_step, save_fn(path) saves the current adapter to path."""
+        if aer < self.best_aer - self.min_delta:
+            self.best_aer, self.best_step = aer, global_step
+            self.num_bad_evaluations = 0
+        else:
+            self.num_bad_evaluations += 1
+            if self.patience > 0 and self.num_bad_evaluations >= self.patience:
+                self.should_stop = True
+                logger.info(
+                    "Early stopping at step %d: no AER improvement in %d evaluations, best AER = %.2f%% at step %d",
+                    global_step, self.num_bad_evaluations, self.best_aer * 100.0, self.best_step,
+                )
+
+        if self.keep_best > 0 and (len(self.checkpoints) < self.keep_best or aer < self.checkpoints[-1][0]):
+            path = os.path.join(self.output_dir, "best-{}".format(global_step))
+            # save_adapter only creates the last directory of the path
+            os.makedirs(self.output_dir, exist_ok=True)
+            save_fn(path)
+            self.checkpoints.append((aer, global_step, path))
+            self.checkpoints.sort()
+            for _, _, dropped_path in self.checkpoints[self.keep_best:]:
+                logger.info("Deleting checkpoint [{}] due to args.keep_best_checkpoints".format(dropped_path))
+                shutil.rmtree(dropped_path, ignore_errors=True)
+            del self.checkpoints[self.keep_best:]
+            with open(os.path.join(self.output_dir, "best_checkpoints.json"), "w", encoding="utf-8") as f:
+                json.dump([{"step": step, "aer": aer, "path": path} for aer, step, path in self.checkpoints], f, indent=2)
+        return self.should_stop
+
+
+def _sorted_checkpoints(args, checkpoint_prefix="checkpoint", use_mtime=False, output_dir=None) -> List[str]:
     ordering_and_checkpoint_path = []
 
-    glob_checkpoints = glob.glob(os.path.join(args.output_dir, "{}-*".format(checkpoint_prefix)))
+    glob_checkpoints = glob.glob(os.path.join(output_dir or args.output_dir, "{}-*".format(checkpoint_prefix)))
 
     for path in glob_checkpoints:
         if use_mtime:
@@ -69,14 +267,14 @@ def _sorted_checkpoints(args, checkpoint_prefix="checkpoint", use_mtime=False) -
     checkpoints_sorted = [checkpoint[1] for checkpoint in checkpoints_sorted]
     return checkpoints_sorted
 
-def _rotate_checkpoints(args, checkpoint_prefix="checkpoint", use_mtime=False) -> None:
+def _rotate_checkpoints(args, checkpoint_prefix="checkpoint", use_mtime=False, output_dir=None) -> None:
     if not args.save_total_limit:
         return
     if args.save_total_limit <= 0:
         return
 
     # Check if we should delete older checkpoint(s)
-    checkpoints_sorted = _sorted_checkpoints(args, checkpoint_prefix, use_mtime)
+    checkpoints_sorted = _sorted_checkpoints(args, checkpoint_prefix, use_mtime, output_dir)
     if len(checkpoints_sorted) <= args.save_total_limit:
         return
 
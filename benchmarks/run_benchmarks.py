@@ -0,0 +1,331 @@
+"""Benchmarks of the CPU-bound pipeline stages on synthetic corpora (see synthetic.py).
+
+Every benchmark prepares its inputs once per corpus (not timed) and then times --repeats
+calls. The minimum is reported together with the throughput in original tokens per second,
+since it is the timing least affected by other load on the machine (the median is stored as
+well). Results can be stored as a baseline and later runs compared against it; a benchmark
+whose minimum is more than --tolerance slower than the baseline counts as a regression.
+Benchmarks faster than --min_time in the baseline are dominated by timer and scheduling
+noise and are not compared, and a benchmark that looks like a regression is timed --repeats
+more times before it is reported, so that a single noisy period does not fail the comparison.
+
+    python benchmarks/run_benchmarks.py --num_tokens 100000 1000000 --num_labels 7 69 --save_baseline benchmarks/baselines/local.json
+    python benchmarks/run_benchmarks.py --num_tokens 100000 1000000 --num_labels 7 69 --compare benchmarks/baselines/local.json
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import torch
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# AccAlign scripts import each other directly
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "AccAlign"))
+
+from devil_in_details import utils
+from synthetic import (
+    generate_corpus,
+    generate_gold_alignments,
+    generate_logits,
+    ttest_dataset,
+    ttest_files,
+    ttrain_files,
+)
+
+# name -> setup(corpus, tmp_dir, args), which returns the function that is timed
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+class SkipBenchmark(Exception):
+    """Raised by a setup if the benchmark cannot run here (e.g. a missing dependency)."""
+
+
+def benchmark(name: str) -> Callable:
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+@benchmark("utils.load_jsonl")
+def setup_load_jsonl(corpus, tmp_dir, args):
+    path = os.path.join(tmp_dir, "original.jsonl")
+    utils.save_jsonl(ttrain_files(corpus)[0], path)
+    return lambda: utils.load_jsonl(path)
+
+
+@benchmark("utils.save_jsonl")
+def setup_save_jsonl(corpus, tmp_dir, args):
+    data = ttrain_files(corpus)[0]
+    return lambda: utils.save_jsonl(data, os.path.join(tmp_dir, "saved.jsonl"))
+
+
+@benchmark("utils.load_text_lines")
+def setup_load_text_lines(corpus, tmp_dir, args):
+    path = os.path.join(tmp_dir, "translated-tokens.txt")
+    utils.save_text_lines(ttrain_files(corpus)[1], path)
+    return lambda: utils.load_text_lines(path)
+
+
+@benchmark("utils.save_text_lines")
+def setup_save_text_lines(corpus, tmp_dir, args):
+    lines = ttrain_files(corpus)[1]
+    return lambda: utils.save_text_lines(lines, os.path.join(tmp_dir, "saved.txt"))
+
+
+@benchmark("utils.parse_alignment_line")
+def setup_parse_alignment_line(corpus, tmp_dir, args):
+    lines = ttrain_files(corpus)[2]
+    return lambda: [utils.parse_alignment_line(line) for line in lines]
+
+
+@benchmark("utils.extract_entity_indices")
+def setup_extract_entity_indices(corpus, tmp_dir, args):
+    return lambda: [utils.extract_entity_indices(tags) for tags in corpus["tags"]]
+
+
+@benchmark("postprocess_alignment_ttrain")
+def setup_postprocess_ttrain(corpus, tmp_dir, args):
+    from devil_in_details.alignment.postprocess_alignment_ttrain import postprocess_bio_alignment
+
+    original, translated, alignment_lines = ttrain_files(corpus)
+    paths = [os.path.join(tmp_dir, name) for name in ("original.jsonl", "translated.txt", "alignment.txt.6")]
+    utils.save_jsonl(original, paths[0])
+    utils.save_text_lines(translated, paths[1])
+    utils.save_text_lines(alignment_lines, paths[2])
+    return lambda: postprocess_bio_alignment(
+        *paths,
+        os.path.join(tmp_dir, "ttrain.jsonl"),
+        complete_source=True,
+        complete_target=True,
+        complete_instance=True,
+    )
+
+
+@benchmark("postprocess_alignment_ttest")
+def setup_postprocess_ttest(corpus, tmp_dir, args):
+    from devil_in_details.alignment.postprocess_alignment_ttest import postprocess_bio_alignment
+
+    translated, original, alignment_lines = ttest_files(corpus)
+    paths = [os.path.join(tmp_dir, name) for name in ("translated.txt", "original.jsonl", "alignment.txt.6")]
+    utils.save_text_lines(translated, paths[0])
+    utils.save_jsonl(original, paths[1])
+    utils.save_text_lines(alignment_lines, paths[2])
+    return lambda: postprocess_bio_alignment(*paths, os.path.join(tmp_dir, "ttest.jsonl"))
+
+
+@benchmark("project_translate_test_logits")
+def setup_project_logits(corpus, tmp_dir, args):
+    from transformers import AutoTokenizer
+    from devil_in_details.evaluation.project_translate_test_logits_bio import project_translate_test_logits_bio
+
+    try:
+        AutoTokenizer.from_pretrained(args.tokenizer_path)
+    except OSError as e:
+        raise SkipBenchmark(f"tokenizer {args.tokenizer_path} not available ({str(e).splitlines()[0]})")
+    dataset_path = os.path.join(tmp_dir, "ttest-dataset.jsonl")
+    logit_path = os.path.join(tmp_dir, "translated_logits.pt")
+    utils.save_jsonl(ttest_dataset(corpus), dataset_path)
+    torch.save(generate_logits(corpus["translated_tags"], corpus["num_labels"], args.seed), logit_path)
+    return lambda: project_translate_test_logits_bio(
+        dataset_path,
+        logit_path,
+        os.path.join(tmp_dir, "projected_logits.pt"),
+        num_labels=corpus["num_labels"],
+        tokenizer_path=args.tokenizer_path,
+        restrict_target=True,
+    )
+
+
+@benchmark("evaluate.ensemble_predictions")
+def setup_ensemble_predictions(corpus, tmp_dir, args):
+    try:
+        from devil_in_details.evaluation.evaluate_bio import ensemble_predictions
+    except ImportError as e:
+        raise SkipBenchmark(str(e))
+
+    first_logits = generate_logits(corpus["tags"], corpus["num_labels"], args.seed)
+    # Projected logits: unmapped tokens are marked with sys.maxsize for label 0
+    unmapped = torch.zeros(corpus["num_labels"])
+    unmapped[0] = sys.maxsize
+    rng = random.Random(args.seed)
+    second_logits = [
+        [unmapped if rng.random() < 0.3 else token for token in sentence]
+        for sentence in generate_logits(corpus["tags"], corpus["num_labels"], args.seed + 1)
+    ]
+    all_logits = {0: first_logits, 1: second_logits}
+    return lambda: ensemble_predictions(all_logits, replace_second_logits=True)
+
+
+@benchmark("aer.calculate_metrics")
+def setup_calculate_metrics(corpus, tmp_dir, args):
+    from aer import calculate_metrics
+
+    sure, possible, hypothesis = generate_gold_alignments(corpus["alignments"], args.seed)
+    return lambda: calculate_metrics(sure, possible, hypothesis, 0.5)
+
+
+@benchmark("aer.calculate_aer")
+def setup_calculate_aer(corpus, tmp_dir, args):
+    from aer import calculate_aer
+
+    sure, possible, hypothesis = generate_gold_alignments(corpus["alignments"], args.seed)
+    return lambda: calculate_aer(sure, possible, hypothesis)
+
+
+def time_calls(func: Callable, repeats: int) -> List[float]:
+    # As timeit, without garbage collections triggered by earlier calls
+    timings = []
+    for _ in range(repeats):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return timings
+
+
+def summarize(timings: List[float], corpus_tokens: int) -> Dict[str, float]:
+    return {
+        "median": statistics.median(timings),
+        "min": min(timings),
+        "repeats": len(timings),
+        "tokens_per_sec": corpus_tokens / min(timings),
+    }
+
+
+def is_regression(result: Dict[str, Any], expected: Dict[str, Any], tolerance: float, min_time: float) -> bool:
+    return "min" in expected and expected["min"] >= min_time and result["min"] > (1.0 + tolerance) * expected["min"]
+
+
+def machine_info() -> Dict[str, Any]:
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+    }
+
+
+def save_report(report: Dict[str, Any], path: str) -> None:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], tolerance: float, min_time: float) -> int:
+    """Print the change of every benchmark against the baseline, returns the number of regressions."""
+    if baseline["machine"] != machine_info():
+        print(f"Warning: baseline from a different machine: {baseline['machine']}")
+    regressions = 0
+    for key, result in results.items():
+        if "min" not in result:
+            continue
+        expected = baseline["results"].get(key, {})
+        if "min" not in expected:
+            print(f"{key:<70} not in the baseline")
+            continue
+        if expected["min"] < min_time:
+            print(f"{key:<70} below --min_time, not compared")
+            continue
+        ratio = result["min"] / expected["min"]
+        regression = is_regression(result, expected, tolerance, min_time)
+        regressions += regression
+        print(f"{key:<70} {ratio:6.2f}x{'  REGRESSION' if regression else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic corpora")
+    parser.add_argument(
+        "--num_tokens", type=int, nargs="+", default=[100000, 1000000], help="Corpus sizes in original tokens (e.g. 10000 to 10000000)"
+    )
+    parser.add_argument(
+        "--num_labels", type=int, nargs="+", default=[7, 69], help="Numbers of BIO labels (7 for MasakhaNER, 69 for xSID)"
+    )
+    parser.add_argument("--benchmarks", nargs="+", default=None, help="Only run benchmarks containing one of these names")
+    parser.add_argument("--repeats", type=int, default=10, help="Timed calls per benchmark, the minimum is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--tokenizer_path", default="FacebookAI/xlm-roberta-large", help="Tokenizer for project_translate_test_logits"
+    )
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--save_baseline", default=None, help="Store the results as baseline (JSON)")
+    parser.add_argument("--compare", default=None, help="Compare against this baseline, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline")
+    parser.add_argument(
+        "--min_time", type=float, default=0.05, help="Benchmarks faster than this in the baseline (seconds) are not compared"
+    )
+    args = parser.parse_args()
+
+    # The benchmarked functions log every call
+    logging.disable(logging.WARNING)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    names = [
+        name for name in BENCHMARKS if args.benchmarks is None or any(pattern in name for pattern in args.benchmarks)
+    ]
+    results = {}
+    for num_tokens in args.num_tokens:
+        for num_labels in args.num_labels:
+            corpus = generate_corpus(num_tokens, num_labels, args.seed)
+            corpus_tokens = sum(len(tokens) for tokens in corpus["tokens"])
+            for name in names:
+                key = f"{name}[tokens={num_tokens},labels={num_labels}]"
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    try:
+                        func = BENCHMARKS[name](corpus, tmp_dir, args)
+                    except SkipBenchmark as e:
+                        print(f"{key:<70} skipped: {e}")
+                        results[key] = {"skipped": str(e)}
+                        continue
+                    timings = time_calls(func, args.repeats)
+                    result = summarize(timings, corpus_tokens)
+                    expected = baseline["results"].get(key, {}) if baseline else {}
+                    if is_regression(result, expected, args.tolerance, args.min_time):
+                        # Confirm the slowdown, the machine may just have been busy
+                        timings += time_calls(func, args.repeats)
+                        result = summarize(timings, corpus_tokens)
+                results[key] = result
+                print(f"{key:<70} {result['min']:10.4f}s {result['tokens_per_sec']:14,.0f} tokens/s")
+
+    report = {"machine": machine_info(), "repeats": args.repeats, "seed": args.seed, "results": results}
+    if args.output:
+        save_report(report, args.output)
+    if args.save_baseline:
+        # A baseline only holds timings, skipped benchmarks would never be compared
+        skipped = [key for key, result in results.items() if "skipped" in result]
+        if skipped:
+            print(f"Warning: {len(skipped)} skipped benchmark(s) are not in the baseline, install the full requirements")
+        timed = {key: result for key, result in results.items() if "skipped" not in result}
+        save_report(dict(report, results=timed), args.save_baseline)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance, args.min_time)
+        if regressions:
+            print(f"{regressions} regression(s) against {args.compare}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
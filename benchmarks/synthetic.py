@@ -0,0 +1,185 @@
+"""Synthetic BIO corpora, word alignments and logits for the benchmarks.
+
+The data has the shape of the real data but no meaning: Zipf-distributed words, BIO tags
+with 1-3 token entities (tag 0 is O, 2k+1 B- and 2k+2 I- of entity type k, as in ID2LABEL),
+translations about as long as the original sentences with near-diagonal alignments, and
+logits whose argmax is the label most of the time. Generation is seeded and deterministic.
+"""
+
+import argparse
+import os
+import string
+from typing import Any, Dict, List, Set, Tuple
+
+import numpy as np
+import torch
+
+from devil_in_details.utils import save_jsonl, save_text_lines
+
+VOCAB_SIZE = 5000
+MIN_SENTENCE_LENGTH, MAX_SENTENCE_LENGTH = 5, 40
+
+
+def make_vocab(rng: np.random.Generator, size: int = VOCAB_SIZE) -> List[str]:
+    letters = np.array(list(string.ascii_lowercase))
+    return ["".join(rng.choice(letters, size=rng.integers(2, 10))) for _ in range(size)]
+
+
+def sample_words(rng: np.random.Generator, vocab: List[str], n: int) -> List[str]:
+    # Zipf-like word frequencies, clipped to the vocabulary
+    ids = np.minimum(rng.zipf(1.3, size=n), len(vocab)) - 1
+    return [vocab[i] for i in ids]
+
+
+def sample_bio_tags(rng: np.random.Generator, length: int, num_labels: int, entity_rate: float = 0.1) -> List[int]:
+    tags = [0] * length
+    num_types = (num_labels - 1) // 2
+    i = 0
+    while i < length:
+        if rng.random() < entity_rate:
+            entity_type = int(rng.integers(num_types))
+            entity_length = min(int(rng.integers(1, 4)), length - i)
+            tags[i] = 2 * entity_type + 1
+            for j in range(i + 1, i + entity_length):
+                tags[j] = 2 * entity_type + 2
+            i += entity_length
+        else:
+            i += 1
+    return tags
+
+
+def sample_alignment(rng: np.random.Generator, src_len: int, trg_len: int, drop_rate: float = 0.1) -> List[List[int]]:
+    """Near-diagonal [src_idx, trg_idx] pairs, some source words unaligned or aligned twice."""
+    pairs = set()
+    for i in range(src_len):
+        if rng.random() < drop_rate:
+            continue
+        j = round(i * (trg_len - 1) / max(src_len - 1, 1)) + int(rng.integers(-1, 2))
+        j = min(max(j, 0), trg_len - 1)
+        pairs.add((i, j))
+        if rng.random() < drop_rate and j + 1 < trg_len:
+            pairs.add((i, j + 1))
+    return [list(pair) for pair in sorted(pairs)]
+
+
+def generate_corpus(num_tokens: int, num_labels: int = 7, seed: int = 0) -> Dict[str, Any]:
+    """Parallel corpus with about num_tokens original tokens.
+
+    Returns a dict with the original sentences ("tokens", "tags"), their translations
+    ("translated_tokens", "translated_tags" for the logits of a downstream model) and the
+    alignments from original to translated tokens ("alignments").
+    """
+    rng = np.random.default_rng(seed)
+    vocab = make_vocab(rng)
+    corpus = {
+        "num_labels": num_labels,
+        "tokens": [],
+        "tags": [],
+        "translated_tokens": [],
+        "translated_tags": [],
+        "alignments": [],
+    }
+    total = 0
+    while total < num_tokens:
+        length = int(rng.integers(MIN_SENTENCE_LENGTH, MAX_SENTENCE_LENGTH + 1))
+        translated_length = max(1, length + int(rng.integers(-length // 5, length // 5 + 1)))
+        corpus["tokens"].append(sample_words(rng, vocab, length))
+        corpus["tags"].append(sample_bio_tags(rng, length, num_labels))
+        corpus["translated_tokens"].append(sample_words(rng, vocab, translated_length))
+        corpus["translated_tags"].append(sample_bio_tags(rng, translated_length, num_labels))
+        corpus["alignments"].append(sample_alignment(rng, length, translated_length))
+        total += length
+    return corpus
+
+
+def generate_logits(tags: List[List[int]], num_labels: int, seed: int = 0, noise: float = 0.1) -> List[List[torch.Tensor]]:
+    """Logits as saved for the downstream models: a list of num_labels tensors per sentence.
+    The argmax is the tag except for a fraction noise of the tokens."""
+    generator = torch.Generator().manual_seed(seed)
+    logits = []
+    for sentence_tags in tags:
+        sentence_logits = torch.randn(len(sentence_tags), num_labels, generator=generator)
+        keep = torch.rand(len(sentence_tags), generator=generator) >= noise
+        rows = torch.arange(len(sentence_tags))[keep]
+        sentence_logits[rows, torch.tensor(sentence_tags, dtype=torch.long)[keep]] += 5.0
+        logits.append(list(sentence_logits.unbind(0)))
+    return logits
+
+
+def generate_gold_alignments(
+    alignments: List[List[List[int]]], seed: int = 0, possible_rate: float = 0.2, error_rate: float = 0.15
+) -> Tuple[List[Set[Tuple[int, int]]], List[Set[Tuple[int, int]]], List[Set[Tuple[int, int]]]]:
+    """Sure and possible reference links and a hypothesis with errors, in the format of aer.read_reference."""
+    rng = np.random.default_rng(seed)
+    sure, possible, hypothesis = [], [], []
+    for pairs in alignments:
+        links = [tuple(pair) for pair in pairs]
+        is_possible = rng.random(len(links)) < possible_rate
+        sure.append({link for link, p in zip(links, is_possible) if not p})
+        possible.append(set(links))
+        wrong = rng.random(len(links)) < error_rate
+        hypothesis.append({(s, t + 1) if w else (s, t) for (s, t), w in zip(links, wrong)})
+    return sure, possible, hypothesis
+
+
+def ttrain_files(corpus: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], List[str], List[str]]:
+    """Inputs of postprocess_alignment_ttrain: original data, translated alignment input and alignment lines."""
+    original = [{"tokens": tokens, "ner_tags": tags} for tokens, tags in zip(corpus["tokens"], corpus["tags"])]
+    translated = [" ".join(tokens) for tokens in corpus["translated_tokens"]]
+    return original, translated, [format_alignment(pairs) for pairs in corpus["alignments"]]
+
+
+def ttest_files(corpus: Dict[str, Any]) -> Tuple[List[str], List[Dict[str, Any]], List[str]]:
+    """Inputs of postprocess_alignment_ttest: the translation (English) is the source of the alignment."""
+    translated = [" ".join(tokens) for tokens in corpus["translated_tokens"]]
+    original = [{"tokens": tokens, "ner_tags": tags} for tokens, tags in zip(corpus["tokens"], corpus["tags"])]
+    inverted = [format_alignment(sorted([t, s] for s, t in pairs)) for pairs in corpus["alignments"]]
+    return translated, original, inverted
+
+
+def ttest_dataset(corpus: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Output of postprocess_alignment_ttest, the input of the logit projection."""
+    return [
+        {
+            "tokens": translated,
+            "ner_tags": [0] * len(translated),
+            "org_tokens": tokens,
+            "org_ner_tags": tags,
+            "alignment": sorted([t, s] for s, t in pairs),
+        }
+        for tokens, tags, translated, pairs in zip(
+            corpus["tokens"], corpus["tags"], corpus["translated_tokens"], corpus["alignments"]
+        )
+    ]
+
+
+def format_alignment(pairs: List[List[int]]) -> str:
+    return " ".join(f"{s}-{t}" for s, t in pairs)
+
+
+def write_corpus(out_dir: str, corpus: Dict[str, Any], seed: int = 0) -> None:
+    """Write the corpus in the formats of the pipeline: original.jsonl, original-tokens.txt and
+    translated-tokens.txt (alignment inputs), alignment.txt.6, ttest-dataset.jsonl (input of the
+    projection) and the logits of a downstream model on both sides (*_logits.pt)."""
+    original, translated, alignment_lines = ttrain_files(corpus)
+    save_jsonl(original, os.path.join(out_dir, "original.jsonl"))
+    save_text_lines([" ".join(tokens) for tokens in corpus["tokens"]], os.path.join(out_dir, "original-tokens.txt"))
+    save_text_lines(translated, os.path.join(out_dir, "translated-tokens.txt"))
+    save_text_lines(alignment_lines, os.path.join(out_dir, "alignment.txt.6"))
+    save_jsonl(ttest_dataset(corpus), os.path.join(out_dir, "ttest-dataset.jsonl"))
+    torch.save(
+        generate_logits(corpus["translated_tags"], corpus["num_labels"], seed),
+        os.path.join(out_dir, "translated_logits.pt"),
+    )
+    torch.save(generate_logits(corpus["tags"], corpus["num_labels"], seed), os.path.join(out_dir, "original_logits.pt"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic corpus, its alignments and logits")
+    parser.add_argument("out_dir", help="Output directory")
+    parser.add_argument("--num_tokens", type=int, default=100000, help="Approximate number of original tokens")
+    parser.add_argument("--num_labels", type=int, default=7, help="Number of BIO labels (7 for MasakhaNER, 69 for xSID)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    write_corpus(args.out_dir, generate_corpus(args.num_tokens, args.num_labels, args.seed), args.seed)
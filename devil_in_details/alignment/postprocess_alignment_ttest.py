@@ -1,11 +1,19 @@
 import argparse
 import logging
-from devil_in_details.utils import load_jsonl, load_text_lines, save_jsonl, parse_alignment_line
+from devil_in_details.utils import (
+    load_jsonl,
+    load_text_lines,
+    save_jsonl,
+    parse_alignment_line,
+    timed_stage,
+    current_stage,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+@timed_stage("postprocess_alignment_ttest", unit="sentences")
 def postprocess_bio_alignment(
     source_file: str,
     target_file: str,
@@ -28,6 +36,7 @@ def postprocess_bio_alignment(
             f"target={len(target_data)}, alignment={len(alignment_out_data)}"
         )
 
+    current_stage().add_items(len(source_data))
     processed_data = []
     for idx, (src_line, trg_line, alignment_line) in enumerate(
         zip(source_data, target_data, alignment_out_data)
@@ -8,6 +8,8 @@ from devil_in_details.utils import (
     save_jsonl,
     parse_alignment_line,
     build_alignment_mapping,
+    timed_stage,
+    current_stage,
 )
 
 from collections import Counter
@@ -125,6 +127,7 @@ def validate_instance_completeness(
     return True
 
 
+@timed_stage("postprocess_alignment_ttrain", unit="sentences")
 def postprocess_bio_alignment(
     source_file: str,
     target_file: str,
@@ -150,6 +153,7 @@ def postprocess_bio_alignment(
             f"target={len(target_data)}, alignment={len(alignment_out_data)}"
         )
 
+    current_stage().add_items(len(source_data))
     corrupted_indices = []
     processed_data = []
     for idx, (src_line, trg_line, alignment_line) in enumerate(
@@ -1,9 +1,154 @@
 import argparse
+import multiprocessing
+import os
+import sqlite3
+from typing import Dict, Iterable, List
 import jieba
+import sacremoses
 from sacremoses import MosesTokenizer
-from devil_in_details.utils import load_jsonl, save_text_lines
+from devil_in_details.utils import load_jsonl, save_text_lines, timed_stage, current_stage
 
 
+def get_translated_tokenizer(translated_lang, tokenizer="whitespace"):
+    """Function turning a translated line into the whitespace-tokenized alignment input."""
+    if translated_lang == "zh":
+        return lambda line: " ".join(jieba.cut(line))
+    if tokenizer == "moses":
+        moses_tokenizer = MosesTokenizer(lang=translated_lang)
+        return lambda line: moses_tokenizer.tokenize(
+            line, escape=False, return_str=True
+        )
+    # whitespace tokenization (default case)
+    return lambda line: line
+
+
+def tokenizer_key(translated_lang, tokenizer="whitespace"):
+    """Name and version of the tokenizer get_translated_tokenizer uses for a language."""
+    if translated_lang == "zh":
+        return f"jieba-{jieba.__version__}"
+    if tokenizer == "moses":
+        return f"moses-{sacremoses.__version__}"
+    return "whitespace"
+
+
+class TokenizationCache:
+    """Persistent SQLite cache of tokenized lines, keyed by (tokenizer, lang, text).
+
+    Shared between runs, e.g. the alignment inputs of different aligners, and between tasks.
+    """
+
+    # Stay below the SQLite limit of variables per statement
+    QUERY_SIZE = 500
+
+    def __init__(self, path: str, tokenizer: str, lang: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.tokenizer = tokenizer
+        self.lang = lang
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tokenized (tokenizer TEXT, lang TEXT, text TEXT, tokens TEXT, "
+            "PRIMARY KEY (tokenizer, lang, text))"
+        )
+
+    def get_many(self, texts: List[str]) -> Dict[str, str]:
+        cached = {}
+        for i in range(0, len(texts), self.QUERY_SIZE):
+            chunk = texts[i : i + self.QUERY_SIZE]
+            rows = self.connection.execute(
+                "SELECT text, tokens FROM tokenized WHERE tokenizer = ? AND lang = ? AND text IN ({})".format(
+                    ",".join("?" * len(chunk))
+                ),
+                [self.tokenizer, self.lang] + chunk,
+            )
+            cached.update(rows)
+        return cached
+
+    def put_many(self, tokenized: Dict[str, str]) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tokenized VALUES (?, ?, ?, ?)",
+                [
+                    (self.tokenizer, self.lang, text, tokens)
+                    for text, tokens in tokenized.items()
+                ],
+            )
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+# Tokenizer of a worker process of tokenize_translations
+_worker_tokenizer = None
+
+
+def _init_worker(translated_lang, tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = get_translated_tokenizer(translated_lang, tokenizer)
+
+
+def _tokenize_chunk(lines):
+    return [_worker_tokenizer(line) for line in lines]
+
+
+def tokenize_translations(
+    lines: Iterable[str],
+    translated_lang: str,
+    tokenizer: str = "whitespace",
+    num_workers: int = 1,
+    cache_file: str = None,
+    chunk_size: int = 1000,
+) -> List[str]:
+    """Alignment input of translated lines, see get_translated_tokenizer.
+
+    Every distinct line is tokenized once: lines found in the cache_file are reused and
+    the others are tokenized in chunks of chunk_size lines by num_workers processes.
+
+    Args:
+        lines: Translated lines
+        translated_lang: Language of the translations
+        tokenizer: 'moses' or 'whitespace' (zh is always tokenized with jieba)
+        num_workers: Number of tokenization processes
+        cache_file: Path of the persistent TokenizationCache, None disables the cache
+        chunk_size: Lines per task of a worker process
+    """
+    lines = list(lines)
+    key = tokenizer_key(translated_lang, tokenizer)
+    if key == "whitespace":
+        return lines
+
+    cache = TokenizationCache(cache_file, key, translated_lang) if cache_file else None
+    distinct_lines = list(dict.fromkeys(lines))
+    tokenized = cache.get_many(distinct_lines) if cache is not None else {}
+    missing = [line for line in distinct_lines if line not in tokenized]
+
+    if missing:
+        if num_workers > 1 and len(missing) > chunk_size:
+            chunks = [
+                missing[i : i + chunk_size] for i in range(0, len(missing), chunk_size)
+            ]
+            with multiprocessing.Pool(
+                num_workers,
+                initializer=_init_worker,
+                initargs=(translated_lang, tokenizer),
+            ) as pool:
+                results = [
+                    tokens for chunk in pool.imap(_tokenize_chunk, chunks) for tokens in chunk
+                ]
+        else:
+            translated_tokenizer = get_translated_tokenizer(translated_lang, tokenizer)
+            results = [translated_tokenizer(line) for line in missing]
+        new_tokenized = dict(zip(missing, results))
+        tokenized.update(new_tokenized)
+        if cache is not None:
+            cache.put_many(new_tokenized)
+
+    if cache is not None:
+        cache.close()
+    return [tokenized[line] for line in lines]
+
+
+@timed_stage("prepare_alignment", unit="sentences")
 def prepare_alignment_bio(
     original_file,  # path to jsonl
     original_text_column,
@@ -12,6 +157,8 @@ def prepare_alignment_bio(
     original_out_file,
     translated_out_file,
     tokenizer="whitespace",
+    num_workers=1,
+    tokenization_cache=None,
 ):
 
     # Parse input
@@ -29,26 +176,15 @@ def prepare_alignment_bio(
             f"original and translated files have different number of lines: {len(original_data)} vs {len(translated_data)}"
         )
 
-    if tokenizer == "moses":
-        translated_tokenizer = MosesTokenizer(lang=translated_lang)
-
-    original_alignment_in_lines = []
-    translated_alignment_in_lines = []
-
-    for org_line, trans_line in zip(original_data, translated_data):
-        org_alignment_in = " ".join(org_line)
-
-        if translated_lang == "zh":
-            trans_alignment_in = " ".join(jieba.cut(trans_line))
-        elif tokenizer == "moses":
-            trans_alignment_in = translated_tokenizer.tokenize(
-                trans_line, escape=False, return_str=True
-            )
-        else:  # whitespace tokenization (default case)
-            trans_alignment_in = trans_line
-
-        original_alignment_in_lines.append(org_alignment_in)
-        translated_alignment_in_lines.append(trans_alignment_in)
+    current_stage().add_items(len(original_data))
+    original_alignment_in_lines = [" ".join(org_line) for org_line in original_data]
+    translated_alignment_in_lines = tokenize_translations(
+        translated_data,
+        translated_lang,
+        tokenizer,
+        num_workers=num_workers,
+        cache_file=tokenization_cache,
+    )
 
     save_text_lines(original_alignment_in_lines, original_out_file)
     save_text_lines(translated_alignment_in_lines, translated_out_file)
@@ -76,6 +212,17 @@ if __name__ == "__main__":
         default="whitespace",
         help="Set to 'moses' to pretokenize with MosesTokenizer, zh will always be tokenized with jieba)",
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of processes tokenizing the translated data",
+    )
+    parser.add_argument(
+        "--tokenization_cache",
+        default=None,
+        help="SQLite file caching tokenized lines across runs (e.g. data/intermediate/tokenization_cache.sqlite)",
+    )
     args = parser.parse_args()
     prepare_alignment_bio(
         original_file=args.original_file,
@@ -85,4 +232,6 @@ if __name__ == "__main__":
         original_out_file=args.org_out_file,
         translated_out_file=args.trans_out_file,
         tokenizer=args.tokenizer,
+        num_workers=args.num_workers,
+        tokenization_cache=args.tokenization_cache,
     )
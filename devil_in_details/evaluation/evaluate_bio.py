@@ -1,7 +1,13 @@
 import argparse
 import sys
 from typing import Optional, List, Dict
-from devil_in_details.utils import save_text_lines, load_logits_with_retry, str_to_bool
+from devil_in_details.utils import (
+    save_text_lines,
+    load_logits_with_retry,
+    str_to_bool,
+    timed_stage,
+    current_stage,
+)
 import logging
 
 import torch
@@ -144,6 +150,7 @@ def ensemble_predictions(
     return ensemble_preds
 
 
+@timed_stage("evaluate", unit="examples")
 def evaluate_bio(
     task: str,
     dataset_path: str,
@@ -192,6 +199,7 @@ def evaluate_bio(
                     f"Logit length mismatch: model {idx} has {len(logits)} sequences, expected {first_length}"
                 )
 
+    current_stage().add_items(len(all_logits[0]))
     ensemble_preds = ensemble_predictions(all_logits, replace_second_logits)
 
     pred_labels = [
@@ -14,6 +14,8 @@ from devil_in_details.utils import (
     extract_entity_indices,
     load_logits_with_retry,
     build_alignment_mapping,
+    timed_stage,
+    current_stage,
 )
 
 
@@ -61,6 +63,7 @@ def map_entities(
     return target_indices
 
 
+@timed_stage("project_translate_test_logits", unit="examples")
 def project_translate_test_logits_bio(
     target_data_path,
     source_logit_path,
@@ -97,6 +100,7 @@ def project_translate_test_logits_bio(
             f"{len(all_source_logits)} logit sets"
         )
 
+    current_stage().add_items(len(all_source_logits))
     # Projecting logits
     total_entities = 0
     all_target_logits = []
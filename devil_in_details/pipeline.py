@@ -0,0 +1,527 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from devil_in_details.utils import RUN_REPORT_ENV
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+LANGS = {
+    "masakhaner": "bam ewe fon hau ibo kin lug luo mos nya sna swa tsn twi wol xho yor zul".split(),
+    "xsid": "ar da de de-st id it kk nl sr tr zh".split(),
+}
+
+
+class Stage:
+    """A command of the pipeline with its input and output files.
+
+    A stage is up to date if all its outputs exist and neither its command nor the content
+    of its inputs (including the script it runs) changed since it last succeeded.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        command: List[str],
+        inputs: List[str],
+        outputs: List[str],
+        cpus: int = 1,
+        memory_gb: float = 4.0,
+        gpus: int = 0,
+    ):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+        self.gpus = gpus
+        # Stages producing an input of this stage, set by PipelineRunner
+        self.deps: List[str] = []
+
+
+class PipelineRunner:
+    """Runs the stages of a DAG in parallel under CPU, memory and GPU limits.
+
+    Dependencies follow from the files: a stage depends on the stages producing its inputs.
+    Content hashes of the files (cached by size and mtime) and the fingerprints of the
+    stages that succeeded are kept in <state_dir>/pipeline_state.json, the output of every
+    stage is logged to <state_dir>/logs/<stage>.log. The timings of a run, including the run
+    reports of the stages (see devil_in_details.utils.track_stage), go to <state_dir>/run_report.json.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        work_dir: str,
+        state_dir: str,
+        max_cpus: int = os.cpu_count() or 1,
+        max_memory_gb: float = 16.0,
+        max_gpus: int = 0,
+        force: bool = False,
+        dry_run: bool = False,
+    ):
+        self.stages = {stage.name: stage for stage in stages}
+        self.work_dir = work_dir
+        self.state_dir = state_dir
+        self.limits = {"cpus": max_cpus, "memory_gb": max_memory_gb, "gpus": max_gpus}
+        self.force = force
+        self.dry_run = dry_run
+
+        producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in producers:
+                    raise ValueError(f"{output} is produced by {producers[output]} and {stage.name}")
+                producers[output] = stage.name
+        for stage in stages:
+            stage.deps = sorted({producers[path] for path in stage.inputs if path in producers})
+
+        self.state_file = os.path.join(state_dir, "pipeline_state.json")
+        self.state = {"stages": {}, "files": {}}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        self.lock = threading.Lock()
+        self.report: Dict[str, Dict[str, Any]] = {}
+
+    def _path(self, path: str) -> str:
+        return os.path.join(self.work_dir, path)
+
+    def file_digest(self, path: str) -> Optional[str]:
+        full_path = self._path(path)
+        if not os.path.exists(full_path):
+            return None
+        stat = os.stat(full_path)
+        cached = self.state["files"].get(path)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        sha1 = hashlib.sha1()
+        with open(full_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        self.state["files"][path] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+        return sha1.hexdigest()
+
+    def fingerprint(self, stage: Stage) -> str:
+        inputs = {path: self.file_digest(path) for path in stage.inputs}
+        return hashlib.sha1(
+            json.dumps({"command": stage.command, "inputs": inputs}, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def is_up_to_date(self, stage: Stage, fingerprint: str) -> bool:
+        return (
+            not self.force
+            and self.state["stages"].get(stage.name) == fingerprint
+            and all(os.path.exists(self._path(path)) for path in stage.outputs)
+        )
+
+    def _save_state(self) -> None:
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_file, self.state_file)
+
+    def _requirements(self, stage: Stage) -> Dict[str, float]:
+        # A stage needing more than a limit runs alone
+        return {
+            "cpus": min(stage.cpus, self.limits["cpus"]),
+            "memory_gb": min(stage.memory_gb, self.limits["memory_gb"]),
+            "gpus": min(stage.gpus, self.limits["gpus"]),
+        }
+
+    def _execute(self, stage: Stage) -> bool:
+        for path in stage.outputs:
+            os.makedirs(os.path.dirname(self._path(path)), exist_ok=True)
+        log_file = os.path.join(self.state_dir, "logs", f"{stage.name}.log")
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        report_file = os.path.join(self.state_dir, "reports", f"{stage.name}.jsonl")
+        if os.path.exists(report_file):
+            os.remove(report_file)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [self.work_dir, os.environ.get("PYTHONPATH")])))
+        env[RUN_REPORT_ENV] = report_file
+        start = time.time()
+        with open(log_file, "w", encoding="utf-8") as log:
+            returncode = subprocess.call(
+                stage.command, cwd=self.work_dir, env=env, stdout=log, stderr=subprocess.STDOUT
+            )
+        processes = []
+        if os.path.exists(report_file):
+            with open(report_file, "r", encoding="utf-8") as f:
+                processes = [json.loads(line) for line in f]
+        with self.lock:
+            self.report[stage.name] = {
+                "returncode": returncode,
+                "wall_time": round(time.time() - start, 4),
+                "processes": processes,
+            }
+        if returncode != 0:
+            logger.error(f"{stage.name} failed with exit code {returncode}, see {log_file}")
+            return False
+        missing = [path for path in stage.outputs if not os.path.exists(self._path(path))]
+        if missing:
+            logger.error(f"{stage.name} did not produce {missing}, see {log_file}")
+            return False
+        logger.info(f"{stage.name} finished in {time.time() - start:.1f}s")
+        return True
+
+    def run(self) -> bool:
+        """Run all stages that are not up to date, returns False if a stage failed."""
+        status = {}  # name -> "done", "failed" or "skipped"
+        rerun = set()  # Stages that ran or would run (dry run)
+        pending = list(self.stages)
+        running = {}
+        available = dict(self.limits)
+        start_time, start = datetime.now().isoformat(timespec="seconds"), time.time()
+        os.makedirs(self.state_dir, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as executor:
+            while pending or running:
+                for name in list(pending):
+                    stage = self.stages[name]
+                    if any(status.get(dep) in ("failed", "skipped") for dep in stage.deps):
+                        logger.warning(f"Skipping {name}, a dependency failed")
+                        status[name] = "skipped"
+                        pending.remove(name)
+                        continue
+                    if not all(status.get(dep) == "done" for dep in stage.deps):
+                        continue
+
+                    missing_inputs = [path for path in stage.inputs if not os.path.exists(self._path(path))]
+                    if self.dry_run:
+                        if (
+                            self.force
+                            or missing_inputs
+                            or any(dep in rerun for dep in stage.deps)
+                            or not self.is_up_to_date(stage, self.fingerprint(stage))
+                        ):
+                            logger.info(f"Would run {name}: {' '.join(stage.command)}")
+                            rerun.add(name)
+                        else:
+                            logger.info(f"Up to date: {name}")
+                        status[name] = "done"
+                        pending.remove(name)
+                        continue
+
+                    if missing_inputs:
+                        logger.error(f"Cannot run {name}, missing inputs {missing_inputs}")
+                        status[name] = "failed"
+                        pending.remove(name)
+                        continue
+                    fingerprint = self.fingerprint(stage)
+                    if self.is_up_to_date(stage, fingerprint):
+                        logger.info(f"Up to date: {name}")
+                        status[name] = "done"
+                        pending.remove(name)
+                        continue
+
+                    requirements = self._requirements(stage)
+                    if any(requirements[key] > available[key] for key in requirements):
+                        continue
+                    for key in requirements:
+                        available[key] -= requirements[key]
+                    logger.info(f"Running {name}")
+                    running[executor.submit(self._execute, stage)] = (name, fingerprint)
+                    pending.remove(name)
+
+                if not running:
+                    if pending and not any(
+                        all(status.get(dep) == "done" for dep in self.stages[name].deps) for name in pending
+                    ):
+                        raise RuntimeError(f"Unsatisfiable dependencies: {pending}")
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name, fingerprint = running.pop(future)
+                    for key, value in self._requirements(self.stages[name]).items():
+                        available[key] += value
+                    success = future.result()
+                    status[name] = "done" if success else "failed"
+                    with self.lock:
+                        if success:
+                            # Hash the outputs now, the next stages find them in the cache
+                            for path in self.stages[name].outputs:
+                                self.file_digest(path)
+                            self.state["stages"][name] = fingerprint
+                        else:
+                            self.state["stages"].pop(name, None)
+                        self._save_state()
+
+        if not self.dry_run:
+            with open(os.path.join(self.state_dir, "run_report.json"), "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "start_time": start_time,
+                        "wall_time": round(time.time() - start, 4),
+                        "status": status,
+                        "stages": self.report,
+                    },
+                    f,
+                    indent=2,
+                )
+
+        failed = sorted(name for name, result in status.items() if result != "done")
+        if failed:
+            logger.error(f"Failed or skipped stages: {failed}")
+        return not failed
+
+
+def python_stage(name: str, script: str, args: List[str], inputs: List[str], outputs: List[str], **resources) -> Stage:
+    """Stage running a script of the repository, the script itself is an input."""
+    return Stage(name, [sys.executable, script] + args, [script] + inputs, outputs, **resources)
+
+
+def build_stages(
+    task: str,
+    setting: str,
+    langs: List[str],
+    split: str,
+    nllb_model: str = "facebook/nllb-200-3.3B",
+    translation_batch_size: int = 8,
+    adapter_path: Optional[str] = None,
+    align_batch_size: int = 32,
+    tokenizer_path: str = "FacebookAI/xlm-roberta-large",
+    evaluate: bool = False,
+    eval_split: Optional[str] = None,
+) -> List[Stage]:
+    """Stages of the scripts/run_translation_*, scripts/acc_align_* and scripts/run_evaluation_* loops.
+
+    Translate-train (ttrain) translates the English data into every language, translate-test
+    (ttest) translates every language into English. All paths are relative to the work dir.
+    Like the scripts, AccAlign without an adapter writes to acc_noft-* files and the
+    accalign_noft datasets. Models trained on translate-train data are evaluated on the
+    translate-test dataset of eval_split (default: test), which a ttest run produces.
+    """
+    tag_args = ["--tag_name", "entity_tags"] if task == "xsid" else []
+    aligner, alignment_prefix = ("accalign", "acc") if adapter_path else ("accalign_noft", "acc_noft")
+    if setting == "ttest":
+        eval_split = split
+    elif eval_split is None:
+        eval_split = "test"
+    stages = {}
+
+    def add(stage: Stage) -> None:
+        # Stages shared by several languages (e.g. preprocessing of the English data) are added once
+        stages.setdefault(stage.name, stage)
+
+    for lang in langs:
+        if setting == "ttrain":
+            src_lang, trg_lang = "en", lang
+        else:
+            src_lang, trg_lang = lang, "en"
+        original_lang = src_lang
+        translated_lang = trg_lang
+        original_file = f"data/original/{task}/{split}-{original_lang}.jsonl"
+        preprocessed_file = f"data/original/{task}/{split}-{original_lang}/{split}-{original_lang}-tokens.jsonl"
+        name = f"{split}-translate-{src_lang}-{trg_lang}"
+        out_dir = f"data/intermediate/nllb/{task}/{name}"
+        translated_file = f"{out_dir}/{name}-tokens.jsonl"
+        processed_file = f"{out_dir}/{name}-tokens-processed.jsonl"
+        original_align_in = f"{out_dir}/{original_lang}-tokens.txt"
+        translated_align_in = f"{out_dir}/{translated_lang}-tokens.txt"
+        alignment_file = f"{alignment_prefix}-en-{lang}-tokens.txt"
+        alignment = f"{out_dir}/{alignment_file}.6"
+        dataset_file = f"data/final/nllb/{aligner}/{task}/{name}.jsonl"
+
+        add(
+            python_stage(
+                f"preprocess-{task}-{split}-{original_lang}",
+                "devil_in_details/translation/preprocess_translation.py",
+                [original_file, preprocessed_file, "tokens", original_lang],
+                [original_file],
+                [preprocessed_file],
+            )
+        )
+        # The translations are postprocessed while translating (--postprocess)
+        add(
+            python_stage(
+                f"translate-{task}-{name}",
+                "devil_in_details/translation/run_translation.py",
+                [
+                    preprocessed_file,
+                    translated_file,
+                    "--src_lang",
+                    src_lang,
+                    "--trg_lang",
+                    trg_lang,
+                    "--model",
+                    nllb_model,
+                    "--batch_size",
+                    str(translation_batch_size),
+                    "--device",
+                    "cuda",
+                    "--postprocess",
+                ],
+                [preprocessed_file],
+                [translated_file, processed_file],
+                memory_gb=16.0,
+                gpus=1,
+            )
+        )
+        add(
+            python_stage(
+                f"prepare_alignment-{task}-{name}",
+                "devil_in_details/alignment/prepare_alignment.py",
+                [original_file, "tokens", translated_lang, processed_file, original_align_in, translated_align_in]
+                + (["--tokenizer", "moses"] if setting == "ttest" else []),
+                [original_file, processed_file],
+                [original_align_in, translated_align_in],
+            )
+        )
+        # Alignment always from the English to the other side
+        align_src, align_tgt = (
+            (original_align_in, translated_align_in) if setting == "ttrain" else (translated_align_in, original_align_in)
+        )
+        add(
+            python_stage(
+                f"align-{task}-{name}",
+                "AccAlign/accalign_infer.py",
+                [
+                    "--output_dir",
+                    out_dir,
+                    "--infer_filename",
+                    alignment_file,
+                    "--model_name_or_path",
+                    "sentence-transformers/LaBSE",
+                    "--data_file_src",
+                    align_src,
+                    "--data_file_tgt",
+                    align_tgt,
+                    "--batch_size",
+                    str(align_batch_size),
+                    "--align_layer",
+                    "6",
+                    "--softmax_thresholds",
+                    "0.1",
+                ]
+                + (["--adapter_path", adapter_path] if adapter_path else []),
+                [align_src, align_tgt],
+                [alignment],
+                memory_gb=8.0,
+                gpus=1,
+            )
+        )
+        if setting == "ttrain":
+            add(
+                python_stage(
+                    f"postprocess_alignment-{task}-{name}",
+                    "devil_in_details/alignment/postprocess_alignment_ttrain.py",
+                    [original_file, translated_align_in, alignment, dataset_file]
+                    + tag_args
+                    + ["--complete_source", "--complete_target", "--complete_instance"],
+                    [original_file, translated_align_in, alignment],
+                    [dataset_file],
+                )
+            )
+        else:
+            add(
+                python_stage(
+                    f"postprocess_alignment-{task}-{name}",
+                    "devil_in_details/alignment/postprocess_alignment_ttest.py",
+                    [translated_align_in, original_file, alignment, dataset_file] + tag_args,
+                    [translated_align_in, original_file, alignment],
+                    [dataset_file],
+                )
+            )
+
+        if evaluate:
+            # The logits of the downstream model are produced outside of the pipeline
+            eval_dataset = f"data/final/nllb/{aligner}/{task}/{eval_split}-translate-{lang}-en.jsonl"
+            logits_dir = f"data/logits/{task}/{setting}"
+            logits = f"{logits_dir}/{eval_split}_{lang}_logits.pt"
+            score_file = f"data/scores/{task}/{setting}/{lang}_score.txt"
+            if setting == "ttest":
+                projected_logits = f"{logits_dir}/{eval_split}_{lang}_projected_logits.pt"
+                add(
+                    python_stage(
+                        f"project-{task}-{eval_split}-{lang}",
+                        "devil_in_details/evaluation/project_translate_test_logits_bio.py",
+                        [eval_dataset, logits, projected_logits, "--tokenizer_path", tokenizer_path, "--restrict_target"],
+                        [eval_dataset, logits],
+                        [projected_logits],
+                    )
+                )
+                logits = projected_logits
+            add(
+                python_stage(
+                    f"evaluate-{task}-{setting}-{eval_split}-{lang}",
+                    "devil_in_details/evaluation/evaluate_bio.py",
+                    [task, eval_dataset, score_file, logits],
+                    [eval_dataset, logits],
+                    [score_file],
+                )
+            )
+    return list(stages.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run translation, word alignment and evaluation as a DAG, re-running only changed stages"
+    )
+    parser.add_argument("task", choices=sorted(LANGS), help="Task")
+    parser.add_argument("setting", choices=["ttrain", "ttest"], help="Translate-train or translate-test")
+    parser.add_argument("--langs", nargs="+", default=None, help="Languages (default: all languages of the task)")
+    parser.add_argument("--split", default=None, help="Split (default: train for ttrain, test for ttest)")
+    parser.add_argument(
+        "--eval_split", default=None, help="Evaluation split of ttrain (test or val, default: test), ttest evaluates --split"
+    )
+    parser.add_argument("--work_dir", default=os.getcwd(), help="Root of the repository")
+    parser.add_argument("--state_dir", default=None, help="Pipeline state and logs (default: <work_dir>/data/pipeline)")
+    parser.add_argument("--nllb_model", default="facebook/nllb-200-3.3B")
+    parser.add_argument("--translation_batch_size", type=int, default=8)
+    parser.add_argument(
+        "--adapter_path", default=None, help="AccAlign adapter (default: no fine-tuning, written as accalign_noft)"
+    )
+    parser.add_argument("--align_batch_size", type=int, default=32)
+    parser.add_argument("--tokenizer_path", default="FacebookAI/xlm-roberta-large", help="Tokenizer of the downstream model")
+    parser.add_argument("--evaluate", action="store_true", help="Also project logits and compute the scores")
+    parser.add_argument("--max_cpus", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--max_memory_gb", type=float, default=32.0)
+    parser.add_argument("--max_gpus", type=int, default=1)
+    parser.add_argument("--force", action="store_true", help="Re-run all stages")
+    parser.add_argument("--dry_run", action="store_true", help="Only list the stages that would run")
+    args = parser.parse_args()
+
+    stages = build_stages(
+        args.task,
+        args.setting,
+        args.langs or LANGS[args.task],
+        args.split or ("train" if args.setting == "ttrain" else "test"),
+        nllb_model=args.nllb_model,
+        translation_batch_size=args.translation_batch_size,
+        adapter_path=args.adapter_path,
+        align_batch_size=args.align_batch_size,
+        tokenizer_path=args.tokenizer_path,
+        evaluate=args.evaluate,
+        eval_split=args.eval_split,
+    )
+    runner = PipelineRunner(
+        stages,
+        args.work_dir,
+        args.state_dir or os.path.join(args.work_dir, "data", "pipeline"),
+        max_cpus=args.max_cpus,
+        max_memory_gb=args.max_memory_gb,
+        max_gpus=args.max_gpus,
+        force=args.force,
+        dry_run=args.dry_run,
+    )
+    sys.exit(0 if runner.run() else 1)
+
+
+if __name__ == "__main__":
+    main()
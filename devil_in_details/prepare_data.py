@@ -1,8 +1,14 @@
 import datasets
 import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+import logging
+from typing import Any, Dict, List, Tuple
+import numpy as np
 from devil_in_details.utils import save_jsonl
 
+logger = logging.getLogger(__name__)
+
 intent_lable2id = {
     "AddToPlaylist": 0,
     "BookRestaurant": 1,
@@ -186,53 +192,145 @@ ID2LABEL = {
 }
 
 
-def prepare_masakhaner(outdir: str = "data/original/"):
+MASAKHANER_LANGS = (
+    "bam ewe fon hau ibo kin lug luo mos nya sna swa tsn twi wol xho yor zul".split()
+)
+
+# Tags 7/8 (MISC in conll2003, DATE in masakhaner2) are mapped to O
+NER_TAG_REMAP = np.arange(9)
+NER_TAG_REMAP[[7, 8]] = 0
+
+
+def remap_ner_tags(batch):
+    """Batched datasets.map function applying NER_TAG_REMAP to all tags of a batch at once."""
+    lengths = [len(tags) for tags in batch["ner_tags"]]
+    flat_tags = np.fromiter(
+        (tag for tags in batch["ner_tags"] for tag in tags),
+        dtype=np.int64,
+        count=sum(lengths),
+    )
+    remapped = NER_TAG_REMAP[flat_tags].tolist()
+    offsets = np.cumsum([0] + lengths).tolist()
+    return {
+        "ner_tags": [
+            remapped[start:end] for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+    }
+
+
+def masakhaner_jobs() -> List[Tuple[str, str, str, str]]:
+    """(HF dataset, config, split, language) of all source datasets of masakhaner."""
+    jobs = [("conll2003", None, split, "en") for split in ["train", "test", "validation"]]
+    jobs += [
+        ("masakhane/masakhaner2", lg, split, lg)
+        for lg in MASAKHANER_LANGS
+        for split in ["test", "validation"]
+    ]
+    return jobs
+
+
+def snapshot_path(snapshot_dir: str, path: str, name: str, split: str) -> str:
+    return os.path.join(snapshot_dir, path.replace("/", "__"), name or "default", split)
+
+
+def load_source_split(
+    path: str, name: str, split: str, snapshot_dir: str = None
+) -> datasets.Dataset:
+    """Split of a HF dataset, from the local snapshot (no network access) if snapshot_dir is set."""
+    if snapshot_dir is None:
+        return datasets.load_dataset(path, name, split=split)
+    local_path = snapshot_path(snapshot_dir, path, name, split)
+    if not os.path.isdir(local_path):
+        raise FileNotFoundError(
+            f"{path} ({name}, {split}) is missing in the snapshot {snapshot_dir}, create it with --export_snapshot"
+        )
+    # Memory-mapped Arrow files
+    return datasets.load_from_disk(local_path)
+
+
+def _save_snapshot_split(snapshot_dir: str, path: str, name: str, split: str) -> str:
+    local_path = snapshot_path(snapshot_dir, path, name, split)
+    datasets.load_dataset(path, name, split=split).save_to_disk(local_path)
+    return local_path
+
+
+def export_snapshot(snapshot_dir: str, num_workers: int = 4) -> None:
+    """Download all source datasets of masakhaner once and save them as a local Arrow snapshot.
+
+    The snapshot directory can be copied to machines without network access and passed
+    as --snapshot_dir.
+    """
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(_save_snapshot_split, snapshot_dir, path, name, split)
+            for path, name, split, _ in masakhaner_jobs()
+        ]
+        for future in futures:
+            logger.info(f"Saved snapshot {future.result()}")
+
+
+def export_masakhaner_split(
+    outdir: str,
+    path: str,
+    name: str,
+    split: str,
+    lang: str,
+    num_proc: int = None,
+    snapshot_dir: str = None,
+) -> str:
+    data = load_source_split(path, name, split, snapshot_dir)
+    # The remapped tags replace the ner_tags column, which moves to the end as before.
+    # A snapshot stays read-only: its map cache would be written next to its Arrow files
+    data = data.map(
+        remap_ner_tags,
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=["ner_tags"],
+        keep_in_memory=snapshot_dir is not None,
+        desc=f"Remapping {lang} {split}",
+    )
+    if split == "validation":
+        split = "val"
+
+    outfile = os.path.join(outdir, f"{split}-{lang}.jsonl")
+    data.to_json(outfile, force_ascii=False)
+    return outfile
+
+
+def prepare_masakhaner(
+    outdir: str = "data/original/",
+    num_proc: int = None,
+    num_workers: int = 4,
+    snapshot_dir: str = None,
+):
+    """Export conll2003 (en) and the masakhaner2 languages without MISC/DATE entities.
+
+    Args:
+        outdir: Output directory
+        num_proc: Processes per datasets.map call (None: in-process)
+        num_workers: Number of splits/languages prepared concurrently
+        snapshot_dir: Local snapshot of the source datasets (see export_snapshot), None
+            loads them with datasets.load_dataset
+    """
     # Get source data
     outdir = f"{outdir}/masakhaner"
     os.makedirs(outdir, exist_ok=True)
 
-    for split in ["train", "test", "validation"]:
-        data = datasets.load_dataset("conll2003", split=split)
-        # Replace MISC entity
-        ner_tag_column = []
-        for i, line in enumerate(data):
-            ner_tags = []
-            for j, tag in enumerate(line["ner_tags"]):
-                if tag == 7 or tag == 8:
-                    ner_tags.append(0)
-                else:
-                    ner_tags.append(tag)
-            ner_tag_column.append(ner_tags)
-        data = data.remove_columns("ner_tags")
-        data = data.add_column("ner_tags", ner_tag_column)
-        if split == "validation":
-            split = "val"
-
-        outfile = os.path.join(outdir, f"{split}-en.jsonl")
-        data.to_json(outfile, force_ascii=False)
-
-    for (
-        lg
-    ) in "bam ewe fon hau ibo kin lug luo mos nya sna swa tsn twi wol xho yor zul".split():
-        for split in ["test", "validation"]:
-            data = datasets.load_dataset("masakhane/masakhaner2", lg, split=split)
-            # Replace Date entity
-            ner_tag_column = []
-            for i, line in enumerate(data):
-                ner_tags = []
-                for j, tag in enumerate(line["ner_tags"]):
-                    if tag == 7 or tag == 8:
-                        ner_tags.append(0)
-                    else:
-                        ner_tags.append(tag)
-                ner_tag_column.append(ner_tags)
-            data = data.remove_columns("ner_tags")
-            data = data.add_column("ner_tags", ner_tag_column)
-            if split == "validation":
-                split = "val"
-
-            outfile = os.path.join(outdir, f"{split}-{lg}.jsonl")
-            data.to_json(outfile, force_ascii=False)
+    # Processes instead of threads: datasets.map forks its own workers, which is unsafe from threads
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(
+                export_masakhaner_split,
+                outdir,
+                *job,
+                num_proc=num_proc,
+                snapshot_dir=snapshot_dir,
+            )
+            for job in masakhaner_jobs()
+        ]
+        # Raises the first error of a job
+        for future in futures:
+            future.result()
 
 
 def seqs2data(tabular_file: str, skip_first_line: bool = False):
@@ -265,121 +363,181 @@ def seqs2data(tabular_file: str, skip_first_line: bool = False):
         the comments in the beginning of the instance.
     """
     sent = []
-    for line in open(tabular_file, mode="r", encoding="utf-8"):
-        if skip_first_line:
-            skip_first_line = False
-            continue
-        # because people use paste command, which includes empty tabs
-        if len(line) < 2 or line.replace("\t", "") in ["" "\n"]:
-            if len(sent) == 0:
+    # Index of the first line of the sentence with a given number of columns
+    first_idx_by_num_cols = {}
+    with open(tabular_file, mode="r", encoding="utf-8") as f:
+        for line in f:
+            if skip_first_line:
+                skip_first_line = False
                 continue
-            num_cols = len(sent[-1])
-            beg_idx = 0
-            for i in range(len(sent)):
-                back_idx = len(sent) - 1 - i
-                if len(sent[back_idx]) == num_cols:
-                    beg_idx = len(sent) - 1 - i
-            yield sent[beg_idx:], sent
-            sent = []
-        else:
-            if line.startswith("# text"):  # because tab in UD_Munduruku-TuDeT
-                line = line.replace("\t", " ")
-            sent.append([token for token in line.rstrip("\n").split("\t")])
+            # because people use paste command, which includes empty tabs
+            if len(line) < 2 or line.replace("\t", "") == "\n":
+                if len(sent) == 0:
+                    continue
+                # Lines before the first line with as many columns as the last one are comments
+                yield sent[first_idx_by_num_cols[len(sent[-1])] :], sent
+                sent = []
+                first_idx_by_num_cols = {}
+            else:
+                if line.startswith("# text"):  # because tab in UD_Munduruku-TuDeT
+                    line = line.replace("\t", " ")
+                sent.append(line.rstrip("\n").split("\t"))
+                first_idx_by_num_cols.setdefault(len(sent[-1]), len(sent) - 1)
 
     # adds the last sentence when there is no empty line
     if len(sent) != 0 and sent != [""]:
-        num_cols = len(sent[-1])
-        beg_idx = 0
-        for i in range(len(sent)):
-            back_idx = len(sent) - 1 - i
-            if len(sent[back_idx]) == num_cols:
-                beg_idx = len(sent) - 1 - i
-        yield sent[beg_idx:], sent
+        yield sent[first_idx_by_num_cols[len(sent[-1])] :], sent
+
+
+# Intents that are not in the evaluation data
+XSID_SKIPPED_INTENTS = {"weather/checkSunset", "weather/checkSunrise"}
+# Slot types that are mapped to O
+XSID_UNUSED_SLOTS = {
+    "alarm/alarm_modifier",
+    "negation",
+    "timer/attributes",
+    "weather/temperatureUnit",
+    "news/type",
+    "reminder/reminder_modifier",
+}
+# Marks the raw tag of the broken instances of the data
+XSID_BROKEN_TAG = -1
+
+
+def xsid_tag_id(entity_tag_raw: str) -> int:
+    """Label id of a raw xSID slot tag, XSID_BROKEN_TAG for the broken tag of the data."""
+    if entity_tag_raw[1:] == "-reference-part":
+        entity_tag_raw = f"{entity_tag_raw[0]}-reference"
+    # Map unused labels to O
+    if entity_tag_raw[2:] in XSID_UNUSED_SLOTS:
+        entity_tag_raw = "O"
+    # Weird error in the data (check the previous instance)
+    if entity_tag_raw == "Orecurring_datetime":
+        return XSID_BROKEN_TAG
+    entity_tag = label2id.get(entity_tag_raw, None)
+    if entity_tag == None:
+        raise AssertionError(f"Unknown xSID tag {entity_tag_raw}")
+    return entity_tag
+
+
+def read_xsid(conll_file: str, deduplicate: bool = False) -> List[Dict[str, Any]]:
+    """Instances (tokens, entity_tags, intent) of an xSID CoNLL file in a single pass.
+
+    The raw slot tags are converted with a lookup table that is filled with xsid_tag_id
+    on the first occurrence of a tag.
+
+    Args:
+        conll_file: Path to the xSID file
+        deduplicate: Drop repeated instances (same tokens and intent)
+    """
+    tag_table = {}
+    seen = set()
+    output_data = []
+    for tokens_and_labels, _ in seqs2data(conll_file):
+        intent_raw = tokens_and_labels[0][2]
+        if intent_raw in XSID_SKIPPED_INTENTS:
+            continue
+        intent_label = intent_lable2id.get(intent_raw, None)
+        if intent_label == None:
+            raise AssertionError(f"Unknown xSID intent {intent_raw}")
 
+        tokens, entity_tags = [], []
+        for token_and_label in tokens_and_labels:
+            if token_and_label[1] == "":
+                continue
+            entity_tag_raw = token_and_label[3]
+            entity_tag = tag_table.get(entity_tag_raw)
+            if entity_tag is None:
+                entity_tag = tag_table[entity_tag_raw] = xsid_tag_id(entity_tag_raw)
+            if entity_tag == XSID_BROKEN_TAG:
+                break
+            tokens.append(token_and_label[1])
+            entity_tags.append(entity_tag)
+        else:
+            if deduplicate:
+                # Concatenate tokens and intent to find duplicates
+                key = " ".join(tokens + [str(intent_label)])
+                if key in seen:
+                    continue
+                seen.add(key)
+            output_data.append(
+                {"tokens": tokens, "entity_tags": entity_tags, "intent": intent_label}
+            )
+    return output_data
+
+
+def export_xsid_split(input_dir: str, outdir: str, lang: str, split: str) -> str:
+    # Deduplicate the training data
+    output_data = read_xsid(
+        f"{input_dir}/{lang}.{split}.conll", deduplicate=split == "train"
+    )
+
+    # Posprocess the filename
+    if split == "valid":
+        split = "val"
 
-def prepare_xsid(outdir: str = "data/original/"):
+    outfile = f"{outdir}/{split}-{lang}.jsonl"
+    save_jsonl(data=output_data, filepath=outfile)
+    return outfile
+
+
+def prepare_xsid(outdir: str = "data/original/", num_workers: int = 4):
 
     input_dir = f"{outdir}/raw/xSID-0.5"
     outdir = f"{outdir}/xsid"
     os.makedirs(outdir, exist_ok=True)
 
-    all_tags = set()
-    for lang in "ar da de-st de en id it kk nl sr tr zh".split():
-        for split in "valid test".split():  # "train valid test"
-            output_data = []
-            broken_instance = set()
-            if split == "train" and lang != "en":
-                continue
-            data = seqs2data(f"{input_dir}/{lang}.{split}.conll")
-            for i, row in enumerate(data):
-                output_row = {"tokens": [], "entity_tags": []}
-                tokens_and_labels = row[0]
-                intent_raw = tokens_and_labels[0][2]
-                # Skip these intents ==> Those are not in the evaluation data
-                if intent_raw in ["weather/checkSunset", "weather/checkSunrise"]:
-                    continue
-                intent_label = intent_lable2id.get(intent_raw, None)
-                if intent_label == None:
-                    raise AssertionError
-                output_row["intent"] = intent_label
-                for j, token_and_label in enumerate(tokens_and_labels):
-                    if token_and_label[1] != "":
-                        output_row["tokens"].append(token_and_label[1])
-                    else:
-                        continue
-                    entity_tag_raw = token_and_label[3]
-                    if entity_tag_raw[1:] == "-reference-part":
-                        entity_tag_raw = f"{entity_tag_raw[0]}-reference"
-                    # Map unused labels to O
-                    if entity_tag_raw[2:] in [
-                        "alarm/alarm_modifier",
-                        "negation",
-                        "timer/attributes",
-                        "weather/temperatureUnit",
-                        "news/type",
-                        "reminder/reminder_modifier",
-                    ]:
-                        entity_tag_raw = "O"
-                    # Weird error in the data (check the previous instance)
-                    if entity_tag_raw == "Orecurring_datetime":
-                        broken_instance.add(i)
-                        break
-                    entity_tag = label2id.get(entity_tag_raw, None)
-                    all_tags.add(entity_tag)
-                    if entity_tag == None:
-                        raise AssertionError
-                    output_row["entity_tags"].append(entity_tag)
-                if i in broken_instance:
-                    continue
-                assert len(output_row["entity_tags"]) == len(output_row["tokens"])
-                output_data.append(output_row)
-
-            # Deduplicate the training data
-            hashed_example = set()
-            del_indices = []
-            if split == "train":
-                for i, row in enumerate(output_data):
-                    # Concatenate tokens and intent to find duplicates
-                    tokens = " ".join(row["tokens"] + [str(row["intent"])])
-                    if tokens in hashed_example:
-                        del_indices.append(i)
-                    else:
-                        hashed_example.add(tokens)
-                for i in sorted(del_indices, reverse=True):
-                    del output_data[i]
-
-            # Posprocess the filename
-            if split == "valid":
-                split = "val"
-
-            save_jsonl(data=output_data, filepath=f"{outdir}/{split}-{lang}.jsonl")
+    jobs = [
+        (lang, split)
+        for lang in "ar da de-st de en id it kk nl sr tr zh".split()
+        for split in "valid test".split()  # "train valid test"
+        if not (split == "train" and lang != "en")
+    ]
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(export_xsid_split, input_dir, outdir, lang, split)
+            for lang, split in jobs
+        ]
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--outdir", default="data/original/", help="Output directory")
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=None,
+        help="Processes per datasets.map call when remapping tags",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="Number of datasets prepared concurrently",
+    )
+    parser.add_argument(
+        "--snapshot_dir",
+        default=None,
+        help="Prepare masakhaner offline from a local snapshot of the source datasets",
+    )
+    parser.add_argument(
+        "--export_snapshot",
+        default=None,
+        help="Only download the masakhaner source datasets and save them as a snapshot to this directory",
+    )
 
     args = parser.parse_args()
 
-    prepare_masakhaner(args.outdir)
-    prepare_xsid(args.outdir)
+    if args.export_snapshot:
+        export_snapshot(args.export_snapshot, num_workers=args.num_workers)
+        exit(0)
+
+    prepare_masakhaner(
+        args.outdir,
+        num_proc=args.num_proc,
+        num_workers=args.num_workers,
+        snapshot_dir=args.snapshot_dir,
+    )
+    prepare_xsid(args.outdir, num_workers=args.num_workers)
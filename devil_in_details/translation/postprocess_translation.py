@@ -1,44 +1,74 @@
 import re
 import os
+import json
 import argparse
 import logging
-from devil_in_details.utils import load_jsonl, save_jsonl
+from typing import Iterable
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Zero-width characters, the left-to-right mark and no-break spaces become spaces
+CLEAN_TABLE = str.maketrans(
+    {char: " " for char in ["\u200c", "\u200b", "\u200d", "\u200e", "\xa0"]}
+)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
 
 def clean_translation(text):
-    text = (
-        text.replace("\u200c", " ")
-        .replace("\u200b", " ")
-        .replace("\u200d", " ")
-        .replace("\u200e", " ")
-        .replace("\xa0", " ")
-    )
-    text = re.sub(r"\s+", " ", text)
-    return text
+    return WHITESPACE_PATTERN.sub(" ", text.translate(CLEAN_TABLE))
 
 
-def postprocess_bio(
-    input_path: str,
-    lang: str,
-):
+def processed_path(input_path: str) -> str:
+    """Path of the postprocessed version of a translated data file."""
     in_dir_name = os.path.dirname(input_path)
     in_file_name = os.path.splitext(os.path.basename(input_path))[0]
-    output_file_name = f"{in_file_name}-processed"
+    return f"{in_dir_name}/{in_file_name}-processed.jsonl"
+
+
+class StreamingPostprocessor:
+    """Writes cleaned translations to a JSONL file as they are produced.
+
+    Usage:
+        with StreamingPostprocessor(output_path, lang) as postprocessor:
+            postprocessor.write(translations)
+    """
 
-    # Read input data
-    input_data = load_jsonl(input_path)
+    def __init__(self, output_path: str, lang: str):
+        self.output_path = output_path
+        self.lang = lang
+        self.file = None
 
-    out_data = []
-    for line in input_data:
-        line = clean_translation(line["translation"][lang])
-        out_data.append({"translation": {lang: line}})
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
+        self.file = open(self.output_path, "w", encoding="utf-8")
+        return self
 
-    # Write output
-    save_jsonl(out_data, f"{in_dir_name}/{output_file_name}.jsonl")
+    def write(self, translations: Iterable[str]) -> None:
+        for translation in translations:
+            json.dump(
+                {"translation": {self.lang: clean_translation(translation)}},
+                self.file,
+                ensure_ascii=False,
+            )
+            self.file.write("\n")
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+
+def postprocess_bio(
+    input_path: str,
+    lang: str,
+):
+    # Streamed line by line, the file is never held in memory
+    with open(input_path, "r", encoding="utf-8") as f, StreamingPostprocessor(
+        processed_path(input_path), lang
+    ) as postprocessor:
+        for line in f:
+            if line.strip():
+                postprocessor.write([json.loads(line)["translation"][lang]])
 
 
 if __name__ == "__main__":
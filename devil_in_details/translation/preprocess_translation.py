@@ -2,12 +2,25 @@ import argparse
 import re
 import os
 import logging
+from functools import lru_cache
+from typing import Callable, Dict, List
 from devil_in_details.utils import load_jsonl, save_jsonl
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Hiragana/Katakana, CJK ideographs, halfwidth Katakana and Thai
+CJK_PATTERN = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f\u0E00-\u0E7F]"
+)
+
+
+@lru_cache(maxsize=1 << 18)
+def is_Chinese_or_Japanese_token(token: str) -> bool:
+    """True if the token contains a Chinese, Japanese (or Thai) character, cached per token."""
+    return CJK_PATTERN.search(token) is not None
+
 
 def judge_if_Chinese_and_Japanese_token(pretokenized_text):
     """
@@ -20,19 +33,42 @@ def judge_if_Chinese_and_Japanese_token(pretokenized_text):
         a 0, 1 list, 1 means is Chinese token, 0 means not.
         [1, 1, 1, 1, 1, 1, 0]
     """
-    "U+0E00..U+0E7F"
-    return [
-        (
-            1
-            if re.search(
-                r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f\u0E00-\u0E7F]+",
-                i,
-            )
-            != None
-            else 0
-        )
-        for i in pretokenized_text
-    ]
+    return [int(is_Chinese_or_Japanese_token(i)) for i in pretokenized_text]
+
+
+def merge_Chinese_tokens(tokens: List[str]) -> str:
+    """Join tokens with whitespace, except between two Chinese/Japanese tokens."""
+    pieces = []
+    prev_is_cjk = False
+    for idx, token in enumerate(tokens):
+        is_cjk = is_Chinese_or_Japanese_token(token)
+        if idx > 0 and not (prev_is_cjk and is_cjk):
+            pieces.append(" ")
+        pieces.append(token)
+        prev_is_cjk = is_cjk
+    return "".join(pieces)
+
+
+# Language-specific conversion of pretokenized text into the input text of the translation
+# model, languages without an entry are joined with whitespace
+DETOKENIZERS: Dict[str, Callable[[List[str]], str]] = {}
+
+
+def register_detokenizer(lang: str):
+    """Decorator registering a function List[str] -> str as the detokenizer of lang."""
+
+    def register(detokenizer):
+        DETOKENIZERS[lang] = detokenizer
+        return detokenizer
+
+    return register
+
+
+register_detokenizer("zh")(merge_Chinese_tokens)
+
+
+def detokenize_for_translation(tokens: List[str], lang: str) -> str:
+    return DETOKENIZERS.get(lang, " ".join)(tokens)
 
 
 def preprocess(
@@ -56,34 +92,8 @@ def preprocess(
 
     out_data = []
     for line in input_data:
-        tokens = line[column]
-
-        if lang == "zh":
-            # Merge Chinese tokens without whitespace
-            Chinese_or_Eng_list = judge_if_Chinese_and_Japanese_token(tokens)
-            text = tokens[0]
-            if len(tokens) > 1:
-                for idx, token in enumerate(tokens):
-                    if idx == 0:
-                        # Already part of text
-                        continue
-                    # 1. Case: Previous token is not Chinese or current token is not Chinese
-                    if (
-                        Chinese_or_Eng_list[idx - 1] == 0
-                        or Chinese_or_Eng_list[idx] == 0
-                    ):
-                        text = text + " " + token
-                    # 2. Case: Previous token is Chinese and current token is Chinese
-                    elif (
-                        Chinese_or_Eng_list[idx] == 1
-                        and Chinese_or_Eng_list[idx - 1] == 1
-                    ):
-                        text = text + token
-                    else:
-                        raise AssertionError
-
-        else:
-            text = " ".join(tokens)
+        # zh: Chinese tokens are merged without whitespace
+        text = detokenize_for_translation(line[column], lang)
 
         out_data.append({"translation": {lang: text}})
 
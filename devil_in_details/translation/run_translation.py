@@ -6,7 +6,13 @@ from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 from tqdm import tqdm
 
 # sys.path.append("/home/bee82nf/devil-in-details")
-from devil_in_details.utils import load_jsonl, save_jsonl
+from devil_in_details.utils import load_jsonl, track_stage
+from devil_in_details.translation.postprocess_translation import (
+    StreamingPostprocessor,
+    processed_path,
+)
+import contextlib
+import json
 import logging
 
 # Set up logging
@@ -445,6 +451,12 @@ def main():
         "--max_length", type=int, default=512, help="Maximum sequence length"
     )
     parser.add_argument("--device", help="Device to use (cuda/cpu)")
+    parser.add_argument(
+        "--postprocess",
+        action="store_true",
+        help="Also write the cleaned translations (<output_file>-processed.jsonl) while translating, "
+        "replaces running postprocess_translation.py afterwards",
+    )
 
     args = parser.parse_args()
 
@@ -455,7 +467,8 @@ def main():
         return
 
     # Initialize translator
-    translator = NLLBTranslator(model_name=args.model, device=args.device)
+    with track_stage("load_translation_model"):
+        translator = NLLBTranslator(model_name=args.model, device=args.device)
 
     # Set nllb codes
     nllb_src_lang = ISO2NLLB[args.src_lang]["code"]
@@ -472,25 +485,33 @@ def main():
         f"Translating {len(texts)} texts from {nllb_src_lang} to {nllb_trg_lang}"
     )
 
-    # Translate in batches
-    result = []
-
-    for i in tqdm(range(0, len(texts), args.batch_size), desc="Translating batches"):
-        batch_texts = texts[i : i + args.batch_size]
-
-        # Translate batch
-        batch_translations = translator.translate_batch(
-            batch_texts, nllb_src_lang, nllb_trg_lang, args.max_length
-        )
-        batch_translations = [t.strip() for t in batch_translations]
+    # Translate in batches, every batch is written (and cleaned) as soon as it is translated
+    os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
+    with track_stage("translate", unit="sentences") as stage, open(
+        args.output_file, "w", encoding="utf-8"
+    ) as f, (
+        StreamingPostprocessor(processed_path(args.output_file), args.trg_lang)
+        if args.postprocess
+        else contextlib.nullcontext()
+    ) as postprocessor:
+        for i in tqdm(
+            range(0, len(texts), args.batch_size), desc="Translating batches"
+        ):
+            batch_texts = texts[i : i + args.batch_size]
+
+            # Translate batch
+            batch_translations = translator.translate_batch(
+                batch_texts, nllb_src_lang, nllb_trg_lang, args.max_length
+            )
+            batch_translations = [t.strip() for t in batch_translations]
 
-        for t in batch_translations:
-            t_item = {"translation": {args.trg_lang: t}}
-            result.append(t_item)
+            for t in batch_translations:
+                json.dump({"translation": {args.trg_lang: t}}, f, ensure_ascii=False)
+                f.write("\n")
+            if postprocessor is not None:
+                postprocessor.write(batch_translations)
+            stage.add_items(len(batch_translations))
 
-    # Save results
-    os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
-    save_jsonl(result, args.output_file)
     logger.info("Translation completed successfully!")
 
 
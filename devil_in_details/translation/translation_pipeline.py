@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import logging
+from typing import Callable, List, Optional
+
+from tqdm import tqdm
+
+from devil_in_details.utils import load_jsonl
+from devil_in_details.translation.preprocess_translation import (
+    detokenize_for_translation,
+)
+from devil_in_details.translation.postprocess_translation import clean_translation
+from devil_in_details.translation.run_translation import ISO2NLLB, NLLBTranslator
+from devil_in_details.alignment.prepare_alignment import get_translated_tokenizer
+
+# Set up logging
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Marks the end of the translated batches in the queue
+_DONE = object()
+
+
+class AlignmentInputWriter(threading.Thread):
+    """Cleans, tokenizes and writes translated batches taken from a bounded queue.
+
+    Runs next to the translation loop, so the CPU work on a batch overlaps with the
+    translation of the following batches. Writes the processed translations (JSONL)
+    and the alignment inputs of the original and the translated side (one line each).
+    """
+
+    def __init__(
+        self,
+        batches: "queue.Queue",
+        trg_lang: str,
+        translated_tokenizer: Callable[[str], str],
+        processed_output_file: str,
+        original_align_in_file: str,
+        translated_align_in_file: str,
+    ):
+        super().__init__(daemon=True)
+        self.batches = batches
+        self.trg_lang = trg_lang
+        self.translated_tokenizer = translated_tokenizer
+        self.output_files = [
+            processed_output_file,
+            original_align_in_file,
+            translated_align_in_file,
+        ]
+        self.error: Optional[BaseException] = None
+
+    def run(self):
+        try:
+            for path in self.output_files:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(self.output_files[0], "w", encoding="utf-8") as f_processed, open(
+                self.output_files[1], "w", encoding="utf-8"
+            ) as f_original, open(self.output_files[2], "w", encoding="utf-8") as f_translated:
+                while True:
+                    batch = self.batches.get()
+                    if batch is _DONE:
+                        return
+                    original_tokens, translations = batch
+                    for tokens, translation in zip(original_tokens, translations):
+                        translation = clean_translation(translation)
+                        json.dump(
+                            {"translation": {self.trg_lang: translation}},
+                            f_processed,
+                            ensure_ascii=False,
+                        )
+                        f_processed.write("\n")
+                        f_original.write(" ".join(tokens) + "\n")
+                        f_translated.write(self.translated_tokenizer(translation) + "\n")
+        except BaseException as e:
+            self.error = e
+
+    def put(self, batch) -> None:
+        """Queue a batch, fails as soon as the writer died instead of translating until the queue is full."""
+        while True:
+            if self.error is not None or not self.is_alive():
+                raise RuntimeError("Alignment input writer stopped") from self.error
+            try:
+                self.batches.put(batch, timeout=1.0)
+                return
+            except queue.Full:
+                pass
+
+
+def run_pipeline(
+    translator: NLLBTranslator,
+    original_data: List[List[str]],
+    src_lang: str,
+    trg_lang: str,
+    processed_output_file: str,
+    original_align_in_file: str,
+    translated_align_in_file: str,
+    batch_size: int = 8,
+    max_length: int = 512,
+    tokenizer: str = "whitespace",
+    queue_size: int = 16,
+) -> None:
+    """Preprocess, translate, postprocess and prepare the alignment input in one pass.
+
+    Args:
+        translator: Loaded NLLB translator
+        original_data: Pretokenized original sentences
+        src_lang: Language of the original data (ISO639)
+        trg_lang: Language to translate to (ISO639)
+        processed_output_file: Path of the cleaned translations (JSONL)
+        original_align_in_file: Path of the alignment input of the original data
+        translated_align_in_file: Path of the alignment input of the translated data
+        tokenizer: Tokenization of the translations for the alignment, see prepare_alignment
+        queue_size: Maximum number of translated batches waiting for the writer
+    """
+    texts = [detokenize_for_translation(tokens, src_lang) for tokens in original_data]
+    nllb_src_lang = ISO2NLLB[src_lang]["code"]
+    nllb_trg_lang = ISO2NLLB[trg_lang]["code"]
+
+    writer = AlignmentInputWriter(
+        queue.Queue(maxsize=queue_size),
+        trg_lang,
+        get_translated_tokenizer(trg_lang, tokenizer),
+        processed_output_file,
+        original_align_in_file,
+        translated_align_in_file,
+    )
+    writer.start()
+    try:
+        for i in tqdm(range(0, len(texts), batch_size), desc="Translating batches"):
+            batch_translations = translator.translate_batch(
+                texts[i : i + batch_size], nllb_src_lang, nllb_trg_lang, max_length
+            )
+            writer.put(
+                (original_data[i : i + batch_size], [t.strip() for t in batch_translations])
+            )
+    finally:
+        if writer.is_alive():
+            writer.put(_DONE)
+        writer.join()
+    if writer.error is not None:
+        raise writer.error
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Translate pretokenized data and write the cleaned translations and "
+        "the word alignment inputs, without intermediate files"
+    )
+    parser.add_argument("input_file", help="Original data in JSONL format")
+    parser.add_argument(
+        "column", help="Column with the tokens that are translated and aligned"
+    )
+    parser.add_argument("processed_output_file", help="Cleaned translations (JSONL)")
+    parser.add_argument(
+        "original_align_in_file", help="Alignment input of the original data"
+    )
+    parser.add_argument(
+        "translated_align_in_file", help="Alignment input of the translated data"
+    )
+    parser.add_argument(
+        "--src_lang", required=True, help="Source language code (ISO639)"
+    )
+    parser.add_argument(
+        "--trg_lang", required=True, help="Target language code (ISO639)"
+    )
+    parser.add_argument(
+        "--model", default="facebook/nllb-200-3.3B", help="NLLB model name"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=8, help="Batch size for translation"
+    )
+    parser.add_argument(
+        "--max_length", type=int, default=512, help="Maximum sequence length"
+    )
+    parser.add_argument("--device", help="Device to use (cuda/cpu)")
+    parser.add_argument(
+        "--tokenizer",
+        default="whitespace",
+        help="Set to 'moses' to pretokenize the translations with MosesTokenizer, zh will always be tokenized with jieba",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=16,
+        help="Maximum number of translated batches waiting to be cleaned and tokenized",
+    )
+    args = parser.parse_args()
+
+    original_data = [line[args.column] for line in load_jsonl(args.input_file)]
+    if not original_data:
+        logger.error("No data loaded. Exiting.")
+        return
+
+    translator = NLLBTranslator(model_name=args.model, device=args.device)
+    logger.info(
+        f"Translating {len(original_data)} texts from {args.src_lang} to {args.trg_lang}"
+    )
+    run_pipeline(
+        translator,
+        original_data,
+        args.src_lang,
+        args.trg_lang,
+        args.processed_output_file,
+        args.original_align_in_file,
+        args.translated_align_in_file,
+        batch_size=args.batch_size,
+        max_length=args.max_length,
+        tokenizer=args.tokenizer,
+        queue_size=args.queue_size,
+    )
+    logger.info("Translation pipeline completed successfully!")
+
+
+if __name__ == "__main__":
+    main()
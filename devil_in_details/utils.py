@@ -1,7 +1,14 @@
 import json
 import argparse
+import atexit
+import functools
+import resource
+import sys
+import threading
 from collections import defaultdict
-from typing import List, Dict, Any, Tuple
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Dict, Any, Tuple, Optional, Callable, Iterator
 import logging
 import os
 import torch
@@ -174,6 +181,207 @@ def load_logits_with_retry(
                 )
 
 
+# If set, every process appends its run report (one JSON object per line) to this file at exit
+RUN_REPORT_ENV = "DEVIL_IN_DETAILS_RUN_REPORT"
+
+
+def _cpu_time() -> float:
+    """CPU time of the process and its finished child processes (e.g. multiprocessing workers)."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def process_peak_rss_mb() -> float:
+    """Peak resident set size of the process since it started.
+
+    Use this instead of ru_maxrss, which track_stage lowers on Linux when it resets the high
+    water mark of the RSS at the start of a stage.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    peak = peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    return max(peak, _peak_before_reset_mb)
+
+
+def _high_water_mark_mb() -> Optional[float]:
+    """Peak resident set size since the last _reset_high_water_mark (VmHWM, Linux only)."""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_high_water_mark() -> bool:
+    """Reset VmHWM to the current RSS, returns False if the kernel does not allow it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class StageStats:
+    """Wall time, CPU time, peak RSS and throughput of a stage, see track_stage."""
+
+    def __init__(self, name: str, unit: str = "items"):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.status = "running"
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss_mb = 0.0
+        # "stage" if peak_rss_mb was measured within the stage, "process" if it is the peak of the
+        # process since it started (where the high water mark of the RSS cannot be reset)
+        self.peak_rss_scope = "stage"
+
+    def add_items(self, n: int) -> None:
+        """Count n more processed items (sentences, examples, ...)."""
+        self.items += n
+
+    @property
+    def items_per_sec(self) -> float:
+        return self.items / self.wall_time if self.wall_time > 0 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "status": self.status,
+            "wall_time": round(self.wall_time, 4),
+            "cpu_time": round(self.cpu_time, 4),
+            "peak_rss_mb": round(self.peak_rss_mb, 1),
+            "peak_rss_scope": self.peak_rss_scope,
+            "items": self.items,
+            "unit": self.unit,
+            "items_per_sec": round(self.items_per_sec, 2),
+        }
+
+
+_run_start = (datetime.now().isoformat(timespec="seconds"), time.perf_counter(), _cpu_time())
+_finished_stages: List[StageStats] = []
+_active_stages = threading.local()
+_report_registered = False
+# Stages of all threads share the high water mark of the process
+_open_stages: List[StageStats] = []
+_open_stages_lock = threading.Lock()
+_peak_before_reset_mb = 0.0
+
+
+def _start_peak_rss(stats: StageStats) -> None:
+    global _peak_before_reset_mb
+    with _open_stages_lock:
+        # Resetting the high water mark loses the peak of the process and of the stages that are
+        # still running, keep it
+        peak = _high_water_mark_mb()
+        if peak is not None:
+            _peak_before_reset_mb = max(_peak_before_reset_mb, peak)
+            for other in _open_stages:
+                other.peak_rss_mb = max(other.peak_rss_mb, peak)
+        if not _reset_high_water_mark():
+            stats.peak_rss_scope = "process"
+        _open_stages.append(stats)
+
+
+def _finish_peak_rss(stats: StageStats) -> None:
+    with _open_stages_lock:
+        _open_stages.remove(stats)
+        peak = _high_water_mark_mb() if stats.peak_rss_scope == "stage" else None
+        if peak is None:
+            stats.peak_rss_scope = "process"
+            stats.peak_rss_mb = process_peak_rss_mb()
+        else:
+            stats.peak_rss_mb = max(stats.peak_rss_mb, peak)
+
+
+@contextmanager
+def track_stage(name: str, unit: str = "items") -> Iterator[StageStats]:
+    """Measure a stage of the pipeline and add it to the run report.
+
+    The yielded StageStats counts the processed items (stats.add_items) for the throughput.
+    CPU time includes the finished child processes. Peak RSS is the peak of the process (without
+    its children) within the stage, or since the process started where it cannot be reset (see
+    StageStats.peak_rss_scope).
+
+    Args:
+        name: Name of the stage in the log and the run report
+        unit: What the items are (e.g. sentences)
+    """
+    global _report_registered
+    if os.environ.get(RUN_REPORT_ENV) and not _report_registered:
+        atexit.register(write_run_report, os.environ[RUN_REPORT_ENV])
+        _report_registered = True
+
+    stats = StageStats(name, unit)
+    stack = _active_stages.__dict__.setdefault("stack", [])
+    stack.append(stats)
+    _start_peak_rss(stats)
+    start_wall, start_cpu = time.perf_counter(), _cpu_time()
+    try:
+        yield stats
+        stats.status = "ok"
+    except BaseException:
+        stats.status = "failed"
+        raise
+    finally:
+        stats.wall_time = time.perf_counter() - start_wall
+        stats.cpu_time = _cpu_time() - start_cpu
+        _finish_peak_rss(stats)
+        stack.pop()
+        _finished_stages.append(stats)
+        logger.info(
+            f"Stage {name} {stats.status}: {stats.wall_time:.2f}s wall, {stats.cpu_time:.2f}s CPU, "
+            f"peak RSS {stats.peak_rss_mb:.0f} MB, {stats.items} {unit} ({stats.items_per_sec:.1f}/s)"
+        )
+
+
+def current_stage() -> StageStats:
+    """Innermost stage tracked by the calling thread (an unrecorded one outside of any stage)."""
+    stack = getattr(_active_stages, "stack", None)
+    return stack[-1] if stack else StageStats("untracked")
+
+
+def timed_stage(name: Optional[str] = None, unit: str = "items") -> Callable:
+    """Decorator tracking every call of a function as a stage (named after the function by default),
+    the function counts its items with current_stage().add_items."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_stage(name or func.__name__, unit):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def run_report() -> Dict[str, Any]:
+    """Machine-readable report of the stages the process finished so far, the totals count from the
+    import of this module."""
+    return {
+        "command": sys.argv,
+        "pid": os.getpid(),
+        "start_time": _run_start[0],
+        "wall_time": round(time.perf_counter() - _run_start[1], 4),
+        "cpu_time": round(_cpu_time() - _run_start[2], 4),
+        "process_peak_rss_mb": round(process_peak_rss_mb(), 1),
+        "stages": [stats.to_dict() for stats in _finished_stages],
+    }
+
+
+def write_run_report(filepath: str) -> None:
+    """Append the run report as one JSON line to filepath."""
+    if os.path.dirname(filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run_report()) + "\n")
+
+
 def str_to_bool(v: str) -> bool:
     """Convert string to boolean."""
     if isinstance(v, bool):
@@ -3,23 +3,23 @@ SOURCE_FILE=$1
 TARGET_FILE=$2
 OUTPUT_DIR=$3
 OUTPUT_FILE=$4
-ALIGNMENT_THRESHOLD=${5:-0.1}
+ALIGNMENT_THRESHOLD=${5:-0.1} # Space-separated list (e.g., "0.05 0.1 0.2") writes one alignment file per threshold
 BATCH_SIZE=${6:-32}
+EMBEDDING_CACHE_DIR=${7:-} # Optional cache of the hidden states (e.g., reused for the English side of translate-train)
 
 ADAPTER=/data/42-julia-hpc-rz-wuenlp/bee82nf/.cache/huggingface/adapter/checkpoint
 MODEL='sentence-transformers/LaBSE'
 
-python AccAlign/train_alignment_adapter.py \
-    --infer_path $OUTPUT_DIR \
+python AccAlign/accalign_infer.py \
+    --output_dir $OUTPUT_DIR \
     --infer_filename $OUTPUT_FILE \
     --adapter_path $ADAPTER \
     --model_name_or_path $MODEL \
-    --extraction 'softmax' \
-    --infer_data_file_src $SOURCE_FILE \
-    --infer_data_file_tgt $TARGET_FILE \
-    --per_gpu_train_batch_size ${BATCH_SIZE} \
+    --data_file_src $SOURCE_FILE \
+    --data_file_tgt $TARGET_FILE \
+    --batch_size ${BATCH_SIZE} \
     --align_layer 6 \
-    --softmax_threshold $ALIGNMENT_THRESHOLD \
-    --do_test \
+    --softmax_thresholds $ALIGNMENT_THRESHOLD \
+    ${EMBEDDING_CACHE_DIR:+--embedding_cache_dir $EMBEDDING_CACHE_DIR}
 
 exit
\ No newline at end of file
@@ -20,8 +20,5 @@ echo Model: $MODEL
 ### Preprocessing
 python $WORK_DIR/devil_in_details/translation/preprocess_translation.py ${SRC_PATH} ${SRC_PATH_PRE} ${COLUMN} ${SRC_LANG}
 
-# Translation
-python $WORK_DIR/devil_in_details/translation/run_translation.py ${SRC_PATH_PRE} ${OUT_PATH} --src_lang ${SRC_LANG} --trg_lang ${TRG_LANG} --model ${MODEL} --batch_size ${BATCH_SIZE} --device "cuda"
-
-### Postprocessing
-python $WORK_DIR/devil_in_details/translation/postprocess_translation.py ${OUT_PATH} ${TRG_LANG}
\ No newline at end of file
+# Translation, the translations are postprocessed (${OUT_PATH%.jsonl}-processed.jsonl) as they are produced
+python $WORK_DIR/devil_in_details/translation/run_translation.py ${SRC_PATH_PRE} ${OUT_PATH} --src_lang ${SRC_LANG} --trg_lang ${TRG_LANG} --model ${MODEL} --batch_size ${BATCH_SIZE} --device "cuda" --postprocess
\ No newline at end of file